@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Compare per-block codec construction against the cached CodecContext used by
+Algorithm.data_compress and Algorithm.data_decompress on small blocks.
+
+Usage (with the package installed, e.g. pip install -e .):
+    python benchmarks/bench_codec_contexts.py [--blocks N] [--blocksize BYTES]
+"""
+import argparse
+import random
+import time
+
+from mkzftree2.models.algorithm import Algorithm, CodecContext
+
+LEVELS = {
+    Algorithm.ZLIB: 6,
+    Algorithm.XZ: 6,
+    Algorithm.LZ4: 1,
+    Algorithm.ZSTD: 3,
+    Algorithm.BZIP2: 9,
+}
+
+
+def make_blocks(count, blocksize):
+    random.seed(0)
+    words = [b'alpha', b'beta', b'gamma', b'delta', b'\n', b'0123', b'{"key": ']
+    blocks = []
+    for _ in range(count):
+        data = bytearray()
+        while len(data) < blocksize:
+            data += random.choice(words)
+        blocks.append(bytes(data[:blocksize]))
+    return blocks
+
+
+def timed(func, blocks):
+    start = time.perf_counter()
+    for block in blocks:
+        func(block)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=2000)
+    parser.add_argument('--blocksize', type=int, default=2**15)
+    opt = parser.parse_args()
+
+    blocks = make_blocks(opt.blocks, opt.blocksize)
+
+    print(f"{'algorithm':<8} {'op':<10} {'fresh MB/s':>12} {'cached MB/s':>12} {'gain':>7}")
+    for alg, level in LEVELS.items():
+        # Slow codecs run on a tenth of the blocks
+        sample = blocks[:len(blocks) // 10 or 1] if alg in (Algorithm.XZ, Algorithm.BZIP2) else blocks
+        size = len(sample) * opt.blocksize / 2**20
+
+        fresh = timed(lambda b: CodecContext(alg, level).compress(b), sample)
+        cached = timed(lambda b: alg.data_compress(b, level), sample)
+        print(f"{alg.name:<8} {'compress':<10} {size/fresh:12.1f} {size/cached:12.1f} {fresh/cached:6.2f}x")
+
+        compressed = [alg.data_compress(b, level) for b in sample]
+        fresh = timed(lambda b: CodecContext(alg).decompress(b), compressed)
+        cached = timed(alg.data_decompress, compressed)
+        print(f"{alg.name:<8} {'decompress':<10} {size/fresh:12.1f} {size/cached:12.1f} {fresh/cached:6.2f}x")
+
+
+if __name__ == '__main__':
+    main()
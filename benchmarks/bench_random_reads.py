@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Small random reads through FileObject.read_range, as served by the FUSE mount,
+with plain file reads and with the memory-mapped reader.
+
+Usage (with the package installed, e.g. pip install -e .):
+    python benchmarks/bench_random_reads.py [--size MIB] [--reads N] [--length BYTES] [-a ALG]
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from mkzftree2.compressor import compress_file
+from mkzftree2.models.FileObject import FileObject
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=64, help="Uncompressed size in MiB")
+    parser.add_argument('--reads', type=int, default=5000)
+    parser.add_argument('--length', type=int, default=4096)
+    parser.add_argument('-a', default='zstd')
+    opt = parser.parse_args()
+
+    rnd = random.Random(0)
+    size = opt.size * 2**20
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        in_file = Path(tmpdir) / 'data.csv'
+        with open(in_file, 'w') as fout:
+            while fout.tell() < size:
+                fout.write(f"{rnd.randrange(10**9)},{rnd.random():.6f},item{rnd.randrange(1000)}\n")
+        out_file = Path(tmpdir) / 'data.zf'
+        compress_file(in_file, out_file, algorithm=opt.a, zlevel=3, copy_attributes=False)
+
+        offsets = [rnd.randrange(0, size - opt.length) for _ in range(opt.reads)]
+
+        for use_mmap in [False, True]:
+            with open(out_file, 'rb') as src, FileObject(out_file, use_mmap=use_mmap) as fobj:
+                latencies = []
+                start = time.perf_counter()
+                for offset in offsets:
+                    t0 = time.perf_counter()
+                    fobj.read_range(offset, opt.length, file_descriptor=src)
+                    latencies.append(time.perf_counter() - t0)
+                elapsed = time.perf_counter() - start
+
+            print(f"{'mmap' if use_mmap else 'file':<5} {opt.reads / elapsed:10.0f} reads/s  "
+                  f"p50 {percentile(latencies, 50) * 1e6:7.1f} us  "
+                  f"p99 {percentile(latencies, 99) * 1e6:7.1f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Listing a huge directory through the zisofuse readdir handler, replying in
+kernel-sized chunks as a real `ls` would see them. Needs pyfuse3.
+
+Usage (with the package installed, e.g. pip install -e .):
+    python benchmarks/bench_readdir.py [--entries N] [--reply N] [--compressed N]
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import pyfuse3
+import trio
+
+from mkzftree2 import zisofuse
+from mkzftree2.compressor import compress_file
+
+
+class Collector:
+    """Stand-in for readdir_reply, accepting a bounded number of entries per call"""
+
+    def __init__(self, per_call):
+        self.per_call = per_call
+        self.names = []
+        self.left = 0
+        self.offset = 0
+
+    def __call__(self, token, name, attr, off):
+        if self.left == 0:
+            return False
+        self.left -= 1
+        self.names.append(name)
+        self.offset = off
+        return True
+
+
+async def list_dir(ops, collector):
+    start = time.perf_counter()
+    fh = await ops.opendir(pyfuse3.ROOT_INODE, None)
+    first = None
+    calls = 0
+    while True:
+        collector.left = collector.per_call
+        before = len(collector.names)
+        await ops.readdir(fh, collector.offset, None)
+        calls += 1
+        if first is None:
+            first = time.perf_counter() - start
+        if len(collector.names) == before:
+            break
+    await ops.releasedir(fh)
+    return first, time.perf_counter() - start, calls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=500000)
+    parser.add_argument('--reply', type=int, default=128, help="Entries accepted per readdir call")
+    parser.add_argument('--compressed', type=int, default=1000,
+                        help="How many of the entries are zisofs files")
+    opt = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sample = Path(tmpdir) / 'sample'
+        sample.write_bytes(b'zisofs readdir benchmark\n' * 4096)
+        tree = Path(tmpdir) / 'tree'
+        tree.mkdir()
+        compress_file(sample, tree / 'file0', copy_attributes=False)
+        # Copies, not hardlinks: each entry has its own inode, so its header is parsed
+        # and its metadata cached on its own
+        for i in range(1, opt.compressed):
+            shutil.copyfile(tree / 'file0', tree / f'file{i}')
+        for i in range(opt.compressed, opt.entries):
+            (tree / f'file{i}').touch()
+
+        collector = Collector(opt.reply)
+        zisofuse.pyfuse3.readdir_reply = collector
+        ops = zisofuse.Operations(str(tree))
+        first, total, calls = trio.run(list_dir, ops, collector)
+
+    assert len(collector.names) == opt.entries, len(collector.names)
+    print(f"{opt.entries} entries in {calls} readdir calls: "
+          f"first reply {first * 1e3:.1f} ms, total {total:.2f} s "
+          f"({opt.entries / total:.0f} entries/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Compress and decompress a mostly empty sparse file (100 GiB by default), as a
+thin-provisioned disk image would be. Holes are neither read by compress_file
+nor written by uncompress_file.
+
+Usage (with the package installed, e.g. pip install -e .):
+    python benchmarks/bench_sparse.py [--size GIB] [--data MIB] [--dir DIR]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from mkzftree2.compressor import compress_file, uncompress_file
+
+
+def allocated(path):
+    return os.stat(path).st_blocks * 512
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100, help="Apparent size in GiB")
+    parser.add_argument('--data', type=int, default=64, help="Data written in MiB, spread in 1 MiB extents")
+    parser.add_argument('--dir', default=None, help="Working directory (must support sparse files)")
+    opt = parser.parse_args()
+
+    size = opt.size * 2**30
+    random.seed(0)
+    extent = b'a,b,c,d,e,f,g,h\n' * 2**16  # 1 MiB
+
+    with tempfile.TemporaryDirectory(dir=opt.dir) as tmpdir:
+        in_file = Path(tmpdir) / 'disk.img'
+        with open(in_file, 'wb') as fout:
+            fout.truncate(size)
+            for offset in sorted(random.sample(range(0, size // len(extent)), opt.data)):
+                fout.seek(offset * len(extent))
+                fout.write(extent)
+
+        print(f"input     : {size / 2**30:.1f} GiB apparent, {allocated(in_file) / 2**20:.1f} MiB allocated")
+
+        start = time.perf_counter()
+        compress_file(in_file, Path(tmpdir) / 'disk.zf', copy_attributes=False)
+        elapsed = time.perf_counter() - start
+        print(f"compress  : {elapsed:.2f} s, {os.stat(Path(tmpdir) / 'disk.zf').st_size / 2**20:.1f} MiB output")
+
+        start = time.perf_counter()
+        uncompress_file(Path(tmpdir) / 'disk.zf', Path(tmpdir) / 'disk.out')
+        elapsed = time.perf_counter() - start
+        print(f"decompress: {elapsed:.2f} s, {allocated(Path(tmpdir) / 'disk.out') / 2**20:.1f} MiB allocated")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Compare two result files of benchmarks/suite.py (e.g. before and after a commit).
+Prints the change of every metric and exits with 1 if any of them got worse than
+the threshold: lower MB/s, higher ratio or higher read latency.
+
+Usage:
+    python benchmarks/compare.py BASE.json NEW.json [--threshold PCT] [--all]
+"""
+import argparse
+import json
+import sys
+
+# Metric -> True if higher is better
+METRICS = {
+    'compress_mbs': True,
+    'decompress_mbs': True,
+    'ratio': False,
+    'read_p50_us': False,
+    'read_p99_us': False,
+}
+
+KEY = ('corpus', 'algorithm', 'level', 'blocksize')
+
+
+def load(path):
+    with open(path) as fin:
+        data = json.load(fin)
+    return data['meta'], {tuple(r[k] for k in KEY): r for r in data['results']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help="Regression threshold in percent")
+    parser.add_argument('--all', action='store_true', help="Show every case, not only the regressions")
+    opt = parser.parse_args()
+
+    base_meta, base = load(opt.base)
+    new_meta, new = load(opt.new)
+    print(f"base: {base_meta.get('commit')} ({base_meta.get('date')})  "
+          f"new: {new_meta.get('commit')} ({new_meta.get('date')})")
+
+    regressions = 0
+    for key in sorted(set(base) & set(new)):
+        changes = []
+        worse = False
+        for metric, higher_is_better in METRICS.items():
+            before, after = base[key][metric], new[key][metric]
+            if not before:
+                continue
+            change = (after - before) / before * 100
+            if (-change if higher_is_better else change) > opt.threshold:
+                worse = True
+            changes.append(f"{metric} {before:.3g} -> {after:.3g} ({change:+.1f}%)")
+
+        regressions += worse
+        if worse or opt.all:
+            print(f"{'REGRESSION' if worse else 'ok':<10} {' '.join(str(k) for k in key)}: {', '.join(changes)}")
+
+    missing = set(base) ^ set(new)
+    if missing:
+        print(f"{len(missing)} cases only in one of the files")
+
+    print(f"{regressions} regressions above {opt.threshold}%")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark of every algorithm, block size and a few representative levels
+on a synthetic corpus (text, random data, a sparse file and mixed binary records).
+For each combination it reports compression and decompression MB/s, the ratio, and
+the latency percentiles of random single block reads. Results can be saved as JSON
+and compared between commits with benchmarks/compare.py.
+
+Usage (with the package installed, e.g. pip install -e .):
+    python benchmarks/suite.py [--size MIB] [--quick] [--output FILE.json]
+                               [--corpus NAME ...] [-a ALG ...] [-b LOG2 ...]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import struct
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+from mkzftree2.arguments import default_block_sizes
+from mkzftree2.compressor import compress_file
+from mkzftree2.models.FileObject import FileObject
+from mkzftree2.models.algorithm import Algorithm
+
+# Levels measured for each algorithm. --quick only keeps the first one
+LEVELS = {
+    'zlib': [6, 1, 9],
+    'xz': [6, 1],
+    'lz4': [1, 9],
+    'zstd': [3, 1, 19],
+    'bzip2': [9, 1],
+    'zstd_dict': [3],
+}
+
+CORPUS = ['text', 'random', 'sparse', 'mixed']
+
+
+def write_corpus(name, path, size, rnd):
+    """
+    Write size bytes of the given kind of synthetic data
+    """
+    with open(path, 'wb') as fout:
+        if name == 'text':
+            words = [''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rnd.randint(2, 10)))
+                     for _ in range(2000)]
+            while fout.tell() < size:
+                line = ' '.join(rnd.choice(words) for _ in range(rnd.randint(4, 16)))
+                fout.write(f"{rnd.randrange(10**9)} INFO {line}\n".encode())
+        elif name == 'random':
+            fout.write(rnd.getrandbits(8 * size).to_bytes(size, 'little'))
+        elif name == 'sparse':
+            # 1/8 of data in 256 KiB extents, the rest is holes
+            extent = 2**18
+            fout.truncate(size)
+            for offset in sorted(rnd.sample(range(size // extent), max(1, size // extent // 8))):
+                fout.seek(offset * extent)
+                fout.write(b'a,b,c,d,e,f,g,h\n' * (extent // 16))
+        elif name == 'mixed':
+            # Fixed size records: counters, floats, short strings, padding and some noise
+            record = struct.Struct('<IId16s8x')
+            names = [f"name{i}".encode() for i in range(64)]
+            while fout.tell() < size:
+                for _ in range(1024):
+                    fout.write(record.pack(rnd.randrange(2**16), rnd.randrange(2**32), rnd.random(),
+                                           rnd.choice(names)))
+                fout.write(rnd.getrandbits(8 * 4096).to_bytes(4096, 'little'))
+        else:
+            raise ValueError(name)
+        fout.truncate(size)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_case(in_file, out_file, alg, level, blocksize, opt, rnd):
+    size = os.stat(in_file).st_size
+
+    # force: measure the codec even where the file would be stored uncompressed
+    compress = best_time(lambda: compress_file(in_file, out_file, blocksize=blocksize, algorithm=alg,
+                                               zlevel=level, force=True, copy_attributes=False), opt.repeat)
+    csize = os.stat(out_file).st_size
+
+    with FileObject(out_file) as fobj:
+        def decompress():
+            for _ in fobj.get_chunks():
+                pass
+        decompress_time = best_time(decompress, opt.repeat)
+
+        nblocks = -(-size // blocksize)
+        latencies = []
+        with open(out_file, 'rb') as src:
+            for _ in range(opt.reads):
+                num = rnd.randrange(nblocks)
+                start = time.perf_counter()
+                fobj.read_block(num, file_descriptor=src)
+                latencies.append(time.perf_counter() - start)
+
+    return {
+        'size': size,
+        'csize': csize,
+        'ratio': csize / size,
+        'compress_mbs': size / compress / 1e6,
+        'decompress_mbs': size / decompress_time / 1e6,
+        'read_p50_us': percentile(latencies, 50) * 1e6,
+        'read_p90_us': percentile(latencies, 90) * 1e6,
+        'read_p99_us': percentile(latencies, 99) * 1e6,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=Path(__file__).parent,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=16, help="Size of each corpus file in MiB")
+    parser.add_argument('--corpus', nargs='+', choices=CORPUS, default=CORPUS)
+    parser.add_argument('-a', nargs='+', choices=Algorithm.list_all(), default=Algorithm.list_all())
+    parser.add_argument('-b', nargs='+', type=int, choices=default_block_sizes, default=default_block_sizes)
+    parser.add_argument('--quick', action='store_true', help="Only the default level of each algorithm")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of each measure, the best one is kept")
+    parser.add_argument('--reads', type=int, default=1000, help="Random block reads for the latency")
+    parser.add_argument('--output', default=None, help="Save the results as JSON")
+    opt = parser.parse_args()
+
+    results = []
+
+    print(f"{'corpus':<7} {'alg':<9} {'lvl':>3} {'bs':>3} {'ratio':>6} {'comp MB/s':>10} {'dec MB/s':>9} "
+          f"{'p50 us':>8} {'p99 us':>8}")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for corpus in opt.corpus:
+            in_file = Path(tmpdir) / corpus
+            # Same data whatever corpora are selected
+            write_corpus(corpus, in_file, opt.size * 2**20, random.Random(corpus))
+            out_file = Path(tmpdir) / f"{corpus}.zf"
+
+            for alg in opt.a:
+                levels = LEVELS[alg][:1] if opt.quick else LEVELS[alg]
+                for level in levels:
+                    for log2 in opt.b:
+                        result = run_case(in_file, out_file, alg, level, 2**log2, opt, random.Random(0))
+                        result.update(corpus=corpus, algorithm=alg, level=level, blocksize=log2)
+                        results.append(result)
+                        print(f"{corpus:<7} {alg:<9} {level:>3} {log2:>3} {result['ratio']:>6.3f} "
+                              f"{result['compress_mbs']:>10.1f} {result['decompress_mbs']:>9.1f} "
+                              f"{result['read_p50_us']:>8.1f} {result['read_p99_us']:>8.1f}")
+
+    if opt.output:
+        meta = {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'size_mib': opt.size,
+            'repeat': opt.repeat,
+        }
+        with open(opt.output, 'w') as fout:
+            json.dump({'meta': meta, 'results': results}, fout, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1 @@
-from mkzftree2.compressor import compress_file
+from mkzftree2.compressor import compress_file, compress_stream
@@ -1,5 +1,11 @@
+from contextlib import ExitStack, redirect_stdout
+import sys
+from mkzftree2.compressor import compress_stream
 from mkzftree2.arguments import get_options
-from mkzftree2.file_process import process_files, find_files, uncompress_files
+from mkzftree2.index import read_index
+from mkzftree2.fsck import load_digests
+from mkzftree2.stats import RunStats
+from mkzftree2.file_process import process_files, find_files, uncompress_files, verify_files
 
 
 def main(args=None):
@@ -9,6 +15,29 @@ def main(args=None):
     target = opt.out_dir[0]
     blocksize = 2 ** opt.blocksize
 
+    if source == '-':
+        # Compress stdin into a single file
+        if target == '-':
+            compress_stream(sys.stdin.buffer, sys.stdout.buffer, blocksize, opt.a, opt.z, opt.legacy, opt.jobs,
+                            auto_policy=opt.auto_policy)
+            sys.stdout.buffer.flush()
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with open(target, 'wb') as dst:
+                compress_stream(sys.stdin.buffer, dst, blocksize, opt.a, opt.z, opt.legacy, opt.jobs,
+                                auto_policy=opt.auto_policy)
+        return
+
+    if opt.verify:
+        # Check the tree out_dir
+        digests = None
+        if opt.index is not None or opt.manifest is not None:
+            digests = load_digests(opt.index, opt.manifest)
+        problems = verify_files(target, source if opt.verify_source else None, digests,
+                                workers=opt.jobs, file_jobs=opt.file_jobs, pool=opt.pool,
+                                verbose=opt.verbose, quiet=opt.quiet)
+        sys.exit(1 if problems else 0)
+
     # Create targer directory
     try:
         target.mkdir(parents=True)
@@ -19,21 +48,42 @@ def main(args=None):
         if opt.fuse:
             from mkzftree2.zisofuse import mount_fuse
             print(f"Mounting {source} into {target}")
-            mount_fuse(source, target)
+            mount_fuse(source, target, use_mmap=opt.mmap, cache_size=opt.cache_size * 2**20,
+                       readahead=opt.readahead, threads=opt.threads,
+                       attr_timeout=opt.attr_timeout, entry_timeout=opt.entry_timeout,
+                       index_file=opt.index)
         else:
             # Uncompress in_dir
-            uncompress_files(source, target)
+            index = read_index(opt.index) if opt.index is not None else None
+            uncompress_files(source, target, index, verbose=opt.verbose, quiet=opt.quiet,
+                             file_jobs=opt.file_jobs, pool=opt.pool)
     else:
         # Compress in_dir
 
         # Recursive search of all files
         list_files = find_files(source, opt.file, opt.follow_symlinks)
 
-        process_files(list_files, source, target, opt.overwrite, opt.a,
-                    opt.z, blocksize, opt.force, opt.legacy, opt.ignore_attributes)
+        hooks = RunStats() if opt.stats is not None else None
+        try:
+            with ExitStack() as stack:
+                if opt.stats == '-':
+                    # The report must be alone on stdout to be parsed: everything else goes to stderr
+                    stack.enter_context(redirect_stdout(sys.stderr))
+                process_files(list_files, source, target, opt.overwrite, opt.a,
+                            opt.z, blocksize, opt.force, opt.legacy, opt.ignore_attributes,
+                            workers=opt.jobs, file_jobs=opt.file_jobs, pool=opt.pool,
+                            dict_scope=opt.dict_scope, index_file=opt.index,
+                            manifest_file=opt.manifest, dedup=opt.dedup,
+                            auto_policy=opt.auto_policy, hooks=hooks,
+                            verbose=opt.verbose, quiet=opt.quiet)
+        finally:
+            if hooks is not None and hooks.wall is not None:
+                # Also when some files failed
+                hooks.write(opt.stats)
 
     # Process
-    print("\nDone. Have a nice day :)")
+    if not opt.quiet:
+        print("\nDone. Have a nice day :)", file=sys.stderr if opt.stats == '-' else sys.stdout)
 
 
 if __name__ == '__main__':
@@ -1,9 +1,14 @@
 import argparse
+import os
 from pathlib import Path
 from mkzftree2.models.algorithm import Algorithm
 
 
 def input_dir(in_dir):
+    if in_dir == '-':
+        # Compress stdin
+        return in_dir
+
     d = Path(in_dir)
     if d.is_dir() and d.exists():
         if any(d.iterdir()):
@@ -13,6 +18,10 @@ def input_dir(in_dir):
 
 
 def output_dir(in_dir):
+    if in_dir == '-':
+        # Write to stdout
+        return in_dir
+
     dirin = Path(in_dir)
     return dirin
 
@@ -32,22 +41,42 @@ def _create_parser():
     parser = argparse.ArgumentParser('mkzftree2')
 
     parser.add_argument('in_dir',
-                        type=input_dir, action='store', nargs=1, help="Input directory")
+                        type=input_dir, action='store', nargs=1,
+                        help="Input directory, or - to compress stdin into the out_dir file")
     parser.add_argument('out_dir',
-                        type=output_dir, action='store', nargs=1, help="Output directory")
+                        type=output_dir, action='store', nargs='?',
+                        help="Output directory, or file (- for stdout) when in_dir is -. "
+                             "With --verify alone, in_dir is the tree to check and out_dir is not given")
     parser.add_argument('file',
                         type=input_files, action='store', nargs='*',
                         help="Optional input file. If specified, the rest of the files inside in_dir will be omited")
 
+    parser.add_argument('--index',
+                        type=Path, default=None, metavar="PATH",
+                        help="Tree index of out_dir: written there when compressing, read by -u and --fuse")
+
+    parser.add_argument('-q', '--quiet',
+                        default=False, action='store_true',
+                        help="Don't show the progress nor the totals")
+    parser.add_argument('--verbose',
+                        default=False, action='store_true',
+                        help="List every processed file")
+
     group_compression = parser.add_argument_group('compression', 'Arguments related to compression')
     group_decompression = parser.add_argument_group('decompression', 'Arguments related to decompression')
 
     group_compression.add_argument('-a',
-                        choices=Algorithm.list_all(), default='zlib', type=str,
-                        help="Compression algorithm")
+                        choices=Algorithm.list_all() + ['auto'], default='zlib', type=str,
+                        help="Compression algorithm. auto chooses the algorithm and level of each file")
+    group_compression.add_argument('--auto-policy',
+                        choices=['ratio', 'balanced', 'speed'], default='balanced',
+                        help="-a auto: favour the smallest output, fast decompression, or both (Default: balanced)")
     group_compression.add_argument('-b', '--blocksize',
                         choices=default_block_sizes, type=int, default=15,
                         help="Blocksize can be 15 (32kb), 16 (64kb) or 17 (128kb)")
+    group_compression.add_argument('--dedup',
+                        default=False, action='store_true',
+                        help="Compress files with the same content once, and reflink or hardlink the other outputs")
     group_compression.add_argument('--follow-symlinks',
                         default=False, action='store_true',
                         help="Process symlinks outside in_dir as regular files")
@@ -57,6 +86,26 @@ def _create_parser():
     group_compression.add_argument('--ignore-attributes',
                         default=False, action='store_true',
                         help="Don't copy source file attributes")
+    group_compression.add_argument('-j', '--jobs',
+                        type=int, default=None, metavar="N",
+                        help="Compress or check blocks of a file with N threads (Default: 1, --verify: number of CPUs)")
+    group_compression.add_argument('--dict-scope',
+                        choices=['file', 'tree'], default='file',
+                        help="zstd_dict: train one dictionary per file or one for the whole tree (Default: file)")
+    group_compression.add_argument('--file-jobs',
+                        type=int, default=None, metavar="N",
+                        help="Compress, uncompress or check N files concurrently (Default: 1, --verify: number of CPUs)")
+    group_compression.add_argument('--pool',
+                        choices=['thread', 'process'], default='thread',
+                        help="Worker pool used by --file-jobs (Default: thread)")
+    group_compression.add_argument('--manifest',
+                        type=Path, default=None, metavar="PATH",
+                        help="Incremental build: only compress files changed since the run that wrote PATH, "
+                             "and remove the outputs of deleted files")
+    group_compression.add_argument('--stats',
+                        default=None, metavar="PATH",
+                        help="Write statistics of the run (time per stage, bytes per algorithm...) "
+                             "as JSON to PATH, - for stdout")
     group_compression.add_argument('--legacy', default=False,
                         action='store_true', help="Generate old ZISOFSv1 tree")
     group_compression.add_argument('-o', '--overwrite', default=False,
@@ -67,7 +116,7 @@ def _create_parser():
                         Compression levels:
                         zlib/xz/bzip2: 1-9,
                         lz4: 1-16,
-                        zstd: 1-22
+                        zstd/zstd_dict: 1-22
                         """
                         )
     
@@ -76,6 +125,25 @@ def _create_parser():
 
     group_decompression.add_argument('--fuse', default=False,
                         action='store_true', help="Mount out_dir with libfuse instead of decompressing")
+    group_decompression.add_argument('--mmap', default=False,
+                        action='store_true', help="--fuse: read compressed files through shared memory mappings")
+    group_decompression.add_argument('--cache-size', type=int, default=64, metavar="MiB",
+                        help="--fuse: memory used to cache decompressed blocks, 0 to disable (Default: 64)")
+    group_decompression.add_argument('--readahead', type=int, default=32, metavar="BLOCKS",
+                        help="--fuse: maximum number of blocks prefetched on sequential reads, 0 to disable (Default: 32)")
+    group_decompression.add_argument('--threads', type=int, default=None, metavar="N",
+                        help="--fuse: threads reading and decompressing blocks. With readahead, half of them "
+                             "prefetch blocks, and readahead needs at least 2 (Default: number of CPUs)")
+    group_decompression.add_argument('--attr-timeout', type=float, default=1, metavar="SECONDS",
+                        help="--fuse: time the kernel caches file attributes (Default: 1)")
+    group_decompression.add_argument('--entry-timeout', type=float, default=1, metavar="SECONDS",
+                        help="--fuse: time the kernel caches name lookups (Default: 1)")
+    group_verification = parser.add_argument_group('verification', 'Arguments related to the check of a tree')
+    group_verification.add_argument('--verify', default=False, action='store_true',
+                        help="Check the compressed tree out_dir instead of writing it: headers, pointers tables and "
+                             "every block. Contents are compared with the hashes of --index or --manifest, if given")
+    group_verification.add_argument('--verify-source', default=False, action='store_true',
+                        help="--verify, also comparing contents with the files of in_dir. out_dir is required")
     parser.add_argument('-v', '--version', action='version', version="0.2")
 
     return parser
@@ -88,7 +156,27 @@ def get_options(args):
 
     opt = _create_parser().parse_args(args)
 
-    if opt.legacy and not opt.a == 'zlib':
+    if opt.out_dir is None:
+        if not opt.verify or opt.verify_source:
+            raise ValueError("out_dir is required, except to --verify the tree in_dir")
+        # The tree to check. There is no source to compare it with
+        opt.out_dir = opt.in_dir
+    else:
+        opt.out_dir = [opt.out_dir]
+
+    if opt.in_dir[0] == '-' and (opt.uncompress or opt.file):
+        raise ValueError("stdin can only be compressed into a single file")
+
+    if opt.in_dir[0] == '-' and (opt.index is not None or opt.manifest is not None):
+        raise ValueError("A tree index or manifest can't be written for stdin")
+
+    if opt.uncompress and (opt.manifest is not None or opt.stats is not None):
+        raise ValueError("A manifest and statistics are only used when compressing")
+
+    if opt.out_dir[0] == '-' and opt.in_dir[0] != '-':
+        raise ValueError("Only stdin can be compressed into stdout")
+
+    if opt.legacy and opt.a not in ['zlib', 'auto']:
         raise ValueError("Legacy mode only support zlib compressor")
 
     if (opt.a == 'zlib' or opt.a == 'xz' or opt.a == 'bzip2') and opt.z > 9:
@@ -97,7 +185,35 @@ def get_options(args):
     if opt.a == 'lz4' and opt.z > 16:
         raise ValueError(f"{opt.a} support up to 16 levels")
 
-    if opt.a == 'zstd' and opt.z > 22:
+    if (opt.a == 'zstd' or opt.a == 'zstd_dict') and opt.z > 22:
         raise ValueError(f"{opt.a} support up to 22 levels")
 
+    if opt.cache_size < 0 or opt.readahead < 0 or opt.attr_timeout < 0 or opt.entry_timeout < 0:
+        raise ValueError("Cache size, readahead and timeouts can't be negative")
+
+    if opt.threads is not None and opt.threads < 1:
+        raise ValueError("Number of threads must be at least 1")
+
+    if opt.verify_source:
+        opt.verify = True
+
+    if opt.verify and (opt.uncompress or opt.in_dir[0] == '-' or opt.file):
+        raise ValueError("--verify checks a whole compressed tree, built from a source directory")
+
+    if opt.verify and not opt.out_dir[0].is_dir():
+        raise NotADirectoryError(opt.out_dir[0])
+
+    if opt.quiet and opt.verbose:
+        raise ValueError("--quiet and --verbose can't be used together")
+
+    # Checking a tree only reads it, so it uses every CPU by default
+    default_jobs = (os.cpu_count() or 1) if opt.verify else 1
+    if opt.jobs is None:
+        opt.jobs = default_jobs
+    if opt.file_jobs is None:
+        opt.file_jobs = default_jobs
+
+    if opt.jobs < 1 or opt.file_jobs < 1:
+        raise ValueError("Number of jobs must be at least 1")
+
     return opt
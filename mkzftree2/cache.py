@@ -0,0 +1,168 @@
+from collections import OrderedDict, defaultdict
+import threading
+
+
+class BlockCache:
+    """
+    LRU cache of decompressed blocks, bounded by the total size of the blocks.
+    Blocks are keyed by (inode, block number) and shared by all the readers of
+    a file. It is thread safe
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._blocks = OrderedDict()  # (inode, num) -> data
+        self._inode_blocks = defaultdict(set)  # inode -> {num}
+        self._versions = dict()  # inode -> version of the cached blocks
+        self._lock = threading.Lock()
+
+    def get(self, inode, num):
+        """
+        Return the cached block, or None
+        """
+        with self._lock:
+            data = self._blocks.get((inode, num))
+            if data is None:
+                self.misses += 1
+                return None
+
+            self._blocks.move_to_end((inode, num))
+            self.hits += 1
+            return data
+
+    def put(self, inode, num, data):
+        """
+        Store a block, evicting the least recently used ones if needed.
+        Blocks bigger than the whole cache are not stored
+        """
+        if len(data) > self.max_bytes:
+            return
+
+        data = bytes(data)
+        with self._lock:
+            old = self._blocks.pop((inode, num), None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._blocks[(inode, num)] = data
+            self._inode_blocks[inode].add(num)
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                (old_inode, old_num), old = self._blocks.popitem(last=False)
+                self._discard(old_inode, old_num)
+                self.size -= len(old)
+
+    def validate(self, inode, version):
+        """
+        Drop the blocks of inode if they were cached from another version of
+        the backing file (e.g. a different (st_mtime_ns, st_size))
+        """
+        with self._lock:
+            if self._versions.get(inode, version) != version:
+                self._invalidate(inode)
+            self._versions[inode] = version
+
+    def invalidate(self, inode):
+        """
+        Drop all the blocks of inode
+        """
+        with self._lock:
+            self._invalidate(inode)
+            self._versions.pop(inode, None)
+
+    def _invalidate(self, inode):
+        for num in self._inode_blocks.pop(inode, ()):
+            self.size -= len(self._blocks.pop((inode, num)))
+
+    def _discard(self, inode, num):
+        nums = self._inode_blocks[inode]
+        nums.discard(num)
+        if not nums:
+            del self._inode_blocks[inode]
+
+    def __len__(self):
+        return len(self._blocks)
+
+
+class Readahead:
+    """
+    Access pattern of a file handle. Once reads look sequential, it tells which
+    blocks should be prefetched, doubling the window on each sequential read
+    """
+
+    def __init__(self, max_window=32, min_window=2):
+        self.max_window = max_window
+        self.min_window = min_window
+        self.window = 0
+        self.last_block = None
+        self.prefetched_until = 0  # First block not prefetched yet
+
+    def access(self, first, last):
+        """
+        Register a read of blocks first to last (included) and return the range
+        of blocks to prefetch
+        """
+        sequential = self.last_block is not None and self.last_block <= first <= self.last_block + 1
+        self.last_block = last
+
+        if not sequential or not self.max_window:
+            # Random access. Start again
+            self.window = 0
+            self.prefetched_until = last + 1
+            return range(0)
+
+        self.window = min(self.max_window, max(self.min_window, self.window * 2))
+
+        start = max(last + 1, self.prefetched_until)
+        end = last + 1 + self.window
+        self.prefetched_until = max(self.prefetched_until, end)
+        return range(start, end)
+
+
+class MetadataCache:
+    """
+    LRU cache of the uncompressed size of files (None if not compressed), keyed by
+    (st_dev, st_ino, st_mtime_ns, st_size): a modified file gets a new key, so
+    entries never need to be invalidated. It is thread safe
+    """
+
+    def __init__(self, max_entries=2**16):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._sizes = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(st):
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get_size(self, st, loader):
+        """
+        Return the cached size for the stat result st, or call loader() to get it
+        """
+        key = self.key(st)
+        with self._lock:
+            if key in self._sizes:
+                self._sizes.move_to_end(key)
+                self.hits += 1
+                return self._sizes[key]
+            self.misses += 1
+
+        size = loader()
+
+        with self._lock:
+            self._sizes[key] = size
+            while len(self._sizes) > self.max_entries:
+                self._sizes.popitem(last=False)
+
+        return size
+
+    def __len__(self):
+        return len(self._sizes)
@@ -0,0 +1,166 @@
+from collections import Counter
+import math
+
+from mkzftree2.models.algorithm import Algorithm
+
+# Files whose estimated ratio is above this limit are not worth compressing
+RATIO_LIMIT = 0.98
+
+# Random data is close to 8 bits of entropy per byte
+ENTROPY_LIMIT = 7.95
+
+# Signatures (offset, magic) of formats that are already compressed
+COMPRESSED_MAGICS = {
+    'jpeg': (0, b'\xFF\xD8\xFF'),
+    'png': (0, b'\x89PNG\r\n\x1a\n'),
+    'gif': (0, b'GIF8'),
+    'webp': (8, b'WEBP'),
+    'mp4': (4, b'ftyp'),
+    'mkv': (0, b'\x1A\x45\xDF\xA3'),
+    'ogg': (0, b'OggS'),
+    'flac': (0, b'fLaC'),
+    'mp3': (0, b'ID3'),
+    'zip': (0, b'PK\x03\x04'),
+    'gzip': (0, b'\x1F\x8B'),
+    'bzip2': (0, b'BZh'),
+    'xz': (0, b'\xFD7zXZ\x00'),
+    'zstd': (0, b'\x28\xB5\x2F\xFD'),
+    'lz4': (0, b'\x04\x22\x4D\x18'),
+    '7z': (0, b'7z\xBC\xAF\x27\x1C'),
+    'rar': (0, b'Rar!\x1A\x07'),
+    'zisofs2': (0, b'\xEF\x22\x55\xA1\xBC\x1B\x95\xA0'),
+    'zisofs': (0, b'\x37\xE4\x53\x96\xC9\xDB\xD6\x07'),
+}
+
+
+def sniff_magic(head):
+    """
+    Return the name of the compressed format of the data starting with head, or None
+    """
+    for name, (offset, magic) in COMPRESSED_MAGICS.items():
+        if head[offset:offset+len(magic)] == magic:
+            return name
+    return None
+
+
+def entropy(data):
+    """
+    Shannon entropy of data, in bits per byte
+    """
+    if not data:
+        return 0.0
+
+    total = len(data)
+    return -sum(c / total * math.log2(c / total) for c in Counter(data).values())
+
+
+def sample_ratios(samples, algorithm, zlevel):
+    """
+    Estimate the compression ratio of each sample block of a file.
+    Zero blocks cost nothing. Already compressed formats and high entropy samples
+    are considered incompressible without trying to compress them
+    """
+    if samples and sniff_magic(samples[0][:16]):
+        return [1] * len(samples)
+
+    if algorithm.uses_dictionary():
+        # A dictionary trained on a few samples would flatter the result
+        algorithm = Algorithm.ZSTD
+
+    ratios = []
+    for sample in samples:
+        if not sample or sample == bytes(len(sample)):
+            ratios.append(0)
+        elif entropy(sample) > ENTROPY_LIMIT:
+            ratios.append(1)
+        else:
+            ratios.append(min(1, len(algorithm.data_compress(sample, zlevel)) / len(sample)))
+
+    return ratios
+
+
+def estimate_ratio(samples, algorithm, zlevel):
+    """
+    Estimate the compression ratio of a file from a list of its sample blocks
+    """
+    total = sum(len(s) for s in samples)
+    if not total:
+        return 1
+
+    ratios = sample_ratios(samples, algorithm, zlevel)
+    return sum(r * len(s) for r, s in zip(ratios, samples)) / total
+
+
+# (algorithm, level) pairs tried by the automatic selection, from the fastest to decompress
+AUTO_CANDIDATES = [
+    (Algorithm.LZ4, 1),
+    (Algorithm.ZSTD, 3),
+    (Algorithm.ZSTD, 19),
+    (Algorithm.ZLIB, 9),
+    (Algorithm.BZIP2, 9),
+    (Algorithm.XZ, 6),
+]
+
+# Used for files with too little sample data to tell the candidates apart
+AUTO_DEFAULT = (Algorithm.ZSTD, 3)
+
+# Below this many bytes of compressible samples, a file gets AUTO_DEFAULT without any trial
+AUTO_MIN_SAMPLE = 2**16
+
+# Typical decompression speed (bytes/s of output) of each algorithm on a single core.
+# A fixed table rather than a timing of the samples: the choice must not depend on the
+# load of the machine, so that identical files always get the same algorithm
+DECOMPRESS_SPEEDS = {
+    Algorithm.LZ4: 4000 * 2**20,
+    Algorithm.ZSTD: 1500 * 2**20,
+    Algorithm.ZSTD_DICT: 1500 * 2**20,
+    Algorithm.ZLIB: 400 * 2**20,
+    Algorithm.XZ: 100 * 2**20,
+    Algorithm.BZIP2: 50 * 2**20,
+}
+
+# Read bandwidth (bytes/s) of the medium each policy optimises for. Reading a byte of a file
+# costs ratio / bandwidth + 1 / decompression speed: the slower the medium, the more the
+# ratio matters, and on a fast one the decompression speed wins
+AUTO_POLICIES = {
+    'ratio': 2**16,
+    'balanced': 100 * 2**20,
+    'speed': 2**30,
+}
+
+
+def select_algorithm(samples, policy='balanced', legacy=False, candidates=AUTO_CANDIDATES):
+    """
+    Choose the (algorithm, level) of a file by compressing its sample blocks with the
+    candidates, weighing their ratio against their decompression speed (DECOMPRESS_SPEEDS).
+    Legacy files can only use zlib.
+    Zero blocks and incompressible samples don't tell the candidates apart, so they are ignored
+    """
+    if legacy:
+        candidates = [c for c in candidates if c[0] == Algorithm.ZLIB] or [(Algorithm.ZLIB, 9)]
+
+    bandwidth = AUTO_POLICIES[policy]
+
+    if samples and sniff_magic(samples[0][:16]):
+        samples = []
+    samples = [s for s in samples if s and s != bytes(len(s)) and entropy(s) <= ENTROPY_LIMIT]
+    total = sum(len(s) for s in samples)
+    if not total:
+        # Nothing to compress: any candidate is as good. Take the fastest one
+        return candidates[0]
+    if total < AUTO_MIN_SAMPLE:
+        return AUTO_DEFAULT if AUTO_DEFAULT in candidates else candidates[0]
+
+    best = None
+    for algorithm, level in candidates:
+        speed_cost = 1 / DECOMPRESS_SPEEDS[algorithm]
+        if best is not None and speed_cost >= best[0]:
+            # Slower to decompress than the best cost so far, even if it compressed to nothing
+            continue
+
+        ratio = sum(len(algorithm.data_compress(s, level)) for s in samples) / total
+        cost = ratio / bandwidth + speed_cost
+        if best is None or cost < best[0]:
+            best = (cost, (algorithm, level))
+
+    return best[1]
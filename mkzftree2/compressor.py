@@ -1,14 +1,44 @@
 from argparse import ArgumentError
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from pathlib import Path
+import errno
+import os
+import shutil
+import stat
+import tempfile
 
 from mkzftree2.models.FileObject import FileObject
 from mkzftree2.arguments import default_block_sizes
-from mkzftree2.utils import NotCompressedFile, clone_attributes, clone_dir_attributes, IllegalArgumentError
-from mkzftree2.models.algorithm import Algorithm
+from mkzftree2.iso9660 import uint_array
+from mkzftree2.utils import NotCompressedFile, clone_attributes, clone_dir_attributes, IllegalArgumentError, copy_file_data, COPY_BUFSIZE
+from mkzftree2.models.algorithm import Algorithm, train_dictionary, dictionary_id, tree_dictionary_name, \
+    DICT_SIZE, DICT_MIN_FILE_SIZE
+from mkzftree2.classifier import sample_ratios, select_algorithm, RATIO_LIMIT
+from mkzftree2.stats import NO_STATS
 
-def uncompress_file(input_file, output_file, copy_attributes=True):
+# Number of blocks sampled to train a dictionary
+DICT_SAMPLES = 64
+
+# Blocks sampled to estimate the ratio of files with at least CLASSIFY_MIN_BLOCKS blocks
+CLASSIFY_SAMPLES = 8
+CLASSIFY_MIN_BLOCKS = 16
+
+# Algorithm name choosing the algorithm and level of each file
+AUTO = 'auto'
+
+# Compressed data of a stream is kept in memory up to this size, then spilled to a temporary file
+SPOOL_SIZE = 64 * 2**20
+
+# Legacy (zisofs v1) files have 32 bits sizes and pointers
+LEGACY_LIMIT = 2**32
+
+def uncompress_file(input_file, output_file, copy_attributes=True, compressed=None):
     """
-    docstring
+    Uncompress input_file into output_file. Files that are not compressed are copied.
+    compressed=False skips parsing the header of a file already known to be uncompressed
     """
 
     in_file = Path(input_file) if not isinstance(
@@ -17,20 +47,27 @@ def uncompress_file(input_file, output_file, copy_attributes=True):
         output_file, Path) else output_file
 
     try:
+        if compressed is False:
+            raise NotCompressedFile
         fobj = FileObject(in_file)
     except NotCompressedFile:
         # Not compressed. Just copy
         with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
-            dst.write(src.read())  # TODO: Check memory usage for big files
+            copy_file_data(src, dst)
             if copy_attributes:
                 clone_attributes(in_file, out_file)
                 clone_dir_attributes(in_file.parents, out_file.parents)
             return
 
-    with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
-        for data in fobj.get_chunks():
-            dst.write(data)  # TODO: Check memory usage for big files
-
+    with open(out_file, 'wb') as dst:
+        for data in fobj.get_chunks(sparse=True):
+            if data is None:
+                # Zero block. Leave a hole
+                dst.seek(fobj.header.get_blocksize(), os.SEEK_CUR)
+            else:
+                dst.write(data)
+        # Holes at the end are only allocated by the final size
+        dst.truncate(fobj.get_size())
 
 
 def compress_file(input_file, output_file,
@@ -39,7 +76,21 @@ def compress_file(input_file, output_file,
                   zlevel=6,
                   force=False,
                   legacy=False,
-                  copy_attributes=True):
+                  copy_attributes=True,
+                  workers=1,
+                  dictionary=None,
+                  hasher=None,
+                  auto_policy='balanced',
+                  stats=NO_STATS):
+    """
+    Compress input_file into output_file and return the ratio (1 if it's stored uncompressed).
+    If a hashlib object is given as hasher, it's updated with the whole content of input_file.
+    With algorithm='auto', the algorithm and level of the file are chosen from sample blocks
+    (see classifier.select_algorithm), and zlevel is ignored.
+    A given dictionary is a tree dictionary (see save_tree_dictionary): the file only refers
+    to it by id. Otherwise, algorithms with a dictionary train one for the file.
+    The time of every stage is recorded in stats (a StageStats)
+    """
 
     in_file = Path(input_file) if not isinstance(
         input_file, Path) else input_file
@@ -49,67 +100,455 @@ def compress_file(input_file, output_file,
     if blocksize not in [2**x for x in default_block_sizes]:
         raise ValueError(f"Not a valid {blocksize}")
 
-    algorithm = Algorithm.from_arg(algorithm)
+    if algorithm == AUTO:
+        with open(in_file, 'rb') as src, stats.stage('classify'):
+            algorithm, zlevel = select_algorithm(_sample_blocks(src, blocksize, CLASSIFY_SAMPLES),
+                                                 auto_policy, legacy)
+    else:
+        algorithm = Algorithm.from_arg(algorithm)
 
     if legacy and algorithm != Algorithm.ZLIB: raise IllegalArgumentError("Legacy only support zlib")
 
     fobj = FileObject(in_file, alg=algorithm,
                       blocksize=blocksize, isLegacy=legacy)
+    if algorithm.uses_dictionary() and dictionary is not None:
+        fobj.header.set_dictionary_id(dictionary_id(dictionary))
 
     # If target directory doesn't exist, create all of them
-    if not out_file.parent.exists():
-        out_file.parent.mkdir(parents=True)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
 
     with open(in_file, 'rb') as src, open(out_file, 'wb') as dst:
-        pointers_table = []
+        size = fobj.get_size()
+        pointers_table = uint_array(fobj.header.pointers_size)
 
-        # File header
-        ziso_header = fobj.generate_header()
-        dst.write(ziso_header)
+        # Estimate the ratio from a few samples before compressing anything.
+        # Small files are just compressed
+        sampled = None
+        if not force and size >= CLASSIFY_MIN_BLOCKS * blocksize:
+            with stats.stage('classify'):
+                samples = _sample_blocks(src, blocksize, CLASSIFY_SAMPLES)
+                ratios = sample_ratios(samples, algorithm, zlevel)
+            sampled = deque(zip(_sample_positions(size, blocksize, CLASSIFY_SAMPLES), ratios))
 
-        # Pointers table
-        dst.write(fobj.getTablePointers())
+        stored = sampled is not None and sum(ratios) / len(ratios) >= RATIO_LIMIT
 
-        for chunk in _read_in_chunks(src, blocksize):
-            pointers_table.append(dst.tell())
+        hashed_size = 0
 
-            if chunk != bytes(len(chunk)):
-                # Zero blocks will be skipped
-                data = algorithm.data_compress(chunk, zlevel)
-                dst.write(data)
+        def hashed(blocks):
+            # Hash the blocks while they are read. Holes are hashed as the zeros they are
+            nonlocal hashed_size
+            for chunk in blocks:
+                length = min(blocksize, size - hashed_size)
+                with stats.stage('hash'):
+                    hasher.update(chunk or bytes(length))
+                hashed_size += length
+                yield chunk
+
+        if not stored:
+            with stats.stage('write'):
+                # File header
+                ziso_header = fobj.generate_header()
+                dst.write(ziso_header)
+
+                # Pointers table
+                dst.write(fobj.getTablePointers())
 
-        pointers_table.append(dst.tell())  # Last block
+            if algorithm.uses_dictionary() and dictionary is None:
+                # Small files can't pay for a dictionary of their own
+                dictionary = b''
+                if size >= DICT_MIN_FILE_SIZE:
+                    with stats.stage('dictionary'):
+                        dictionary = train_dictionary(_sample_blocks(src, blocksize, DICT_SAMPLES))
+                # Readers will find it between the pointers table and the first block
+                dst.write(dictionary)
+
+            blocks = _read_blocks(src, blocksize, size, stats)
+            if hasher is not None:
+                blocks = hashed(blocks)
+
+            data_start = dst.tell()
+            compressed_chunks = _compress_chunks(blocks, algorithm, zlevel, workers, dictionary, stats)
+            for num, data in enumerate(compressed_chunks, 1):
+                pointers_table.append(dst.tell())
+                with stats.stage('write'):
+                    dst.write(data)
+                stats.count('bytes_written', len(data))
+
+                if sampled is None:
+                    continue
+
+                # Give up as soon as the projected size is hopeless. The remaining blocks are
+                # expected to compress like the samples ahead, or like the blocks done so far
+                while sampled and sampled[0][0] < num:
+                    sampled.popleft()
+                consumed = min(size, num * blocksize)
+                if sampled:
+                    remaining_ratio = sum(r for _, r in sampled) / len(sampled)
+                else:
+                    remaining_ratio = (dst.tell() - data_start) / consumed
+
+                if dst.tell() + (size - consumed) * remaining_ratio >= size * RATIO_LIMIT:
+                    stored = True
+                    break
+            compressed_chunks.close()
+
+            if not force and dst.tell() >= size:
+                stored = True
 
         ratio = 1
 
-        if dst.tell() >= src.tell() and not force:
-            # Final size is bigger than compressed size
-            src.seek(0)
-            dst.seek(0)
-            dst.truncate()  # Remove all content from file
-            dst.write(src.read())  # TODO: Check memory usage for big files
+        if stored:
+            # Final size is bigger than compressed size. Store the original content
+            if hasher is not None:
+                # Whatever wasn't hashed while compressing
+                src.seek(hashed_size)
+                with stats.stage('hash'):
+                    for data in _read_in_chunks(src, COPY_BUFSIZE):
+                        hasher.update(data)
+            with stats.stage('raw_copy'):
+                _copy_raw(src, dst)
+            stats.count('bytes_written', size)
         else:
+            pointers_table.append(dst.tell())  # Last block
+
             # Save the ratio
-            ratio = dst.tell() / src.tell()
+            ratio = dst.tell() / size if size else 1
             # We confirm that compressed file will be stored. Append pointers table
-            dst.seek(len(ziso_header))  # Just after the header
-            dst.write(fobj.getTablePointers(list_pointers=pointers_table))
+            with stats.stage('write'):
+                dst.seek(len(ziso_header))  # Just after the header
+                dst.write(fobj.getTablePointers(list_pointers=pointers_table))
 
     # Copy attributes from original file
     if copy_attributes:
-        clone_attributes(in_file, out_file)
-        clone_dir_attributes(in_file.parents, out_file.parents)
+        with stats.stage('attributes'):
+            clone_attributes(in_file, out_file)
+            clone_dir_attributes(in_file.parents, out_file.parents)
 
     return ratio
 
 
+def compress_stream(src, dst,
+                    blocksize=2**15,
+                    algorithm='zlib',
+                    zlevel=6,
+                    legacy=False,
+                    workers=1,
+                    dictionary=None,
+                    auto_policy='balanced'):
+    """
+    Compress a readable binary stream of unknown length (stdin, pipes...) into dst,
+    which doesn't need to be seekable either. The pointers table is kept in memory
+    and the compressed data is spooled (in memory, then in a temporary file), so the
+    complete file is written to dst once the uncompressed size is known.
+    When src is a regular file and dst is seekable, the size is known from the start:
+    the data is written in place after room for the pointers table, filled in at the end.
+    Unlike compress_file, the output is always compressed. Returns the ratio
+    """
+    if blocksize not in [2**x for x in default_block_sizes]:
+        raise ValueError(f"Not a valid {blocksize}")
+
+    # Only known for a regular file. It can't change while it's compressed
+    expected = _stream_size(src) if _rewritable(dst) else None
+    if legacy and expected is not None and expected >= LEGACY_LIMIT:
+        raise IllegalArgumentError("Legacy only support files smaller than 4 GiB")
+
+    chunks = _read_in_chunks(src, blocksize)
+
+    if algorithm == AUTO:
+        # Choose with the first blocks of the stream
+        first_chunks = [chunk for _, chunk in zip(range(CLASSIFY_SAMPLES), chunks)]
+        algorithm, zlevel = select_algorithm(first_chunks, auto_policy, legacy)
+        chunks = chain(first_chunks, chunks)
+    else:
+        algorithm = Algorithm.from_arg(algorithm)
+
+    if legacy and algorithm != Algorithm.ZLIB: raise IllegalArgumentError("Legacy only support zlib")
+
+    if algorithm.uses_dictionary() and dictionary is None:
+        # Train with the first blocks of the stream, then compress them as usual
+        first_chunks = [chunk for _, chunk in zip(range(DICT_SAMPLES), chunks)]
+        # Small streams can't pay for a dictionary
+        dictionary = b''
+        if sum(len(chunk) for chunk in first_chunks) >= DICT_MIN_FILE_SIZE:
+            dictionary = train_dictionary(first_chunks)
+        chunks = chain(first_chunks, chunks)
+
+    size = 0
+    pointers_table = uint_array(8)  # Relative to the beginning of the data part
+
+    def counted(chunks):
+        nonlocal size
+        for chunk in chunks:
+            size += len(chunk)
+            if legacy and size >= LEGACY_LIMIT:
+                raise IllegalArgumentError("Legacy only support files smaller than 4 GiB")
+            yield chunk
+
+    with ExitStack() as stack:
+        if expected:
+            # Room for the header and the pointers table, written again at the end
+            start = dst.tell()
+            fobj = FileObject(None, alg=algorithm, blocksize=blocksize, isLegacy=legacy, size=expected)
+            dst.write(fobj.generate_header())
+            dst.write(fobj.getTablePointers())
+            out = dst
+        else:
+            out = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE))
+        data_offset = out.tell()
+
+        if algorithm.uses_dictionary():
+            out.write(dictionary)
+
+        for data in _compress_chunks(counted(chunks), algorithm, zlevel, workers, dictionary):
+            pointer = out.tell() - data_offset
+            if legacy and pointer + len(data) >= LEGACY_LIMIT:
+                # The pointers of legacy files are 32 bits
+                raise IllegalArgumentError("Legacy only support compressed files smaller than 4 GiB")
+            pointers_table.append(pointer)
+            out.write(data)
+
+        if expected is not None and size != expected:
+            raise IllegalArgumentError(f"Input changed while being compressed: {size} bytes instead of {expected}")
+
+        if size == 0:
+            # Same as compress_file: an empty file is stored as is
+            return 1
+
+        pointers_table.append(out.tell() - data_offset)  # Last block
+
+        fobj = FileObject(None, alg=algorithm, blocksize=blocksize, isLegacy=legacy, size=size)
+
+        ziso_header = fobj.generate_header()
+        data_start = len(ziso_header) + len(fobj.getTablePointers())
+        if legacy and data_start + pointers_table[-1] >= LEGACY_LIMIT:
+            raise IllegalArgumentError("Legacy only support compressed files smaller than 4 GiB")
+        pointers = fobj.getTablePointers(list_pointers=uint_array(fobj.header.pointers_size,
+                                                                  (data_start + p for p in pointers_table)))
+
+        if out is dst:
+            end = dst.tell()
+            dst.seek(start + len(ziso_header))
+            dst.write(pointers)
+            dst.seek(end)
+        else:
+            dst.write(ziso_header)
+            dst.write(pointers)
+            out.seek(0)
+            shutil.copyfileobj(out, dst)
+
+        return (data_start + pointers_table[-1]) / size
+
+
+def _rewritable(dst):
+    """
+    Whether what was written to dst can be written again in place: it must be seekable,
+    and not opened in append mode (every write would go to the end)
+    """
+    # Objects with just a write method are not seekable
+    seekable = getattr(dst, 'seekable', None)
+    if seekable is None or not seekable():
+        return False
+
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        return not fcntl.fcntl(dst.fileno(), fcntl.F_GETFL) & os.O_APPEND
+    except (OSError, ValueError):
+        # Not backed by a file descriptor (BytesIO...)
+        return True
+
+
+def _stream_size(src):
+    """
+    Number of bytes left to read from src if it's a regular file, otherwise None
+    """
+    try:
+        st = os.fstat(src.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return max(0, st.st_size - src.tell())
+    except (OSError, ValueError):
+        # No file descriptor or not seekable
+        return None
+
+
+def train_tree_dictionary(list_files, blocksize, samples=DICT_SAMPLES):
+    """
+    Train a single dictionary from sample blocks of all the given files, up to the size
+    of samples blocks. Small files are sampled completely, so a tree of many small files
+    gets as many samples as one of big files. The dictionary is 1/64 of the samples, which
+    is about the best tradeoff between its own size and what it saves
+    """
+    list_files = [f for f in list_files if f.is_file()]
+    per_file = max(1, samples // max(1, len(list_files)))
+
+    sample_blocks = []
+    sampled_size = 0
+    for f in list_files:
+        with open(f, 'rb') as src:
+            blocks = _sample_blocks(src, blocksize, per_file)
+        sample_blocks.extend(blocks)
+        sampled_size += sum(len(block) for block in blocks)
+        if sampled_size >= samples * blocksize:
+            break
+
+    return train_dictionary(sample_blocks, min(DICT_SIZE, sampled_size // 64))
+
+
+def save_tree_dictionary(target_dir, dictionary):
+    """
+    Store the tree dictionary at the root of the output tree, where the readers of the
+    files compressed with it find it
+    """
+    dict_file = target_dir / tree_dictionary_name(dictionary_id(dictionary))
+    target_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = f"{dict_file}.tmp"
+    with open(tmp_file, 'wb') as fout:
+        fout.write(dictionary)
+    os.replace(tmp_file, dict_file)
+    return dict_file
+
+
+def _sample_positions(size, blocksize, count):
+    """
+    Numbers of up to count blocks evenly spread over a file of the given size
+    """
+    nblocks = -(-size // blocksize)
+    step = max(1, nblocks // count)
+    return list(range(0, nblocks, step)[:count])
+
+
+def _sample_blocks(src, blocksize, count):
+    """
+    Read up to count blocks evenly spread over src. The position of src is restored
+    """
+    position = src.tell()
+    size = src.seek(0, 2)
+
+    samples = []
+    for num in _sample_positions(size, blocksize, count):
+        src.seek(num * blocksize)
+        samples.append(src.read(blocksize))
+
+    src.seek(position)
+    return samples
+
+
+def _copy_raw(src, dst):
+    """
+    Replace the content of dst with the whole src, without loading it in memory
+    """
+    src.seek(0)
+    dst.seek(0)
+    dst.truncate()  # Remove all content from file
+    copy_file_data(src, dst)
+
+
+def _compress_block(chunk, algorithm, zlevel, dictionary=None, stats=NO_STATS):
+    """
+    Compress a single block. Zero blocks are mapped to an empty output block
+    """
+    stats.count('blocks')
+    with stats.stage('zero_check'):
+        is_zero = chunk == bytes(len(chunk))
+    if is_zero:
+        stats.count('zero_blocks')
+        return b''
+    with stats.stage('compress'):
+        return algorithm.data_compress(chunk, zlevel, dictionary)
+
+
+def _compress_chunks(chunks, algorithm, zlevel, workers=1, dictionary=None, stats=NO_STATS):
+    """
+    Generator of compressed blocks, in the same order as the given chunks.
+    With more than one worker, blocks are compressed concurrently in a thread
+    pool (all codecs release the GIL). The number of blocks in flight is bounded,
+    so memory usage doesn't depend on the file size.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield _compress_block(chunk, algorithm, zlevel, dictionary, stats)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_compress_block, chunk, algorithm, zlevel, dictionary, stats))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def _data_regions(src, size):
+    """
+    List of (start, end) regions of src that hold data, according to SEEK_DATA/SEEK_HOLE.
+    The whole file is a single region if the platform or the filesystem can't tell
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return [(0, size)]
+
+    fd = src.fileno()
+    position = os.lseek(fd, 0, os.SEEK_CUR)
+    regions = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as ex:
+                if ex.errno == errno.ENXIO:
+                    break  # Only a hole until the end of the file
+                raise
+            offset = os.lseek(fd, start, os.SEEK_HOLE)
+            regions.append((start, min(offset, size)))
+    except OSError:
+        regions.append((offset, size))
+    finally:
+        os.lseek(fd, position, os.SEEK_SET)
+
+    return regions
+
+
+def _read_blocks(src, blocksize, size, stats=NO_STATS):
+    """
+    Generator of the blocks of src. Blocks that lie completely in a hole of a sparse
+    file are not read: an empty block is returned instead
+    """
+    regions = deque(_data_regions(src, size))
+
+    for offset in range(0, size, blocksize):
+        end = min(offset + blocksize, size)
+
+        while regions and regions[0][1] <= offset:
+            regions.popleft()
+
+        if not regions or regions[0][0] >= end:
+            yield b''
+            continue
+
+        with stats.stage('read'):
+            src.seek(offset)
+            data = src.read(end - offset)
+        stats.count('bytes_read', len(data))
+        yield data
+
+
 # https://stackoverflow.com/a/519653
 def _read_in_chunks(file_object, chunk_size):
     """Lazy function (generator) to read a file piece by piece.
-    Default chunk size: 1k."""
+    Every piece is chunk_size bytes but the last one, even if the
+    stream returns short reads (pipes, sockets...)"""
     while True:
         data = file_object.read(chunk_size)
         if not data:
             break
+        while len(data) < chunk_size:
+            more = file_object.read(chunk_size - len(data))
+            if not more:
+                break
+            data += more
         yield data
-
@@ -0,0 +1,70 @@
+from collections import OrderedDict, defaultdict
+import hashlib
+
+from mkzftree2.manifest import file_digest
+
+# Bytes hashed first to tell apart most files of the same size without reading them completely
+HEAD_SIZE = 2**16
+
+
+def _head_digest(path):
+    with open(path, 'rb') as fin:
+        return hashlib.blake2b(fin.read(HEAD_SIZE), digest_size=16).digest()
+
+
+def find_duplicates(list_files):
+    """
+    Group the given files by content. Returns an ordered dict of the first file of each
+    group (in the given order) -> [(duplicate, kind)], where kind is 'hardlink' for the
+    other names of the same inode and 'content' for other files with the same content.
+    Unique files are not included. Candidates are narrowed down by size, then by a hash
+    of their beginning, and only then hashed completely
+    """
+    inodes = OrderedDict()  # (dev, ino) -> [files]
+    sizes = dict()  # (dev, ino) -> size
+    for f in list_files:
+        st = f.stat()
+        inodes.setdefault((st.st_dev, st.st_ino), []).append(f)
+        sizes[(st.st_dev, st.st_ino)] = st.st_size
+
+    by_size = defaultdict(list)
+    for key in inodes:
+        by_size[sizes[key]].append(key)
+
+    # Inodes with the same content, keyed by the first one
+    same_content = defaultdict(list)
+    for size, keys in by_size.items():
+        if size == 0 or len(keys) < 2:
+            continue
+
+        by_head = defaultdict(list)
+        for key in keys:
+            by_head[_head_digest(inodes[key][0])].append(key)
+
+        for candidates in by_head.values():
+            if len(candidates) < 2:
+                continue
+            if size <= HEAD_SIZE:
+                by_digest = {None: candidates}  # Already hashed completely
+            else:
+                by_digest = defaultdict(list)
+                for key in candidates:
+                    by_digest[file_digest(inodes[key][0])].append(key)
+
+            for group in by_digest.values():
+                same_content[group[0]].extend(group[1:])
+
+    groups = OrderedDict()
+    for key, files in inodes.items():
+        duplicates = [(f, 'hardlink') for f in files[1:]]
+        for other in same_content.get(key, []):
+            duplicates.extend((f, 'content') for f in inodes[other])
+        if duplicates:
+            groups[files[0]] = duplicates
+
+    # Inodes that are duplicates of a previous one are not groups on their own
+    for others in same_content.values():
+        for key in others:
+            groups.pop(inodes[key][0], None)
+
+    return groups
@@ -1,15 +1,30 @@
 from mkzftree2.arguments import output_dir
 import os
-from mkzftree2.compressor import compress_file, uncompress_file
-from mkzftree2.utils import clone_dir_attributes
+import time
+from pathlib import Path
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from mkzftree2.compressor import compress_file, uncompress_file, train_tree_dictionary, save_tree_dictionary, AUTO
+from mkzftree2.models.FileObject import FileObject, ZISOFSv2, tree_dictionary_file_id
+from mkzftree2.models.algorithm import Algorithm
+from mkzftree2.index import content_hasher, index_entry, merge_index, write_index, lookup as index_lookup
+from mkzftree2.manifest import read_manifest, write_manifest, source_entry, is_unchanged, file_digest
+from mkzftree2.dedup import find_duplicates
+from mkzftree2.fsck import CheckResult, check_file
+from mkzftree2.stats import StageStats, NO_STATS
+from mkzftree2.progress import Progress
+from mkzftree2.utils import IllegalZisofsFormat, NotCompressedFile, clone_attributes, clone_dir_attributes, reflink_file, sizeof_fmt, copy_file_data
 
 
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['', ' Ki', ' Mi', ' Gi', ' Ti', ' Pi', ' Ei', ' Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
+# Outcome of a single file: status is one of 'compressed', 'stored' (raw copy), 'skipped',
+# 'unchanged' (incremental builds), 'linked' (deduplicated) or 'copied' (duplicate copied
+# to keep its own attributes: it uses space of its own, but wasn't compressed again).
+# digest is the content hash of the source (see mkzftree2.index), if it was requested.
+# elapsed is the time spent compressing it, in seconds, and algorithm the name of the
+# algorithm it was compressed with, if known. stats is the StageStats of its compression
+# as a dict, if they were requested
+FileResult = namedtuple('FileResult', ['source', 'target', 'osize', 'csize', 'status', 'digest', 'elapsed',
+                                       'algorithm', 'stats'])
 
 
 def find_files(source_dir, restrict_search, followLinks):
@@ -44,34 +59,426 @@ def find_files(source_dir, restrict_search, followLinks):
     return list_files
 
 
-def uncompress_files(input_dir, output_dir):
+def _walk_tree(input_dir):
     """
-    docstring
+    List the directories, regular files and symlinks of a tree, as paths relative to it.
+    Directories come before their content. Symlinks to directories are not followed.
+    Tree dictionaries (at the root of a compressed tree) are not part of the content
     """
-    for source_file in input_dir.iterdir():
-        target_file = output_dir / source_file.relative_to(input_dir)
+    dirs, files, links = [], [], []
+    for root, dirnames, filenames in os.walk(input_dir):
+        rel_root = Path(root).relative_to(input_dir)
+        if str(rel_root) == '.':
+            filenames = [name for name in filenames if tree_dictionary_file_id(Path(root) / name) is None]
+        for name in dirnames + filenames:
+            path = Path(root) / name
+            if path.is_symlink():
+                links.append(rel_root / name)
+            elif path.is_dir():
+                dirs.append(rel_root / name)
+            elif path.is_file():
+                files.append(rel_root / name)
+    return dirs, files, links
 
-        if source_file.is_file():
-            # Handle files
-            if source_file.is_symlink():
-                target_file.symlink_to(os.readlink(source_file))
-                continue
-            else:
-                # Regular file
-                uncompress_file(source_file, target_file)
-                print(f"{target_file}")
 
-        elif source_file.is_dir():
-            target_file.mkdir(parents=True)
-            uncompress_files(source_file, target_file)
-            # Use fake file to get correct dir path
-            clone_dir_attributes(
-                (source_file / 'fake.txt').parents, (target_file / 'fake.txt').parents)
+def _uncompress_task(source_file, target_file, compressed):
+    """
+    Uncompress a single file and return its uncompressed size. Runs inside the pool
+    workers, so it must not print anything
+    """
+    uncompress_file(source_file, target_file, copy_attributes=False, compressed=compressed)
+    clone_attributes(source_file, target_file)
+    return target_file.stat().st_size
+
+
+def uncompress_files(input_dir, output_dir, index=None, verbose=False, quiet=False, file_jobs=1, pool='thread'):
+    """
+    Uncompress the tree input_dir into output_dir, file_jobs files at a time.
+    index (entries of a tree index) tells which files are stored uncompressed, so
+    their headers are not even read.
+    Progress and totals are shown unless quiet, and every file is listed if verbose
+    """
+    start = time.monotonic()
+    dirs, files, links = _walk_tree(input_dir)
+
+    for rel_path in dirs:
+        (output_dir / rel_path).mkdir(parents=True, exist_ok=True)
+
+    stats = [(input_dir / rel_path).stat() for rel_path in files]
+    sizes = [st.st_size for st in stats]
+    progress = Progress(len(files), sum(sizes), enabled=not quiet)
+
+    tasks = []
+    for rel_path, st in zip(files, stats):
+        compressed = None
+        if index is not None:
+            entry = index_lookup(index, str(rel_path), st)
+            if entry is not None:
+                compressed = entry.algorithm != 0
+        tasks.append((input_dir / rel_path, output_dir / rel_path, compressed))
+
+    results = [None] * len(tasks)
+
+    def file_done(idx, result):
+        results[idx] = result
+        if isinstance(result, Exception):
+            progress.write(f"{tasks[idx][1]}: FAILED ({result})")
+            return
+        progress.update(sizes[idx])
+        if verbose:
+            progress.write(f"{tasks[idx][1]}")
+
+    if file_jobs <= 1:
+        for idx, task in enumerate(tasks):
+            try:
+                file_done(idx, _uncompress_task(*task))
+            except Exception as ex:
+                file_done(idx, ex)
+    else:
+        for idx, result in _run_pool(_uncompress_task, tasks, file_jobs, pool, sizes):
+            file_done(idx, result)
+
+    for rel_path in links:
+        (output_dir / rel_path).symlink_to(os.readlink(input_dir / rel_path))
+
+    # Directories are done last, as creating their content changes their dates
+    for rel_path in reversed(dirs):
+        clone_attributes(input_dir / rel_path, output_dir / rel_path)
+
+    progress.close()
+
+    failed = [r for r in results if isinstance(r, Exception)]
+    if not quiet:
+        written = sum(r for r in results if not isinstance(r, Exception))
+        elapsed = time.monotonic() - start
+        print(f"Total input size : {sizeof_fmt(sum(sizes))}")
+        print(f"Total output size: {sizeof_fmt(written)} ({written / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+
+    if failed:
+        # Always report the first failure in input order, whatever the scheduling was
+        raise failed[0]
+
+
+def _verify_task(target_file, digest, source_file, workers):
+    """
+    Check a single file of a compressed tree, against the content of source_file if
+    given. Runs inside the pool workers, so it must not print anything
+    """
+    if source_file is not None:
+        if not source_file.is_file():
+            return CheckResult(target_file, 'mismatch', None, "Not in the source tree")
+        digest = file_digest(source_file)
+    return check_file(target_file, digest, workers)
+
+
+def verify_files(target_dir, source_dir=None, digests=None, workers=1, file_jobs=1, pool='thread',
+                 verbose=False, quiet=False):
+    """
+    Check every file of the compressed tree target_dir without writing anything (see
+    mkzftree2.fsck), file_jobs files at a time and the blocks of each file with workers
+    threads. Contents are compared with the files of source_dir, or with digests (path
+    relative to the tree -> content hash, e.g. from load_digests) if given.
+    Problems are always listed, every file if verbose, and progress and totals unless
+    quiet. Returns the CheckResults of the files with problems
+    """
+    start = time.monotonic()
+    _, files, links = _walk_tree(target_dir)
+
+    expected = set()
+    if source_dir is not None:
+        _, source_files, _ = _walk_tree(source_dir)
+        expected = set(source_files)
+    elif digests is not None:
+        expected = set(Path(p) for p in digests)
+
+    sizes = [(target_dir / rel_path).stat().st_size for rel_path in files]
+    progress = Progress(len(files), sum(sizes), enabled=not quiet)
+
+    tasks = []
+    for rel_path in files:
+        digest = digests.get(str(rel_path)) if digests is not None else None
+        source_file = source_dir / rel_path if source_dir is not None else None
+        tasks.append((target_dir / rel_path, digest, source_file, workers))
+
+    results = [None] * len(tasks)
+
+    def file_done(idx, result):
+        if isinstance(result, Exception):
+            result = CheckResult(tasks[idx][0], 'corrupt', None, str(result))
+        results[idx] = result
+        progress.update(sizes[idx])
+        if result.status != 'ok':
+            progress.write(f"{result.path}: {result.status.upper()} ({result.error})")
+        elif verbose:
+            progress.write(f"{result.path}: OK")
+
+    if file_jobs <= 1:
+        for idx, task in enumerate(tasks):
+            try:
+                file_done(idx, _verify_task(*task))
+            except Exception as ex:
+                file_done(idx, ex)
+    else:
+        for idx, result in _run_pool(_verify_task, tasks, file_jobs, pool, sizes):
+            file_done(idx, result)
+
+    # Expected files that are not in the tree. Symlinks are only checked for existence
+    present = set(files) | set(links)
+    for rel_path in sorted(expected - present):
+        result = CheckResult(target_dir / rel_path, 'missing', None, "Not in the compressed tree")
+        results.append(result)
+        progress.write(f"{result.path}: MISSING ({result.error})")
+
+    progress.close()
+
+    problems = [r for r in results if r.status != 'ok']
+    if not quiet:
+        checked = sum(r.size for r in results if r.size is not None)
+        elapsed = time.monotonic() - start
+        print(f"Checked files    : {len(files)}, {len(problems)} with problems")
+        print(f"Uncompressed size: {sizeof_fmt(checked)} ({checked / max(elapsed, 1e-9) / 1e6:.1f} MB/s)")
+
+    return problems
+
+
+def _compress_task(source_file, target_file, overwrite, alg, zlevel, blocksize, force, legacy,
+                   copy_attributes, workers, dictionary, hash_content=False, auto_policy='balanced',
+                   collect_stats=False):
+    """
+    Compress a single file and return its FileResult. Runs inside the pool workers,
+    so it must not print anything
+    """
+    osize = source_file.stat().st_size
+
+    if target_file.exists() and not overwrite:
+        return FileResult(source_file, target_file, osize, target_file.stat().st_size, 'skipped', None, 0, None,
+                          None)
+
+    stats = StageStats() if collect_stats else NO_STATS
+
+    if target_file.exists() and target_file.stat().st_nlink > 1:
+        # Shared with other outputs (deduplicated). Don't change them
+        target_file.unlink()
+
+    start = time.perf_counter()
+    hasher = content_hasher() if hash_content else None
+
+    ratio = compress_file(
+        source_file,
+        target_file,
+        blocksize=blocksize,
+        algorithm=alg,
+        zlevel=zlevel,
+        force=force,
+        legacy=legacy,
+        copy_attributes=copy_attributes,
+        workers=workers,
+        dictionary=dictionary,
+        hasher=hasher,
+        auto_policy=auto_policy,
+        stats=stats)
+
+    status = 'stored' if ratio == 1 else 'compressed'
+    digest = hasher.digest() if hasher is not None else None
+    elapsed = time.perf_counter() - start
+    algorithm = None
+    if status == 'compressed':
+        # With the auto algorithm, only the header tells which one was chosen
+        algorithm = alg if alg != AUTO else FileObject(target_file).get_algorithm().name.lower()
+    return FileResult(source_file, target_file, osize, target_file.stat().st_size, status, digest,
+                      elapsed, algorithm, stats.as_dict() if collect_stats else None)
+
+
+def _format_result(result):
+    if result.status == 'skipped':
+        return f"{result.target}: SKIPED"
+    elif result.status == 'unchanged':
+        return f"{result.target}: UNCHANGED"
+    elif result.status == 'linked':
+        return f"{result.target}: {sizeof_fmt(result.osize)} (linked)"
+    elif result.status == 'copied':
+        return f"{result.target}: {sizeof_fmt(result.osize)} (copied)"
+    elif result.status == 'stored':
+        return f"{result.target}: {sizeof_fmt(result.osize)} (stored)"
+    else:
+        return f"{result.target}: {sizeof_fmt(result.osize)} -> {sizeof_fmt(result.csize)} ({result.algorithm})"
+
+
+def _run_pool(func, tasks, file_jobs, pool, sizes):
+    """
+    Run func on the arguments of each task concurrently and yield (index, result or
+    exception) as soon as each file is done. The largest files (sizes of the sources) are submitted
+    first, so a single huge file doesn't become the long tail of the run
+    """
+    executor_class = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+
+    order = sorted(range(len(tasks)), key=lambda i: sizes[i], reverse=True)
 
+    with executor_class(max_workers=file_jobs) as executor:
+        futures = {executor.submit(func, *tasks[i]): i for i in order}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as ex:
+                yield futures[future], ex
+
+
+def _link_symlink(source_file, target_file, replace):
+    """
+    Create target_file as a copy of the symlink source_file. An existing target is
+    kept if it's the same link, or if it can't be replaced
+    """
+    link = os.readlink(source_file)
+    if os.path.lexists(target_file):
+        if (target_file.is_symlink() and os.readlink(target_file) == link) or not replace:
+            return
+        target_file.unlink()
+    target_file.symlink_to(link)
+
+
+def _same_attributes(file_a, file_b):
+    """
+    Whether two files have the same permissions and owner. Dates are not compared: they
+    almost always differ between copies, and sharing them is the price of deduplication
+    """
+    st_a, st_b = file_a.stat(), file_b.stat()
+    return (st_a.st_mode, st_a.st_uid, st_a.st_gid) == (st_b.st_mode, st_b.st_uid, st_b.st_gid)
+
+
+def _link_duplicate(first, source_file, target_file, kind, replace, copy_attributes):
+    """
+    Create the output of source_file, a duplicate of the already compressed first (FileResult).
+    Other names of the same source inode are hardlinked. Other files with the same content
+    are reflinked, so they keep their own attributes. Without reflinks, they are hardlinked
+    if they have the same permissions and owner (or attributes are not copied), and copied
+    otherwise
+    """
+    osize = source_file.stat().st_size
+    status = 'linked'
+
+    if os.path.lexists(target_file):
+        if not replace:
+            return FileResult(source_file, target_file, osize, target_file.stat().st_size, 'skipped', None, 0,
+                              None, None)
+        target_file.unlink()
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+
+    if kind == 'content' and reflink_file(first.target, target_file):
+        if copy_attributes:
+            clone_attributes(source_file, target_file)
+    elif kind == 'content' and copy_attributes and not _same_attributes(first.source, source_file):
+        # A hardlink would share the attributes of the first file (e.g. lose the +x of this one)
+        with open(first.target, 'rb') as src, open(target_file, 'wb') as dst:
+            copy_file_data(src, dst)
+        clone_attributes(source_file, target_file)
+        status = 'copied'
+    else:
+        os.link(first.target, target_file)
+
+    return FileResult(source_file, target_file, osize, target_file.stat().st_size, status, first.digest, 0,
+                      first.algorithm, None)
+
+
+def _remove_stale_dictionaries(target_dir):
+    """
+    Remove the tree dictionaries of target_dir that no file refers to any more, e.g.
+    the ones of the previous builds of an incremental tree
+    """
+    dictionaries = dict()  # id -> file
+    for name in os.listdir(target_dir):
+        dict_id = tree_dictionary_file_id(target_dir / name)
+        if dict_id is not None:
+            dictionaries[dict_id] = target_dir / name
+    if len(dictionaries) < 2:
+        return []
+
+    for rel_path in _walk_tree(target_dir)[1]:
+        try:
+            header = FileObject(target_dir / rel_path).header
+        except (NotCompressedFile, IllegalZisofsFormat, OSError):
+            continue
+        if isinstance(header, ZISOFSv2):
+            dictionaries.pop(header.get_dictionary_id(), None)
+
+    for dict_file in dictionaries.values():
+        dict_file.unlink()
+    return list(dictionaries.values())
+
+
+def _remove_output(rel_path, source_dir, target_dir):
+    """
+    Remove the output of a source file that doesn't exist anymore, and the directories
+    left empty that don't exist in the source either
+    """
+    target_file = target_dir / rel_path
+    try:
+        target_file.unlink()
+    except FileNotFoundError:
+        return False
+
+    for parent in Path(rel_path).parents:
+        if str(parent) == '.' or (source_dir / parent).exists():
+            break
+        try:
+            (target_dir / parent).rmdir()
+        except OSError:
+            break  # Not empty
+    return True
 
-def process_files(list_files, source_dir, target_dir, overwrite, alg, zlevel, blocksize, force, legacy, ignore_attributes):
-    osizesum = 0
-    csizesum = 0
+
+def process_files(list_files, source_dir, target_dir, overwrite, alg, zlevel, blocksize, force, legacy, ignore_attributes,
+                  workers=1, file_jobs=1, pool='thread', dict_scope='file', index_file=None, manifest_file=None,
+                  dedup=False, auto_policy='balanced', hooks=None, verbose=False, quiet=False):
+    """
+    Compress list_files (found in source_dir) into target_dir and return their FileResults.
+    With index_file, a tree index of target_dir is written there, keeping the entries of
+    the other files of a previous index.
+    With manifest_file, the build is incremental: files unchanged since the manifest was
+    written are not compressed again, and outputs of removed source files are deleted.
+    With dedup, files with the same content are only compressed once (see _link_duplicate).
+    With alg='auto', every file gets the algorithm that suits auto_policy best.
+    hooks (a stats.Hooks) are told about every file and the end of the run, with the
+    time spent in every stage.
+    Progress and totals are shown unless quiet, and every file is listed if verbose
+    """
+    # Work done in this process. Files are measured by their tasks
+    stats = StageStats() if hooks is not None else NO_STATS
+
+    def file_done(result):
+        progress.update(result.osize)
+        if verbose:
+            progress.write(_format_result(result))
+        if hooks is not None:
+            hooks.file_done(result, result.stats)
+
+    def summary(line):
+        if not quiet:
+            progress.write(line)
+
+    dictionary = None
+    if alg != AUTO and Algorithm.from_arg(alg).uses_dictionary() and dict_scope == 'tree':
+        # A single dictionary shared by every file of the tree
+        with stats.stage('dictionary'):
+            dictionary = train_tree_dictionary(list_files, blocksize)
+            if dictionary:
+                # Stored once. Files compressed with it only refer to it
+                save_tree_dictionary(target_dir, dictionary)
+            else:
+                dictionary = None
+
+    incremental = manifest_file is not None
+    if incremental:
+        params = dict(algorithm=alg, zlevel=zlevel, blocksize=blocksize, force=force, legacy=legacy,
+                      attributes=not ignore_attributes, dict_scope=dict_scope, auto_policy=auto_policy)
+        old_params, previous_files = read_manifest(manifest_file)
+        # Files compressed with other parameters must be compressed again
+        old_files = previous_files if old_params == params else dict()
+        sources = dict()  # path -> stat, before compressing it
+
+    results = []  # Ready FileResults, or None until the task in the slot is done
+    sizes = []  # Size of the source of each slot
+    tasks = []
+    task_slots = []
     for f in list_files:
         target_file = target_dir / f.relative_to(source_dir)
 
@@ -83,11 +490,11 @@ def process_files(list_files, source_dir, target_dir, overwrite, alg, zlevel, bl
                 pass
             else:
                 # The symlink is inside the source dir. Create its correspondent symlink in target_dir
-                target_file.symlink_to(os.readlink(f))
+                _link_symlink(f, target_file, overwrite or incremental)
                 continue
         elif f.is_dir():
             # Is a empty dir
-            target_file.mkdir(parents=True)
+            target_file.mkdir(parents=True, exist_ok=True)
             if not ignore_attributes:
                 # Use fake file to get correct dir path
                 clone_dir_attributes(
@@ -95,26 +502,137 @@ def process_files(list_files, source_dir, target_dir, overwrite, alg, zlevel, bl
 
             continue
 
-        osizesum += f.stat().st_size
+        st = f.stat()
+        sizes.append(st.st_size)
+
+        if incremental:
+            rel_path = str(f.relative_to(source_dir))
+            sources[rel_path] = st
+            entry = old_files.get(rel_path)
+            if not overwrite and target_file.exists() and is_unchanged(entry, f, st):
+                digest = bytes.fromhex(entry['digest']) if entry['digest'] else None
+                results.append(FileResult(f, target_file, st.st_size, target_file.stat().st_size,
+                                          'unchanged', digest, 0, None, None))
+                continue
+
+        task_slots.append(len(results))
+        results.append(None)
+        # Incremental builds replace the outdated outputs
+        tasks.append((f, target_file, overwrite or incremental, alg, zlevel, blocksize, force, legacy,
+                      not ignore_attributes, workers, dictionary, index_file is not None or incremental,
+                      auto_policy, hooks is not None))
+
+    pending = {slot: task[0] for slot, task in zip(task_slots, tasks)}  # slot -> source
+
+    linked = []  # (slot, source, target, kind, slot of the first copy)
+    if dedup:
+        slots = {task[0]: slot for slot, task in zip(task_slots, tasks)}
+        with stats.stage('dedup'):
+            groups = find_duplicates([task[0] for task in tasks])
+        for first, duplicates in groups.items():
+            for f, kind in duplicates:
+                linked.append((slots.pop(f), f, target_dir / f.relative_to(source_dir), kind, slots[first]))
+        # Only the first copy of each content is compressed
+        kept = [idx for idx, task in enumerate(tasks) if task[0] in slots]
+        tasks = [tasks[idx] for idx in kept]
+        task_slots = [task_slots[idx] for idx in kept]
 
-        if target_file.exists() and not overwrite:
-            csizesum += target_file.stat().st_size
-            print(f"{target_file}: SKIPED")
+    progress = Progress(len(results), sum(sizes), enabled=not quiet)
+    for result in results:
+        if result is not None:
+            file_done(result)
+
+    def task_done(idx, result):
+        results[task_slots[idx]] = result
+        if isinstance(result, Exception):
+            progress.write(f"{tasks[idx][1]}: FAILED ({result})")
+        else:
+            file_done(result)
+
+    if file_jobs <= 1:
+        for idx, task in enumerate(tasks):
+            try:
+                result = _compress_task(*task)
+            except Exception as ex:
+                result = ex
+            task_done(idx, result)
+    else:
+        for idx, result in _run_pool(_compress_task, tasks, file_jobs, pool, [sizes[slot] for slot in task_slots]):
+            task_done(idx, result)
+
+    for slot, f, target_file, kind, first_slot in linked:
+        first = results[first_slot]
+        if isinstance(first, Exception):
+            results[slot] = first
             continue
+        try:
+            with stats.stage('link'):
+                results[slot] = _link_duplicate(first, f, target_file, kind, overwrite or incremental,
+                                                not ignore_attributes)
+            file_done(results[slot])
+        except Exception as ex:
+            results[slot] = ex
+            progress.write(f"{target_file}: FAILED ({ex})")
+
+    progress.close()
+
+    failed = [r for r in results if isinstance(r, Exception)]
+    done = [r for r in results if not isinstance(r, Exception)]
+
+    osizesum = sum(r.osize for r in done)
+    # Deduplicated outputs don't use any space of their own
+    csizesum = sum(r.csize for r in done if r.status != 'linked')
+
+    if dedup:
+        deduplicated = [(results[slot], results[first_slot]) for slot, _, _, _, first_slot in linked
+                        if not isinstance(results[slot], Exception) and results[slot].status == 'linked']
+        saved = sum(r.csize for r, _ in deduplicated)
+        seconds = sum(first.elapsed for _, first in deduplicated)
+        summary(f"Deduplicated     : {len(deduplicated)} files, {sizeof_fmt(saved)} and "
+                f"{seconds:.1f}s of compression saved")
+
+    if incremental:
+        removed = [p for p in previous_files if not os.path.lexists(source_dir / p)]
+        for rel_path in removed:
+            if _remove_output(rel_path, source_dir, target_dir) and verbose:
+                progress.write(f"{target_dir / rel_path}: REMOVED")
+
+        files = {p: e for p, e in old_files.items() if p not in removed}
+        for r in done:
+            rel_path = str(r.source.relative_to(source_dir))
+            files[rel_path] = source_entry(sources[rel_path], r.digest)
+        for slot, f in pending.items():
+            if isinstance(results[slot], Exception):
+                # Retried by the next run
+                files.pop(str(f.relative_to(source_dir)), None)
+        with stats.stage('manifest'):
+            write_manifest(manifest_file, params, files)
+
+        summary(f"Unchanged files  : {sum(r.status == 'unchanged' for r in done)}")
+
+    if alg == AUTO:
+        chosen = Counter(r.algorithm for r in done if r.algorithm)
+        summary(f"Algorithms       : {', '.join(f'{a} ({n})' for a, n in chosen.most_common())}")
+
+    summary(f"Total input size : {sizeof_fmt(osizesum)}")
+    summary(f"Total output size: {sizeof_fmt(csizesum)}")
+
+    if target_dir.is_dir():
+        with stats.stage('dictionary'):
+            for dict_file in _remove_stale_dictionaries(target_dir):
+                if verbose:
+                    progress.write(f"{dict_file}: REMOVED")
 
-        compress_file(
-            f,
-            target_file,
-            blocksize=blocksize,
-            algorithm=alg,
-            zlevel=zlevel,
-            force=force,
-            legacy=legacy)
+    if index_file is not None and not failed:
+        with stats.stage('index'):
+            entries = [index_entry(r.target, str(r.target.relative_to(target_dir)), r.digest) for r in done]
+            write_index(index_file, merge_index(index_file, target_dir, entries))
 
-        csizesum += target_file.stat().st_size
+    if hooks is not None:
+        hooks.run_done(results, stats.as_dict())
 
-        print(
-            f"{target_file}: {sizeof_fmt(f.stat().st_size)} -> {sizeof_fmt(target_file.stat().st_size)}")
+    if failed:
+        # Always report the first failure in input order, whatever the scheduling was
+        raise failed[0]
 
-    print(f"Total input size : {sizeof_fmt(osizesum)}")
-    print(f"Total output size: {sizeof_fmt(csizesum)}")
+    return done
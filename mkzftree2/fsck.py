@@ -0,0 +1,162 @@
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from mkzftree2.index import content_hasher, read_index
+from mkzftree2.manifest import file_digest, read_manifest
+from mkzftree2.models.FileObject import FileObject
+from mkzftree2.utils import IllegalZisofsFormat, NotCompressedFile
+
+# Blocks checked by each task of the thread pool. A single block is too little work
+# for the cost of a task
+BATCH_BLOCKS = 16
+
+# Outcome of the check of a file of a compressed tree: status is 'ok', 'corrupt' (bad
+# header, pointers table or block), 'mismatch' (the content isn't the expected one) or
+# 'missing' (expected but not in the tree). size is the uncompressed size, if known,
+# and error describes the problem
+CheckResult = namedtuple('CheckResult', ['path', 'status', 'size', 'error'])
+
+
+def check_pointers(fobj, csize):
+    """
+    Validate the header and the pointers table of fobj, a compressed file of csize bytes.
+    Raises IllegalZisofsFormat describing the first problem found
+    """
+    try:
+        fobj.get_algorithm()
+    except ValueError as ex:
+        raise IllegalZisofsFormat(f"Unknown algorithm: {ex}") from ex
+
+    pointers = fobj.get_pointers()
+    table_end = fobj.get_dictionary_offset()
+
+    if pointers[0] < table_end:
+        raise IllegalZisofsFormat(f"First block at {pointers[0]}, inside the pointers table (until {table_end})")
+
+    for num in range(len(pointers) - 1):
+        if pointers[num + 1] < pointers[num]:
+            raise IllegalZisofsFormat(f"Pointer {num + 1} ({pointers[num + 1]}) is before the previous one "
+                                      f"({pointers[num]})")
+
+    if pointers[-1] > csize:
+        raise IllegalZisofsFormat(f"Blocks end at {pointers[-1]}, after the end of the file ({csize})")
+
+
+def _check_range(fobj, first, count, keep):
+    """
+    Decompress count blocks from first and check their sizes. Returns their data if keep
+    """
+    pointers = fobj.get_pointers()
+    size = fobj.get_size()
+    blocksize = fobj.header.get_blocksize()
+
+    data = []
+    for num in range(first, first + count):
+        expected = min(blocksize, size - num * blocksize)
+        if pointers[num] == pointers[num + 1]:
+            # Zero block
+            if keep:
+                data.append(bytes(expected))
+            continue
+
+        error = None
+        try:
+            block = fobj.read_block(num)
+        except Exception as ex:
+            error = f"Block {num} can't be decompressed: {ex}"
+        if error is not None:
+            # Without the original traceback: it holds views of the mapped file, which
+            # couldn't be closed
+            raise IllegalZisofsFormat(error)
+        if len(block) != expected:
+            raise IllegalZisofsFormat(f"Block {num} is {len(block)} bytes instead of {expected}")
+        if keep:
+            data.append(block)
+
+    return b''.join(data) if keep else None
+
+
+def _check_blocks(fobj, workers=1, keep=False):
+    """
+    Generator of the checked blocks of fobj, in batches and in order: their data if keep,
+    otherwise None. With more than one worker, batches are decompressed concurrently in
+    a thread pool, with a bounded number of them in flight
+    """
+    nblocks = len(fobj.get_pointers()) - 1
+    # Loaded once, before the workers share it
+    fobj.get_dictionary()
+
+    batches = [(first, min(BATCH_BLOCKS, nblocks - first)) for first in range(0, nblocks, BATCH_BLOCKS)]
+
+    if workers <= 1 or len(batches) <= 1:
+        for first, count in batches:
+            yield _check_range(fobj, first, count, keep)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for first, count in batches:
+            pending.append(pool.submit(_check_range, fobj, first, count, keep))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def check_file(path, digest=None, workers=1):
+    """
+    Check a file of a compressed tree without writing anything: its header, its pointers
+    table, and that every block decompresses to the size it should, with workers threads.
+    If digest is given, the content hash (see mkzftree2.index) of the uncompressed data
+    must match it. Files stored uncompressed are only hashed. Returns a CheckResult
+    """
+    try:
+        try:
+            fobj = FileObject(path, use_mmap=True)
+        except NotCompressedFile:
+            size = os.stat(path).st_size
+            if digest is not None and file_digest(path) != digest:
+                return CheckResult(path, 'mismatch', size, "Content differs")
+            return CheckResult(path, 'ok', size, None)
+
+        with fobj:
+            check_pointers(fobj, os.stat(path).st_size)
+
+            hasher = content_hasher() if digest is not None else None
+            for data in _check_blocks(fobj, workers, keep=hasher is not None):
+                if hasher is not None:
+                    hasher.update(data)
+
+            if hasher is not None and hasher.digest() != digest:
+                return CheckResult(path, 'mismatch', fobj.get_size(), "Content differs")
+            return CheckResult(path, 'ok', fobj.get_size(), None)
+
+    except IllegalZisofsFormat as ex:
+        return CheckResult(path, 'corrupt', None, str(ex) or "Invalid header")
+    except OSError as ex:
+        return CheckResult(path, 'corrupt', None, str(ex))
+
+
+def load_digests(index_file=None, manifest_file=None):
+    """
+    Content hashes of the files of a tree, as a dict of path relative to the tree -> digest,
+    from a tree index or a source manifest. Files without known hash are not included
+    """
+    digests = dict()
+
+    if manifest_file is not None:
+        params, files = read_manifest(manifest_file)
+        if params is None:
+            raise FileNotFoundError(f"{manifest_file}: manifest not found")
+        for path, entry in files.items():
+            if entry['digest'] is not None:
+                digests[path] = bytes.fromhex(entry['digest'])
+
+    if index_file is not None:
+        for path, entry in read_index(index_file).items():
+            if entry.digest is not None:
+                digests[path] = entry.digest
+
+    return digests
@@ -0,0 +1,132 @@
+from collections import namedtuple
+import hashlib
+import os
+import struct
+
+from mkzftree2.iso9660 import iso711_to_int
+from mkzftree2.models.FileObject import FileObject
+from mkzftree2.utils import NotCompressedFile, IllegalZisofsFormat
+
+# Binary index of a compressed tree:
+#   header: magic, version, number of entries
+#   entry: uncompressed size, compressed size, modification time of the compressed file
+#          (ns), pointers table offset, algorithm (0 if the file is stored uncompressed),
+#          log2 of the block size, content hash, length of the path, followed by the path
+#          relative to the tree (file system encoding)
+# All integers are little endian
+INDEX_MAGIC = b'ZFINDEX\x00'
+INDEX_VERSION = 2
+_HEADER = struct.Struct('<8sII')
+_ENTRY = struct.Struct('<QQQQBB16sH')
+
+DIGEST_SIZE = 16
+
+# Describes a file of the compressed tree. digest is None when unknown
+IndexEntry = namedtuple('IndexEntry', ['path', 'size', 'csize', 'mtime', 'table_offset', 'algorithm',
+                                       'blocksize', 'digest'])
+
+
+def content_hasher():
+    """
+    Hash object used for the content (uncompressed data) of the indexed files
+    """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def index_entry(target_file, path, digest=None):
+    """
+    Describe the file target_file of the compressed tree, known in the index as path
+    """
+    st = target_file.stat()
+    try:
+        header = FileObject(target_file).header
+    except NotCompressedFile:
+        return IndexEntry(path, st.st_size, st.st_size, st.st_mtime_ns, 0, 0, 0, digest)
+
+    return IndexEntry(path, header.get_size(), st.st_size, st.st_mtime_ns, len(header),
+                      header.get_algorithm().value, iso711_to_int(header.blocksize), digest)
+
+
+def write_index(index_file, entries):
+    """
+    Write the index atomically: readers never see a partial file
+    """
+    entries = sorted(entries, key=lambda e: e.path)
+
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, 'wb') as fout:
+        fout.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries)))
+        for e in entries:
+            path = os.fsencode(e.path)
+            fout.write(_ENTRY.pack(e.size, e.csize, e.mtime, e.table_offset, e.algorithm, e.blocksize,
+                                   e.digest or bytes(DIGEST_SIZE), len(path)))
+            fout.write(path)
+    os.replace(tmp_file, index_file)
+
+
+def read_index(index_file):
+    """
+    Load an index as a dict of path -> IndexEntry
+    """
+    with open(index_file, 'rb') as fin:
+        data = fin.read()
+
+    if len(data) < _HEADER.size:
+        raise IllegalZisofsFormat(f"{index_file}: truncated index")
+    magic, version, count = _HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise IllegalZisofsFormat(f"{index_file}: not a tree index")
+
+    entries = dict()
+    offset = _HEADER.size
+    for _ in range(count):
+        if offset + _ENTRY.size > len(data):
+            raise IllegalZisofsFormat(f"{index_file}: truncated index")
+        size, csize, mtime, table_offset, alg, blocksize, digest, path_len = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        path = os.fsdecode(data[offset:offset + path_len])
+        offset += path_len
+
+        if digest == bytes(DIGEST_SIZE):
+            digest = None
+        entries[path] = IndexEntry(path, size, csize, mtime, table_offset, alg, blocksize, digest)
+
+    return entries
+
+
+def lookup(entries, path, stat):
+    """
+    Return the entry of path if it still describes the file with the given stat, or None.
+    A different compressed size or modification time means the file was replaced after
+    the index was written
+    """
+    entry = entries.get(path)
+    if entry is None or entry.csize != stat.st_size or entry.mtime != stat.st_mtime_ns:
+        return None
+    return entry
+
+
+def merge_index(index_file, tree_dir, entries):
+    """
+    Entries of the index of tree_dir once entries were (re)built: those of the previous
+    index_file are kept for the other files, as long as they still describe them
+    """
+    merged = {e.path: e for e in entries}
+    try:
+        previous = read_index(index_file)
+    except (OSError, IllegalZisofsFormat):
+        # No index yet, or an unusable one: it's rebuilt from entries only
+        previous = dict()
+
+    for path, entry in previous.items():
+        if path in merged:
+            continue
+        try:
+            st = os.lstat(os.path.join(tree_dir, path))
+        except OSError:
+            # Removed from the tree
+            continue
+        if lookup(previous, path, st) is not None:
+            merged[path] = entry
+
+    return list(merged.values())
@@ -1,3 +1,5 @@
+from array import array
+import sys
 
 
 def int_to_iso711(value):
@@ -43,3 +45,43 @@ def uint64_to_int(data):
         raise ValueError(f"{data} size must be 8")
 
     return int.from_bytes(data, byteorder='little', signed=False)
+
+
+def _array_typecode(itemsize):
+    for typecode in 'BHILQ':
+        if array(typecode).itemsize == itemsize:
+            return typecode
+    raise ValueError(f"No unsigned array type of {itemsize} bytes")
+
+
+def uint_array(itemsize, values=()):
+    """
+    Create an array of unsigned integers of itemsize bytes
+    """
+    return array(_array_typecode(itemsize), values)
+
+
+def bytes_to_uint_array(data, itemsize):
+    """
+    Convert a sequence of unsigned little endian values of itemsize bytes to an array, in one go
+    """
+    if len(data) % itemsize != 0:
+        raise ValueError(f"{len(data)} is not a multiple of {itemsize}")
+
+    values = uint_array(itemsize)
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+
+def uint_array_to_bytes(values, itemsize):
+    """
+    Convert an array (or any iterable) of integers to unsigned little endian values of itemsize bytes
+    """
+    if not isinstance(values, array) or values.itemsize != itemsize:
+        values = uint_array(itemsize, values)
+    if sys.byteorder != 'little':
+        values = uint_array(itemsize, values)
+        values.byteswap()
+    return values.tobytes()
@@ -0,0 +1,66 @@
+import json
+import os
+
+from mkzftree2.index import content_hasher
+from mkzftree2.utils import COPY_BUFSIZE
+
+# JSON file describing the sources of the last build of a tree:
+#   {"version": 1, "params": {compression parameters},
+#    "files": {path relative to the source dir: {"size", "mtime_ns", "ino", "digest"}}}
+# digest is the hex content hash (see mkzftree2.index) or null if unknown
+MANIFEST_VERSION = 1
+
+
+def read_manifest(manifest_file):
+    """
+    Return (params, files) of a manifest. A missing manifest is an empty one
+    """
+    try:
+        with open(manifest_file) as fin:
+            data = json.load(fin)
+    except FileNotFoundError:
+        return None, dict()
+
+    if data.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"{manifest_file}: unsupported manifest version")
+
+    return data['params'], data['files']
+
+
+def write_manifest(manifest_file, params, files):
+    """
+    Write the manifest atomically, so an interrupted run keeps the previous one
+    """
+    tmp_file = f"{manifest_file}.tmp"
+    with open(tmp_file, 'w') as fout:
+        json.dump({'version': MANIFEST_VERSION, 'params': params, 'files': files}, fout,
+                  sort_keys=True, separators=(',', ':'))
+    os.replace(tmp_file, manifest_file)
+
+
+def source_entry(st, digest=None):
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'ino': st.st_ino,
+            'digest': digest.hex() if digest is not None else None}
+
+
+def file_digest(path):
+    hasher = content_hasher()
+    with open(path, 'rb') as fin:
+        for data in iter(lambda: fin.read(COPY_BUFSIZE), b''):
+            hasher.update(data)
+    return hasher.digest()
+
+
+def is_unchanged(entry, source_file, st):
+    """
+    Whether source_file (with stat st) still has the content recorded in entry.
+    Same size, mtime and inode is trusted. Otherwise, a file of the same size whose
+    content hash is known is hashed again (e.g. it was only touched or copied back)
+    """
+    if entry is None or entry['size'] != st.st_size:
+        return False
+
+    if entry['mtime_ns'] == st.st_mtime_ns and entry['ino'] == st.st_ino:
+        return True
+
+    return entry['digest'] is not None and file_digest(source_file).hex() == entry['digest']
@@ -1,13 +1,118 @@
+from contextlib import contextmanager
 from enum import Enum
+import mmap
 import os
+import threading
 from pathlib import Path
 import math
-from mkzftree2.models.algorithm import Algorithm
-from mkzftree2.iso9660 import int_to_iso711, int_to_iso731, iso711_to_int, int_to_uint64, iso731_to_int, uint64_to_int
+from mkzftree2.models.algorithm import Algorithm, dictionary_id, tree_dictionary_name, TREE_DICT_PREFIX
+from mkzftree2.iso9660 import int_to_iso711, int_to_iso731, iso711_to_int, int_to_uint64, iso731_to_int, uint64_to_int, \
+    bytes_to_uint_array, uint_array_to_bytes
 from mkzftree2.arguments import default_block_sizes
 from mkzftree2.utils import IllegalZisofsFormat, NotCompressedFile
 
 
+# Read-only mappings shared by all the FileObjects of the same file:
+# (st_dev, st_ino, st_size, st_mtime_ns) -> [mmap, memoryview, references]
+_shared_maps = dict()
+_shared_maps_lock = threading.Lock()
+
+
+def _acquire_map(source_file):
+    st = os.stat(source_file)
+    if st.st_size == 0:
+        # Can't map an empty file, and it can't be compressed either
+        raise NotCompressedFile
+
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    with _shared_maps_lock:
+        entry = _shared_maps.get(key)
+        if entry is None:
+            with open(source_file, 'rb') as src:
+                mapping = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+            entry = _shared_maps[key] = [mapping, memoryview(mapping), 0]
+        entry[2] += 1
+
+    return key, entry[1]
+
+
+def _release_map(key):
+    with _shared_maps_lock:
+        entry = _shared_maps[key]
+        entry[2] -= 1
+        if entry[2] == 0:
+            del _shared_maps[key]
+            entry[1].release()
+            entry[0].close()
+
+
+# Tree dictionaries already loaded: (tree root, id) -> dictionary. Trees are told apart,
+# as the ids of different dictionaries may collide
+_tree_dictionaries = dict()
+# Where the tree dictionaries were found: (directory of a file, id) -> tree root
+_tree_dictionary_roots = dict()
+
+
+def tree_dictionary_file_id(path):
+    """
+    Return the id of the tree dictionary stored in path, or None if it's not one: a file
+    named after the id of its content (see save_tree_dictionary)
+    """
+    name = Path(path).name
+    if not name.startswith(TREE_DICT_PREFIX):
+        return None
+    try:
+        dict_id = int(name[len(TREE_DICT_PREFIX):], 16)
+        if name != tree_dictionary_name(dict_id) or not Path(path).is_file():
+            return None
+        with open(path, 'rb') as fin:
+            return dict_id if dictionary_id(fin.read()) == dict_id else None
+    except (ValueError, OSError):
+        return None
+
+
+def find_tree_dictionary(source_file, dict_id):
+    """
+    Return the tree dictionary dict_id used by source_file. It's searched in the parents
+    of the file, as it's stored once at the root of the tree
+    """
+    parents = Path(source_file).absolute().parents
+    root = _tree_dictionary_roots.get((parents[0], dict_id))
+    if root is None:
+        name = tree_dictionary_name(dict_id)
+        for parent in parents:
+            if (parent / name).is_file():
+                root = parent
+                break
+        else:
+            raise IllegalZisofsFormat(f"Dictionary {name} of {source_file} not found")
+        _tree_dictionary_roots[(parents[0], dict_id)] = root
+
+    dictionary = _tree_dictionaries.get((root, dict_id))
+    if dictionary is None:
+        dict_file = root / tree_dictionary_name(dict_id)
+        dictionary = dict_file.read_bytes()
+        if dictionary_id(dictionary) != dict_id:
+            raise IllegalZisofsFormat(f"Dictionary {dict_file} is corrupted")
+        _tree_dictionaries[(root, dict_id)] = dictionary
+
+    return dictionary
+
+
+def _fd_seek(fd, offset):
+    if type(fd) == int:
+        return os.lseek(fd, offset, os.SEEK_SET)
+    else:
+        return fd.seek(offset)
+
+
+def _fd_read(fd, length):
+    if type(fd) == int:
+        return os.read(fd, length)
+    else:
+        return fd.read(length)
+
+
 class commonZisofs:
     blocksize = None  # Block size
     hdr_size = None
@@ -124,6 +229,7 @@ class ZISOFSv2(commonZisofs):
     hdr_size = int_to_iso711(6)  # 24 bytes size
     alg_id = None
     size = None
+    dict_id = bytes(4)
 
     # Array
     pointers_size = 8
@@ -165,6 +271,9 @@ class ZISOFSv2(commonZisofs):
         # File size
         zisofs_obj.size = header[12:20]
 
+        # Id of the tree dictionary, 0 if none
+        zisofs_obj.dict_id = header[20:24]
+
         return zisofs_obj
 
     def set_size(self, size):
@@ -205,56 +314,133 @@ class ZISOFSv2(commonZisofs):
         header.extend(self.alg_id)  # 1
         header.extend(self.blocksize)  # 1
         header.extend(self.size)  # 8
-        header.extend(bytearray(4))  # 4
+        header.extend(self.dict_id)  # 4
 
         return bytes(header)
 
+    def set_dictionary_id(self, dict_id):
+        """
+        Refer to a dictionary stored at the root of the tree, instead of inside the file
+        """
+        self.dict_id = dict_id.to_bytes(4, 'little')
+
+    def get_dictionary_id(self):
+        return int.from_bytes(self.dict_id, 'little')
+
 
 class FileObject:
 
     header = None
+    dictionary = None  # Only used by compressors with a shared dictionary
+    pointers = None  # Pointers table, loaded on first use
+    mapping = None  # memoryview of the whole file, when it's memory-mapped
+    _mapping_key = None
     # Instance functions
 
-    def __init__(self, source_file, alg=None, blocksize=None, isLegacy=None):
+    def __init__(self, source_file, alg=None, blocksize=None, isLegacy=None, size=None, use_mmap=False):
+        """
+        Parse the header of source_file, or prepare a new header if alg, blocksize and isLegacy
+        are given. size allows to create a header without source file (e.g. for streams).
+        With use_mmap, an existing file is read through a shared read-only mapping, so
+        reads don't need any syscall nor copy. Call close() to release it
+        """
 
-        if Path(source_file).is_dir():
+        if source_file is not None and Path(source_file).is_dir():
             raise NotCompressedFile
 
         self.source_file = source_file
 
         if all(v is not None for v in [alg, blocksize, isLegacy]):
+            if size is None:
+                size = self.source_file.stat().st_size
+
             if isLegacy:
                 self.header = ZISOFS()
-                self.header.set_size(self.source_file.stat().st_size)
+                self.header.set_size(size)
                 self.header.set_blocksize(blocksize)
 
             else:
                 self.header = ZISOFSv2()
-                self.header.set_size(self.source_file.stat().st_size)
+                self.header.set_size(size)
                 self.header.set_blocksize(blocksize)
                 self.header.set_alg(alg)
         else:
-            with open(self.source_file, 'rb') as in_fd:
-                header = in_fd.read(32)
+            if use_mmap:
+                self._mapping_key, self.mapping = _acquire_map(self.source_file)
+                header = bytes(self.mapping[0:32])
+            else:
+                with open(self.source_file, 'rb') as in_fd:
+                    header = in_fd.read(32)
 
             try:
-                hdr_obj = ZISOFSv2.from_header(header)
-            except NotCompressedFile:
-                # Maybe a v1 ziso?
-                hdr_obj = ZISOFS.from_header(header)
+                try:
+                    hdr_obj = ZISOFSv2.from_header(header)
+                except NotCompressedFile:
+                    # Maybe a v1 ziso?
+                    hdr_obj = ZISOFS.from_header(header)
+            except Exception:
+                self.close()
+                raise
 
             self.header = hdr_obj
 
+    def close(self):
+        """
+        Release the memory mapping, if any
+        """
+        if self._mapping_key is not None:
+            self.mapping = None
+            _release_map(self._mapping_key)
+            self._mapping_key = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @contextmanager
+    def _open_source(self, file_descriptor=None):
+        """
+        Yield the file descriptor to read from: the given one, or a new one closed at the end.
+        Nothing is opened if the file is memory-mapped
+        """
+        if file_descriptor or self.mapping is not None:
+            yield file_descriptor
+        else:
+            with open(self.source_file, 'rb') as src:
+                yield src
+
+    def _read_at(self, src, offset, length):
+        """
+        Read length bytes at offset. From a mapped file, a memoryview is returned without any copy
+        """
+        if self.mapping is not None:
+            return self.mapping[offset:offset+length]
+
+        if type(src) == int and hasattr(os, 'pread'):
+            # Doesn't move the shared file offset, so concurrent readers are safe
+            return os.pread(src, length, offset)
+
+        _fd_seek(src, offset)
+        return _fd_read(src, length)
+
     def get_size(self):
         return self.header.get_size()
 
-    def get_chunks(self):
+    def get_chunks(self, sparse=False):
         """
-        docstring
+        Generator of all the uncompressed blocks. If sparse, zero blocks are not
+        materialised and None is returned instead
         """
 
-        with open(self.source_file, 'rb') as src:
+        with self._open_source() as src:
             for i in range(0, self._get_numblocks() - 1):
+                if sparse:
+                    pointers = self.get_pointers(src)
+                    if pointers[i] == pointers[i+1]:
+                        yield None
+                        continue
                 yield self.read_block(i, file_descriptor=src)
 
     # Random access to data
@@ -264,65 +450,116 @@ class FileObject:
         """
         return self.header.get_algorithm()
 
-    def read_block(self, num, count=1, file_descriptor=None):
-        def fd_seek(fd, offset):
-            if type(fd) == int:
-                return os.lseek(fd, offset, os.SEEK_SET)
-            else:
-                return fd.seek(offset)
+    def get_dictionary_offset(self):
+        """
+        The dictionary (if any) is stored just after the pointers table
+        """
+        return len(self.header) + self._get_numblocks() * self.header.pointers_size
 
-        def fd_read(fd, length):
-            if type(fd) == int:
-                return os.read(fd, length)
-            else:
-                return fd.read(length)
+    def get_dictionary(self, file_descriptor=None):
+        """
+        Return the dictionary shared by all the blocks, or None if the compressor doesn't use it.
+        It fills the gap between the pointers table and the first block, unless the header
+        refers to a tree dictionary
+        """
+        if not self.get_algorithm().uses_dictionary():
+            return None
+
+        if self.dictionary is None and self.header.get_dictionary_id():
+            self.dictionary = find_tree_dictionary(self.source_file, self.header.get_dictionary_id())
+
+        if self.dictionary is None:
+            start = self.get_dictionary_offset()
+            with self._open_source(file_descriptor) as src:
+                end = self.get_pointers(src)[0]
+                # Must be bytes: it identifies the codec context
+                self.dictionary = bytes(self._read_at(src, start, end - start))
+
+        return self.dictionary
 
+    def read_block(self, num, count=1, file_descriptor=None):
         valid_blocks = self._get_numblocks() - 1
 
         if num >= valid_blocks:
             return b''
 
-        psize = self.header.pointers_size  # Pointer size
-
         # Reuse file descriptor if is given
-        if file_descriptor:
-            src = file_descriptor
-        else:
-            src = open(self.source_file, 'rb')
+        with self._open_source(file_descriptor) as src:
+            dictionary = self.get_dictionary(src)
+
+            # First, get the position and size of the desired blocks
+            list_offset = self.get_pointers(src)[num:num+count+1]
+
+            # Go to the actual data
+            data = []
+            for idx, offset in enumerate(list_offset[:-1]):
+                total = list_offset[idx+1] - offset
+                if (total) != 0:
+                    data.append(self.get_algorithm().data_decompress(
+                        self._read_at(src, offset, total), dictionary
+                    ))
+                else:
+                    # Empty block. Must return all zero
+                    if num + idx == valid_blocks - 1:  # Last one
+                        # Last block will have different size
+                        si = self.header.get_size() - self.header.get_blocksize() * (valid_blocks-1)
+                        data.append(bytes(si))
+                    else:
+                        data.append(bytes(self.header.get_blocksize()))
 
-        # First, get the position and size of the desired block
-        table_pos = len(self.header) + num * psize
-        # Go to the table
-        fd_seek(src, table_pos)
+        # A single block is returned as is, without copy
+        return data[0] if len(data) == 1 else b''.join(data)
 
-        list_offset = []
-        for _ in range(count+1):
-            list_offset.append(self.header.get_pointer_value(fd_read(src, psize)))
+    def read_range(self, offset, length, file_descriptor=None, block_reader=None):
+        """
+        Return up to length bytes of uncompressed data from offset. Only the blocks
+        covering the range are decompressed. block_reader(num) can provide the
+        decompressed blocks instead of read_block (e.g. from a cache)
+        """
+        end = min(self.get_size(), offset + length)
+        if offset >= end:
+            return b''
 
-        # Go to the actual data
-        data = bytearray()
-        for idx, offset in enumerate(list_offset[:-1]):
-            total = list_offset[idx+1] - offset
-            if (total) != 0: # TODO: Improve list access?
-                fd_seek(src, offset)
-                data += self.get_algorithm().data_decompress(
-                    fd_read(src, total)
-                )
-            else:
-                # Empty block. Must return all zero
-                if num == valid_blocks - 1:  # Last one
-                    # Last block will have different size
-                    si = self.header.get_size() - self.header.get_blocksize() * (valid_blocks-1)
-                    data += bytearray(si)
-                else:
-                    data += bytearray(self.header.get_blocksize())
+        if block_reader is None:
+            def block_reader(num):
+                return self.read_block(num, file_descriptor=file_descriptor)
+
+        blocksize = self.header.get_blocksize()
+        first = offset // blocksize
+        last = (end - 1) // blocksize
 
-        if not file_descriptor:
-            # It was our file descriptor. Close it
-            src.close()
+        if first == last:
+            block = block_reader(first)
+            start = offset - first * blocksize
+            if start == 0 and end - offset == len(block):
+                return block
+            return bytes(memoryview(block)[start:start + end - offset])
+
+        data = bytearray()
+        for num in range(first, last + 1):
+            block = memoryview(block_reader(num))
+            block_start = num * blocksize
+            data += block[max(offset, block_start) - block_start:min(end, block_start + len(block)) - block_start]
 
         return data
 
+    def get_pointers(self, file_descriptor=None):
+        """
+        Return the pointers table as an array. It is read and decoded in one go the first
+        time, then cached
+        """
+        if self.pointers is None:
+            psize = self.header.pointers_size  # Pointer size
+            with self._open_source(file_descriptor) as src:
+                data = self._read_at(src, len(self.header), self._get_numblocks() * psize)
+
+            if len(data) != self._get_numblocks() * psize:
+                raise IllegalZisofsFormat("Truncated pointers table")
+
+            self.pointers = bytes_to_uint_array(data, psize)
+
+        return self.pointers
+
     def _get_numblocks(self):
         """
         docstring
@@ -345,18 +582,6 @@ class FileObject:
                 raise ValueError(
                     "Number of precalculated pointers doesn't correspond to final pointers table")
 
-            data = bytearray()
-
-            for addr in list_pointers:
-                if type(self.header) is ZISOFS:
-                    data.extend(int_to_iso731(addr))
-                else:
-                    data.extend(int_to_uint64(addr))
-
-            if len(data) != nblocks * self.header.pointers_size:
-                raise ValueError(
-                    "Number of precalculated pointers doesn't correspond to final pointers table")
-
-            return bytes(data)
+            return uint_array_to_bytes(list_pointers, self.header.pointers_size)
 
         return bytes(nblocks * self.header.pointers_size)
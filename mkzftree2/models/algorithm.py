@@ -1,4 +1,7 @@
 from enum import Enum
+from functools import partial
+import hashlib
+import threading
 
 import zlib
 import bz2
@@ -6,12 +9,66 @@ import lzma
 import lz4.frame
 import zstandard as zstd
 
+# Codec contexts are not thread safe, so every thread keeps its own cache
+_thread_local = threading.local()
+
+# Dictionaries are usually per file. Keep only the most recent ones in the cache
+MAX_DICT_CONTEXTS = 8
+
+# Default size of trained dictionaries
+DICT_SIZE = 2**16
+
+# Smaller files are not worth a dictionary of their own: it would cost more than it saves
+DICT_MIN_FILE_SIZE = 4 * DICT_SIZE
+
+# A dictionary shared by the files of a tree is stored once, in the file of the tree root
+# named TREE_DICT_PREFIX + its id in hex. The headers of the files refer to it by id
+TREE_DICT_PREFIX = '.zfdict-'
+
+
+class CodecContext:
+    """
+    Compressor/decompressor pair for an algorithm and level, ready to be reused
+    across blocks and files. zstd keeps real compression contexts; the other
+    codecs only expose one-shot functions, so their parameters are bound once
+    """
+
+    def __init__(self, algorithm, preset=None, dictionary=None):
+        if algorithm == Algorithm.ZLIB:
+            self.compress = partial(zlib.compress, level=preset)
+            self.decompress = zlib.decompress
+        elif algorithm == Algorithm.XZ:
+            self.compress = partial(lzma.compress, preset=preset)
+            self.decompress = lzma.decompress
+        elif algorithm == Algorithm.LZ4:
+            self.compress = partial(lz4.frame.compress, compression_level=preset)
+            self.decompress = lz4.frame.decompress
+        elif algorithm == Algorithm.ZSTD:
+            if preset is not None:
+                self.compress = zstd.ZstdCompressor(level=preset).compress
+            self.decompress = zstd.ZstdDecompressor().decompress
+        elif algorithm == Algorithm.BZIP2:
+            self.compress = partial(bz2.compress, compresslevel=preset)
+            self.decompress = bz2.decompress
+        elif algorithm == Algorithm.ZSTD_DICT:
+            if dictionary is None:
+                raise ValueError(f"{algorithm} requires a dictionary")
+            # Trained dictionaries are detected by their magic, anything else is raw content
+            dict_data = zstd.ZstdCompressionDict(dictionary)
+            if preset is not None:
+                self.compress = zstd.ZstdCompressor(level=preset, dict_data=dict_data).compress
+            self.decompress = zstd.ZstdDecompressor(dict_data=dict_data).decompress
+        else:
+            raise NotImplementedError(f"{algorithm} compressor not supported")
+
+
 class Algorithm(Enum):
     ZLIB = 1
     XZ = 2
     LZ4 = 3
     ZSTD = 4
     BZIP2 = 5
+    ZSTD_DICT = 6  # Experimental: zstd with a dictionary shared by all blocks
 
     @classmethod
     def from_arg(cls, value):
@@ -21,30 +78,60 @@ class Algorithm(Enum):
     def list_all(cls):
         return [ i[0].lower() for i in cls.__members__.items() ]
 
-    def data_decompress(self, chunk):
-        if self == Algorithm.ZLIB:
-            return zlib.decompress(chunk)
-        elif self == Algorithm.XZ:
-            return lzma.decompress(chunk)
-        elif self == Algorithm.LZ4:
-            return lz4.frame.decompress(chunk)
-        elif self == Algorithm.ZSTD:
-            return zstd.ZstdDecompressor().decompress(chunk)
-        elif self == Algorithm.BZIP2:
-            return bz2.decompress(chunk)
-        else:
-            raise NotImplementedError(f"{self} compressor not supported")
-
-    def data_compress(self, chunk, preset):
-        if self == Algorithm.ZLIB:
-            return zlib.compress(chunk, level=preset)
-        elif self == Algorithm.XZ:
-            return lzma.compress(chunk, preset=preset)
-        elif self == Algorithm.LZ4:
-            return lz4.frame.compress(chunk, compression_level=preset)
-        elif self == Algorithm.ZSTD:
-            return zstd.ZstdCompressor(level=preset).compress(chunk)
-        elif self == Algorithm.BZIP2:
-            return bz2.compress(chunk, compresslevel=preset)
-        else:
-            raise NotImplementedError(f"{self} compressor not supported")
\ No newline at end of file
+    def uses_dictionary(self):
+        return self == Algorithm.ZSTD_DICT
+
+    def get_context(self, preset=None, dictionary=None):
+        """
+        Return the CodecContext of the current thread for this algorithm, level
+        and dictionary. Decompression doesn't depend on the level, so it uses preset=None
+        """
+        try:
+            contexts = _thread_local.contexts
+        except AttributeError:
+            contexts = _thread_local.contexts = {}
+
+        key = (self, preset, dictionary)
+        context = contexts.get(key)
+        if context is None:
+            if dictionary is not None:
+                dict_keys = [k for k in contexts if k[2] is not None]
+                if len(dict_keys) >= MAX_DICT_CONTEXTS:
+                    del contexts[dict_keys[0]]  # Oldest one
+            context = contexts[key] = CodecContext(self, preset, dictionary)
+        return context
+
+    def data_decompress(self, chunk, dictionary=None):
+        return self.get_context(dictionary=dictionary).decompress(chunk)
+
+    def data_compress(self, chunk, preset, dictionary=None):
+        return self.get_context(preset, dictionary).compress(chunk)
+
+
+def train_dictionary(samples, dict_size=DICT_SIZE):
+    """
+    Train a zstd dictionary from a list of sample blocks (zero blocks are ignored). If there are not enough
+    samples to train, the samples themselves are used as raw content dictionary
+    """
+    samples = [s for s in samples if s != bytes(len(s))]
+    if dict_size <= 0 or not samples:
+        return b''
+
+    # zstd trains better with many small samples than with a few big blocks
+    pieces = [block[i:i+4096] for block in samples for i in range(0, len(block), 4096)]
+    try:
+        return zstd.train_dictionary(dict_size, pieces).as_bytes()
+    except zstd.ZstdError:
+        raw_content = b''.join(samples)
+        return raw_content[max(0, len(raw_content) - dict_size):]
+
+
+def dictionary_id(dictionary):
+    """
+    Non zero 32 bit id of a dictionary, derived from its content
+    """
+    return int.from_bytes(hashlib.blake2b(dictionary, digest_size=4).digest(), 'little') or 1
+
+
+def tree_dictionary_name(dict_id):
+    return f"{TREE_DICT_PREFIX}{dict_id:08x}"
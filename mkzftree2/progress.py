@@ -0,0 +1,94 @@
+import sys
+import time
+
+from mkzftree2.utils import sizeof_fmt
+
+
+def _format_time(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    """
+    Overall progress of a run: files and bytes done, current throughput and ETA.
+    It's only redrawn every interval seconds, so updating it costs nothing per file.
+    On a terminal the line is updated in place. Otherwise (e.g. a log file) a new line
+    is written every log_interval seconds
+    """
+
+    def __init__(self, total_files, total_bytes, stream=None, interval=0.2, log_interval=30, enabled=True):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files = 0
+        self.bytes = 0
+
+        self.stream = stream if stream is not None else sys.stderr
+        self.enabled = enabled
+        self.tty = self.stream.isatty()
+        self.interval = interval if self.tty else log_interval
+
+        self.start = time.monotonic()
+        self._last_draw = self.start
+        self._last_bytes = 0
+        self._rate = None  # Smoothed bytes/s
+        self._drawn = False  # A status line is on the terminal
+
+    def update(self, nbytes, files=1):
+        self.files += files
+        self.bytes += nbytes
+
+        now = time.monotonic()
+        if self.enabled and now - self._last_draw >= self.interval:
+            self._measure(now)
+            self._draw()
+
+    def _measure(self, now):
+        rate = (self.bytes - self._last_bytes) / (now - self._last_draw)
+        # Smooth the throughput, so the ETA doesn't jump with every big or small file
+        self._rate = rate if self._rate is None else 0.3 * rate + 0.7 * self._rate
+        self._last_draw = now
+        self._last_bytes = self.bytes
+
+    def status(self):
+        line = (f"{self.files}/{self.total_files} files, "
+                f"{sizeof_fmt(self.bytes)}/{sizeof_fmt(self.total_bytes)}")
+
+        if self._rate is not None:
+            line += f", {self._rate / 1e6:.1f} MB/s"
+            if self._rate > 0 and self.bytes < self.total_bytes:
+                line += f", ETA {_format_time((self.total_bytes - self.bytes) / self._rate)}"
+        return line
+
+    def _draw(self):
+        if self.tty:
+            self.stream.write(f"\r\x1b[K{self.status()}")
+            self._drawn = True
+        else:
+            self.stream.write(f"{self.status()}\n")
+        self.stream.flush()
+
+    def write(self, line):
+        """
+        Print a line on stdout without mixing it with the status line
+        """
+        if self._drawn:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+            self._drawn = False
+        print(line)
+
+    def close(self):
+        """
+        Final status: the elapsed time and the average throughput
+        """
+        if not self.enabled:
+            return
+
+        elapsed = time.monotonic() - self.start
+        if self._drawn:
+            self.stream.write("\r\x1b[K")
+        self.stream.write(f"{self.files}/{self.total_files} files, {sizeof_fmt(self.bytes)} "
+                          f"in {_format_time(elapsed)} ({self.bytes / max(elapsed, 1e-9) / 1e6:.1f} MB/s)\n")
+        self.stream.flush()
+        self._drawn = False
@@ -0,0 +1,190 @@
+from collections import Counter, defaultdict
+import heapq
+import json
+import os
+import threading
+import time
+
+# CPU time of the calling thread. Stages run concurrently in several threads
+_thread_cpu = getattr(time, 'thread_time', time.process_time)
+
+
+class _Stage:
+    __slots__ = ('stats', 'name', 'wall', 'cpu')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = _thread_cpu()
+
+    def __exit__(self, *args):
+        self.stats.add_stage(self.name, time.perf_counter() - self.wall, _thread_cpu() - self.cpu)
+
+
+class StageStats:
+    """
+    Wall and CPU time spent in each stage of the work (read, compress, write...), and
+    counters (bytes read, zero blocks...). It's thread safe, and its content can be sent
+    between processes with as_dict() and merge()
+    """
+
+    def __init__(self):
+        self.stages = defaultdict(lambda: [0.0, 0.0, 0])  # name -> [wall, cpu, calls]
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        Context manager timing the code of a stage
+        """
+        return _Stage(self, name)
+
+    def add_stage(self, name, wall, cpu, calls=1):
+        with self._lock:
+            stage = self.stages[name]
+            stage[0] += wall
+            stage[1] += cpu
+            stage[2] += calls
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'stages': {name: {'wall': wall, 'cpu': cpu, 'calls': calls}
+                           for name, (wall, cpu, calls) in self.stages.items()},
+                'counters': dict(self.counters),
+            }
+
+    def merge(self, data):
+        """
+        Add the content of another StageStats, given as as_dict()
+        """
+        for name, stage in data['stages'].items():
+            self.add_stage(name, stage['wall'], stage['cpu'], stage['calls'])
+        for name, value in data['counters'].items():
+            self.count(name, value)
+
+
+class _NullStats(StageStats):
+    """
+    Records nothing, for runs without statistics
+    """
+    _null_stage = type('_NullStage', (), {'__enter__': lambda self: None,
+                                          '__exit__': lambda self, *args: None})()
+
+    def stage(self, name):
+        return self._null_stage
+
+    def add_stage(self, name, wall, cpu, calls=1):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+
+NO_STATS = _NullStats()
+
+
+class Hooks:
+    """
+    Callbacks of process_files, called in the main process. Subclass it and override
+    what's needed: every method does nothing by default
+    """
+
+    def file_done(self, result, stats):
+        """
+        A file was processed. result is its FileResult; stats its StageStats as a dict,
+        or None if it wasn't compressed in this run
+        """
+
+    def run_done(self, results, stats):
+        """
+        End of the run. results are the FileResults, or the exceptions of the failed files;
+        stats the StageStats (as a dict) of the work done in the main process
+        """
+
+
+class RunStats(Hooks):
+    """
+    Hooks that collect the statistics of a whole run, reported by report()
+    """
+
+    def __init__(self, slowest=10):
+        self.stages = StageStats()
+        self.statuses = Counter()
+        self.algorithms = defaultdict(lambda: {'files': 0, 'in': 0, 'out': 0})
+        self.slowest = []  # Heap of (seconds, path)
+        self.max_slowest = slowest
+        self.failed = 0
+
+        self._start_wall = time.perf_counter()
+        self._start_cpu = os.times()
+        self.wall = None
+        self.cpu = None
+
+    def file_done(self, result, stats):
+        self.statuses[result.status] += 1
+        if stats is not None:
+            self.stages.merge(stats)
+
+        if result.status in ('compressed', 'stored'):
+            algorithm = self.algorithms[result.algorithm or 'stored']
+            algorithm['files'] += 1
+            algorithm['in'] += result.osize
+            algorithm['out'] += result.csize
+
+        if result.elapsed:
+            heapq.heappush(self.slowest, (result.elapsed, str(result.source), result.osize))
+            if len(self.slowest) > self.max_slowest:
+                heapq.heappop(self.slowest)
+
+    def run_done(self, results, stats):
+        self.stages.merge(stats)
+        self.failed = sum(isinstance(r, Exception) for r in results)
+
+        self.wall = time.perf_counter() - self._start_wall
+        end = os.times()
+        # Children are the workers of a process pool
+        self.cpu = {
+            'user': end.user - self._start_cpu.user + end.children_user - self._start_cpu.children_user,
+            'system': end.system - self._start_cpu.system + end.children_system - self._start_cpu.children_system,
+        }
+
+    def report(self):
+        stages = self.stages.as_dict()
+        counters = stages['counters']
+        return {
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'files': dict(self.statuses, failed=self.failed),
+            'bytes': {
+                'in': sum(a['in'] for a in self.algorithms.values()),
+                'out': sum(a['out'] for a in self.algorithms.values()),
+                'per_algorithm': dict(self.algorithms),
+            },
+            'blocks': {
+                'total': counters.get('blocks', 0),
+                'zero': counters.get('zero_blocks', 0),
+            },
+            'stages': stages['stages'],
+            'counters': counters,
+            'slowest': [{'path': path, 'seconds': seconds, 'size': size}
+                        for seconds, path, size in sorted(self.slowest, reverse=True)],
+        }
+
+    def write(self, path):
+        """
+        Write the report as JSON to path, or to stdout if it's -
+        """
+        data = json.dumps(self.report(), indent=1, sort_keys=True)
+        if str(path) == '-':
+            print(data)
+        else:
+            with open(path, 'w') as fout:
+                fout.write(data + '\n')
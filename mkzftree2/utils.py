@@ -1,5 +1,17 @@
+import errno
 import os
 import platform
+import shutil
+
+# ioctl to share the extents of a file (reflink) on btrfs, xfs...
+FICLONE = 0x40049409
+
+# Buffer size of the portable copy
+COPY_BUFSIZE = 2**20
+
+# Errors meaning that a kernel copy method can't be used between these files
+_COPY_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                     errno.ENOTTY, errno.EBADF, errno.EPERM, errno.ENOTSUP}
 
 class IllegalArgumentError(ValueError):
     pass
@@ -10,6 +22,14 @@ class NotCompressedFile(ValueError):
 class IllegalZisofsFormat(ValueError):
     pass
 
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['', ' Ki', ' Mi', ' Gi', ' Ti', ' Pi', ' Ei', ' Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+
 def clone_attributes(input_file, output_file):
     """
     Try to clone system attributes from input_file to output_file
@@ -43,6 +63,75 @@ def clone_attributes(input_file, output_file):
 
 
 
+def copy_file_data(src, dst):
+    """
+    Copy the whole content of the open file src into the empty open file dst.
+    On Linux the data doesn't go through Python: try a reflink (FICLONE), then
+    copy_file_range and sendfile. Otherwise, copy in fixed size buffers
+    """
+    dst.flush()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    size = os.fstat(src_fd).st_size
+    copied = 0
+
+    if platform.system() == 'Linux':
+        try:
+            import fcntl
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            copied = size
+        except OSError as ex:
+            if ex.errno not in _COPY_UNSUPPORTED:
+                raise
+
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    done = os.copy_file_range(src_fd, dst_fd, size - copied,
+                                              offset_src=copied, offset_dst=copied)
+                    if done == 0:
+                        break
+                    copied += done
+            except OSError as ex:
+                if ex.errno not in _COPY_UNSUPPORTED:
+                    raise
+
+        try:
+            os.lseek(dst_fd, copied, os.SEEK_SET)
+            while copied < size:
+                done = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if done == 0:
+                    break
+                copied += done
+        except OSError as ex:
+            if ex.errno not in _COPY_UNSUPPORTED:
+                raise
+
+    # Portable path, or whatever is left (e.g. the file grew)
+    src.seek(copied)
+    dst.seek(copied)
+    shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+
+def reflink_file(src_path, dst_path):
+    """
+    Create dst_path sharing the data extents of src_path (btrfs, xfs...), without copying
+    anything. Returns False, leaving nothing behind, if the file system can't do it
+    """
+    if platform.system() != 'Linux':
+        return False
+
+    import fcntl
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return True
+        except OSError as ex:
+            if ex.errno not in _COPY_UNSUPPORTED:
+                raise
+    os.unlink(dst_path)
+    return False
+
+
 def clone_dir_attributes(input_dir, output_dir):
     """
     Clone recursively directory attributes
@@ -11,14 +11,10 @@ Caveats:
  * Block size (st_blksize) and number of allocated blocks (st_blocks) are not
    passed through.
 
- * Performance for large directories is not good, because the directory
-   is always read completely.
-
  * There may be a way to break-out of the directory tree.
 
- * The readdir implementation is not fully POSIX compliant. If a directory
-   contains hardlinks and is modified during a readdir call, readdir()
-   may return some of the hardlinked files twice or omit them completely.
+ * readdir returns a snapshot of the directory taken by opendir. Entries
+   created or removed later are not seen until the directory is reopened.
 
  * If you delete or rename files in the underlying file system, the
    passthrough file system will get confused.
@@ -41,8 +37,12 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import faulthandler
 from mkzftree2.utils import NotCompressedFile
-from mkzftree2.models.FileObject import FileObject
-import math
+from mkzftree2.models.FileObject import FileObject, ZISOFS, tree_dictionary_file_id
+from mkzftree2.cache import BlockCache, Readahead, MetadataCache
+from mkzftree2.index import read_index, lookup as index_lookup
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from itertools import count
 from collections import deque
 import trio
 from collections import defaultdict
@@ -68,13 +68,43 @@ faulthandler.enable()
 
 log = logging.getLogger(__name__)
 
+# Directory entries whose attributes are fetched at once by readdir
+READDIR_BATCH = 64
+
 
 class Operations(pyfuse3.Operations):
 
     enable_writeback_cache = True
 
-    def __init__(self, source):
+    def __init__(self, source, use_mmap=False, cache_size=64 * 2**20, readahead=32, threads=None,
+                 attr_timeout=1, entry_timeout=1, index=None):
         super().__init__()
+        self._use_mmap = use_mmap
+        self._source = source
+
+        # Entries of a tree index (see mkzftree2.index), path -> IndexEntry
+        self._index = index
+
+        # Uncompressed sizes, so headers are not parsed again on each getattr
+        self._metadata_cache = MetadataCache()
+        self._attr_timeout = attr_timeout
+        self._entry_timeout = entry_timeout
+
+        # Decompressed blocks shared by all the open handles
+        self._block_cache = BlockCache(cache_size) if cache_size else None
+
+        # Prefetched blocks are stored in the block cache. Readahead needs a thread of its own
+        threads = threads or os.cpu_count()
+        self._readahead = readahead if self._block_cache is not None and threads > 1 else 0
+
+        # Block I/O and decompression run in worker threads (codecs release the GIL),
+        # so a slow block doesn't stall the main loop. The threads are split between
+        # reads and prefetches, so no more than threads blocks are decompressed at once
+        prefetch_threads = threads // 2 if self._readahead else 0
+        self._read_limiter = trio.CapacityLimiter(threads - prefetch_threads)
+        self._readahead_map = dict()  # fd -> Readahead
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=prefetch_threads) if self._readahead else None
+        self._prefetch_futures = defaultdict(dict)  # fd -> {num: Future}
         self._inode_path_map = {pyfuse3.ROOT_INODE: source}
         self._lookup_cnt = defaultdict(lambda: 0)
         self._fd_inode_map = dict()
@@ -84,6 +114,9 @@ class Operations(pyfuse3.Operations):
         self._fileobject_map = dict()
         self._fileobject_path_map = dict()
 
+        self._dir_fh = count(1)
+        self._dir_snapshots = dict()  # fh -> (path, [names])
+
     def _inode_to_path(self, inode):
         try:
             val = self._inode_path_map[inode]
@@ -150,14 +183,14 @@ class Operations(pyfuse3.Operations):
                 stat = os.fstat(fd)
                 inode = self._fd_inode_map[fd]
                 t_path = self._inode_to_path(inode)
-
-            try:
-                total_size = FileObject(t_path).header.get_size()
-            except Exception as ex:
-                log.debug(f"{ex}")
         except OSError as exc:
             raise FUSEError(exc.errno)
 
+        if stat_m.S_ISREG(stat.st_mode):
+            total_size = self._indexed_size(t_path, stat)
+            if total_size is None:
+                total_size = self._metadata_cache.get_size(stat, partial(self._uncompressed_size, t_path, stat))
+
         entry = pyfuse3.EntryAttributes()
         for attr in ('st_ino', 'st_mode', 'st_nlink', 'st_uid', 'st_gid',
                      'st_rdev', 'st_size', 'st_atime_ns', 'st_mtime_ns',
@@ -165,18 +198,43 @@ class Operations(pyfuse3.Operations):
             setattr(entry, attr, getattr(stat, attr))
 
         # Correct file size if is compressed
-        if total_size:
+        if total_size is not None:
             entry.st_size = total_size
 
         entry.generation = 0
-        entry.entry_timeout = 0
-        entry.attr_timeout = 0
+        entry.entry_timeout = self._entry_timeout
+        entry.attr_timeout = self._attr_timeout
         entry.st_blksize = 512
         entry.st_blocks = (
             (entry.st_size+entry.st_blksize-1) // entry.st_blksize)
 
         return entry
 
+    def _indexed_size(self, path, stat):
+        """
+        Uncompressed size of a regular file according to the tree index, or None if not indexed
+        """
+        if not self._index or not path.startswith(self._source + os.sep):
+            return None
+
+        entry = index_lookup(self._index, path[len(self._source) + 1:], stat)
+        return entry.size if entry is not None else None
+
+    @staticmethod
+    def _uncompressed_size(path, stat):
+        """
+        Uncompressed size of a regular file, or None if it is not compressed
+        """
+        if stat.st_size < len(ZISOFS()):
+            # Too small to even hold a header
+            return None
+
+        try:
+            return FileObject(path).header.get_size()
+        except Exception as ex:
+            log.debug(f"{ex}")
+            return None
+
     async def readlink(self, inode, ctx):
         path = self._inode_to_path(inode)
         try:
@@ -186,33 +244,53 @@ class Operations(pyfuse3.Operations):
         return fsencode(target)
 
     async def opendir(self, inode, ctx):
-        return inode
-
-    async def readdir(self, inode, off, token):
+        # Snapshot the entries once, so every continuation of readdir is cheap
         path = self._inode_to_path(inode)
-        log.debug('reading %s', path)
-        entries = []
-        for name in os.listdir(path):
-            if name == '.' or name == '..':
-                continue
-            attr = self._getattr(path=os.path.join(path, name))
-            entries.append((attr.st_ino, name, attr))
-
-        log.debug('read %d entries, starting at %d', len(entries), off)
-
-        # This is not fully posix compatible. If there are hardlinks
-        # (two names with the same inode), we don't have a unique
-        # offset to start in between them. Note that we cannot simply
-        # count entries, because then we would skip over entries
-        # (or return them more than once) if the number of directory
-        # entries changes between two calls to readdir().
-        for (ino, name, attr) in sorted(entries):
-            if ino <= off:
-                continue
-            if not pyfuse3.readdir_reply(
-                    token, fsencode(name), attr, ino):
-                break
-            self._add_path(attr.st_ino, os.path.join(path, name))
+        try:
+            with os.scandir(path) as it:
+                names = [entry.name for entry in it]
+            if inode == pyfuse3.ROOT_INODE:
+                # Tree dictionaries are not part of the content
+                names = [name for name in names
+                         if tree_dictionary_file_id(os.path.join(path, name)) is None]
+        except OSError as exc:
+            raise FUSEError(exc.errno)
+
+        fh = next(self._dir_fh)
+        self._dir_snapshots[fh] = (path, names)
+        return fh
+
+    async def readdir(self, fh, off, token):
+        path, names = self._dir_snapshots[fh]
+        log.debug('reading %s, starting at %d', path, off)
+
+        # Offsets are positions in the snapshot. Attributes (and so uncompressed sizes)
+        # are only fetched for the entries being returned, a batch at a time
+        while off < len(names):
+            batch = names[off:off + READDIR_BATCH]
+            attrs = await trio.to_thread.run_sync(self._batch_getattr, path, batch,
+                                                  limiter=self._read_limiter)
+            for name, attr in zip(batch, attrs):
+                off += 1
+                if attr is None:
+                    # Removed after opendir
+                    continue
+                if not pyfuse3.readdir_reply(
+                        token, fsencode(name), attr, off):
+                    return
+                self._add_path(attr.st_ino, os.path.join(path, name))
+
+    async def releasedir(self, fh):
+        del self._dir_snapshots[fh]
+
+    def _batch_getattr(self, path, names):
+        attrs = []
+        for name in names:
+            try:
+                attrs.append(self._getattr(path=os.path.join(path, name)))
+            except FUSEError:
+                attrs.append(None)
+        return attrs
 
     def _forget_path(self, inode, path):
         log.debug('forget %s for %d', path, inode)
@@ -251,10 +329,15 @@ class Operations(pyfuse3.Operations):
             raise FUSEError(exc.errno)
 
         try:
-            fobj = FileObject(file_path)
+            fobj = FileObject(file_path, use_mmap=self._use_mmap)
             self._fileobject_map[fd] = fobj
             self._fileobject_path_map[file_path] = fobj
 
+            if self._block_cache is not None:
+                # Forget cached blocks of a previous version of the file
+                st = os.fstat(fd)
+                self._block_cache.validate(inode, (st.st_mtime_ns, st.st_size))
+
         except NotCompressedFile:
             # If file is not compressed, treat it as general case
             pass
@@ -267,22 +350,68 @@ class Operations(pyfuse3.Operations):
     async def read(self, fd, offset, length):
         if fd not in self._fileobject_map:
             # Not compressed files
-            os.lseek(fd, offset, os.SEEK_SET)
             log.debug('READ of %s, from %d with %d size', fd, offset, length)
-            return os.read(fd, length)
-        
-        blocksize = self._fileobject_map[fd].header.get_blocksize()
-
-        block_start = math.ceil(
-            offset / blocksize)
-        total_blocks = math.ceil(
-            length / blocksize)
+            return await trio.to_thread.run_sync(os.pread, fd, length, offset,
+                                                 limiter=self._read_limiter)
 
+        fobj = self._fileobject_map[fd]
+        inode = self._fd_inode_map[fd]
 
-        data_blocks = self._fileobject_map[fd].read_block(
-            block_start, file_descriptor=fd, count=total_blocks)
+        data = await trio.to_thread.run_sync(
+            partial(fobj.read_range, offset, length,
+                    block_reader=partial(self._read_block, inode, fobj, fd)),
+            limiter=self._read_limiter)
+
+        if self._readahead and data:
+            blocksize = fobj.header.get_blocksize()
+            self._prefetch(fd, inode, fobj, offset // blocksize, (offset + len(data) - 1) // blocksize)
+
+        return data
+
+    def _read_block(self, inode, fobj, fd, num):
+        """
+        Decompressed block num of the file, from the block cache when possible.
+        Runs in a worker thread
+        """
+        if self._block_cache is None:
+            return fobj.read_block(num, file_descriptor=fd)
+
+        data = self._block_cache.get(inode, num)
+        if data is None:
+            future = self._prefetch_futures.get(fd, {}).get(num)
+            if future is not None:
+                # Already being decompressed in background
+                return future.result()
+
+            data = fobj.read_block(num, file_descriptor=fd)
+            self._block_cache.put(inode, num, data)
+        return data
+
+    def _prefetch(self, fd, inode, fobj, first, last):
+        """
+        Decompress in background the next blocks of a handle that is read sequentially
+        """
+        if fd not in self._readahead_map:
+            self._readahead_map[fd] = Readahead(max_window=self._readahead)
+
+        futures = self._prefetch_futures[fd]
+        for num, future in list(futures.items()):
+            if future.done():
+                del futures[num]
+
+        valid_blocks = fobj._get_numblocks() - 1
+        for num in self._readahead_map[fd].access(first, last):
+            if num >= valid_blocks:
+                break
+            if num not in futures:
+                futures[num] = self._prefetch_pool.submit(self._prefetch_block, inode, fobj, fd, num)
 
-        return data_blocks[0:length]
+    def _prefetch_block(self, inode, fobj, fd, num):
+        data = self._block_cache.get(inode, num)
+        if data is None:
+            data = fobj.read_block(num, file_descriptor=fd)
+            self._block_cache.put(inode, num, data)
+        return data
 
     async def release(self, fd):
         if self._fd_open_count[fd] > 1:
@@ -291,10 +420,18 @@ class Operations(pyfuse3.Operations):
 
         del self._fd_open_count[fd]
         inode = self._fd_inode_map[fd]
+
+        # Pending prefetches must not use the fd once it's closed
+        futures = self._prefetch_futures.pop(fd, {}).values()
+        for future in futures:
+            future.cancel()
+        await trio.to_thread.run_sync(wait, futures)
+        self._readahead_map.pop(fd, None)
         del self._inode_fd_map[inode]
         del self._fd_inode_map[fd]
 
         if fd in self._fileobject_map:
+            self._fileobject_map[fd].close()
             del self._fileobject_map[fd]
             del self._fileobject_path_map[self._inode_to_path(inode)]
         try:
@@ -318,9 +455,13 @@ def init_logging(debug=False):
     root_logger.addHandler(handler)
 
 
-def mount_fuse(source, mountpoint):
+def mount_fuse(source, mountpoint, use_mmap=False, cache_size=64 * 2**20, readahead=32, threads=None,
+               attr_timeout=1, entry_timeout=1, index_file=None):
     init_logging() # Nod debug for now
-    operations = Operations(str(source))
+    index = read_index(index_file) if index_file is not None else None
+    operations = Operations(str(source), use_mmap=use_mmap, cache_size=cache_size, readahead=readahead,
+                            threads=threads, attr_timeout=attr_timeout, entry_timeout=entry_timeout,
+                            index=index)
 
     log.debug('Mounting...')
     fuse_options = set(pyfuse3.default_options)
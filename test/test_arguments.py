@@ -5,7 +5,9 @@ from mkzftree2.arguments import get_options
 def test_noarguments(capsys):
     with pytest.raises(SystemExit):
         get_options('')
-    assert 'the following arguments are required: in_dir, out_dir' in capsys.readouterr().err
+    assert 'the following arguments are required: in_dir' in capsys.readouterr().err
+    with pytest.raises(ValueError):
+        get_options(['.'])
 
 
 def test_bad_indir():
@@ -25,4 +27,22 @@ def test_basic(input_file_empty):
         str(input_file_empty.parent),
         "outdir"
     ]
-    get_options(args)
\ No newline at end of file
+    get_options(args)
+
+def test_verify(input_file_empty, tmpdir):
+    opt = get_options([str(input_file_empty.parent), str(tmpdir)])
+    assert not opt.verify and opt.jobs == 1 and opt.file_jobs == 1
+
+    opt = get_options([str(input_file_empty.parent), str(tmpdir), "--verify-source", "--file-jobs", "2"])
+    assert opt.verify and opt.file_jobs == 2 and opt.jobs >= 1
+
+    with pytest.raises(ValueError):
+        get_options([str(input_file_empty.parent), str(tmpdir), "--verify", "-u"])
+    with pytest.raises(NotADirectoryError):
+        get_options([str(input_file_empty.parent), str(tmpdir / "nodir"), "--verify"])
+
+    # Without a source, the tree to check is the only directory
+    opt = get_options([str(input_file_empty.parent), "--verify"])
+    assert opt.verify and opt.out_dir == [input_file_empty.parent]
+    with pytest.raises(ValueError):
+        get_options([str(input_file_empty.parent), "--verify-source"])
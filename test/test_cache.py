@@ -0,0 +1,88 @@
+from mkzftree2.cache import BlockCache, Readahead, MetadataCache
+
+
+def test_lru_budget():
+    cache = BlockCache(max_bytes=3 * 100)
+
+    for num in range(0, 3):
+        cache.put(1, num, bytes(100))
+    assert cache.size == 300
+
+    # Block 0 is now the most recently used
+    assert cache.get(1, 0) == bytes(100)
+    cache.put(2, 0, b'x' * 100)
+
+    assert cache.get(1, 1) is None
+    assert cache.get(1, 0) is not None
+    assert cache.get(2, 0) == b'x' * 100
+    assert cache.size == 300
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    # Too big to be cached
+    cache.put(3, 0, bytes(1000))
+    assert cache.get(3, 0) is None
+    assert len(cache) == 3
+
+
+def test_invalidation():
+    cache = BlockCache(max_bytes=2**20)
+    cache.validate(1, (1000, 50))
+    cache.put(1, 0, b'a' * 50)
+    cache.put(2, 0, b'b' * 50)
+
+    # Same version: blocks are kept
+    cache.validate(1, (1000, 50))
+    assert cache.get(1, 0) == b'a' * 50
+
+    # The backing file changed
+    cache.validate(1, (2000, 50))
+    assert cache.get(1, 0) is None
+    assert cache.get(2, 0) == b'b' * 50
+    assert cache.size == 50
+
+    cache.invalidate(2)
+    assert len(cache) == 0
+    assert cache.size == 0
+
+
+def test_readahead():
+    readahead = Readahead(max_window=8)
+
+    # Nothing is prefetched until reads look sequential
+    assert list(readahead.access(10, 13)) == []
+    assert list(readahead.access(14, 17)) == [18, 19]
+    # Several reads of the same block are still sequential
+    assert list(readahead.access(17, 17)) == [20, 21]
+    assert list(readahead.access(18, 21)) == list(range(22, 30))
+    # The window doesn't grow further
+    assert list(readahead.access(22, 25)) == list(range(30, 34))
+    assert readahead.window == 8
+
+    # Random access resets the window
+    assert list(readahead.access(100, 100)) == []
+    assert readahead.window == 0
+    assert list(readahead.access(101, 101)) == [102, 103]
+
+
+def test_metadata_cache():
+    from types import SimpleNamespace
+    cache = MetadataCache(max_entries=2)
+    calls = []
+
+    def loader(size):
+        return lambda: calls.append(size) or size
+
+    st = SimpleNamespace(st_dev=1, st_ino=10, st_mtime_ns=1000, st_size=50)
+    assert cache.get_size(st, loader(500)) == 500
+    assert cache.get_size(st, loader(999)) == 500
+    assert calls == [500]
+
+    # Modified file: new key
+    st.st_mtime_ns = 2000
+    assert cache.get_size(st, loader(None)) is None
+    assert cache.get_size(st, loader(999)) is None
+
+    # Bounded
+    cache.get_size(SimpleNamespace(st_dev=1, st_ino=11, st_mtime_ns=1, st_size=1), loader(1))
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 3)
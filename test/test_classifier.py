@@ -0,0 +1,76 @@
+import os
+import random
+import pytest
+
+from mkzftree2.classifier import sniff_magic, entropy, estimate_ratio, select_algorithm, RATIO_LIMIT, AUTO_CANDIDATES, \
+    AUTO_DEFAULT, AUTO_MIN_SAMPLE
+from mkzftree2.models.algorithm import Algorithm
+
+
+def test_sniff_magic():
+    assert sniff_magic(b'\xFF\xD8\xFF\xE0\x00\x10JFIF') == 'jpeg'
+    assert sniff_magic(b'\x00\x00\x00\x18ftypmp42') == 'mp4'
+    assert sniff_magic(b'PK\x03\x04\x14\x00') == 'zip'
+    assert sniff_magic(b'a,b,c,d,e,f,g,h\n') is None
+
+
+def test_entropy():
+    assert entropy(b'') == 0
+    assert entropy(b'a' * 1000) == 0
+    assert entropy(os.urandom(2**15)) > 7.9
+
+
+@pytest.mark.parametrize('alg', Algorithm.list_all())
+def test_estimate_ratio(alg):
+    algorithm = Algorithm.from_arg(alg)
+    text = b'a,b,c,d,e,f,g,h\n' * 2048
+    noise = os.urandom(2**15)
+    zeros = bytes(2**15)
+
+    assert estimate_ratio([text] * 4, algorithm, 3) < 0.2
+    assert estimate_ratio([noise] * 4, algorithm, 3) >= RATIO_LIMIT
+    assert estimate_ratio([b'\xFF\xD8\xFF' + text[3:]] + [text] * 3, algorithm, 3) >= RATIO_LIMIT
+
+    # Zero blocks are free
+    assert estimate_ratio([zeros] * 4, algorithm, 3) == 0
+    assert estimate_ratio([noise, zeros, zeros, zeros], algorithm, 3) < 0.3
+
+
+def test_select_algorithm():
+    random.seed(0)
+    text = ''.join(f"{random.randint(0, 10**6)},item{random.randint(0, 100)}\n" for _ in range(10000)).encode()
+    samples = [text[i:i+2**15] for i in range(0, len(text), 2**15)]
+
+    def size(choice):
+        algorithm, level = choice
+        return sum(len(algorithm.data_compress(s, level)) for s in samples)
+
+    # Favouring the ratio never gives a bigger output than favouring the speed
+    assert size(select_algorithm(samples, 'ratio')) <= size(select_algorithm(samples, 'balanced'))
+    assert size(select_algorithm(samples, 'balanced')) <= size(select_algorithm(samples, 'speed'))
+
+    assert select_algorithm(samples, 'ratio', legacy=True)[0] == Algorithm.ZLIB
+
+    # Nothing to learn from incompressible or empty data
+    assert select_algorithm([os.urandom(2**15)] * 4) == AUTO_CANDIDATES[0]
+    assert select_algorithm([bytes(2**15)]) == AUTO_CANDIDATES[0]
+    assert select_algorithm([]) == AUTO_CANDIDATES[0]
+
+
+def test_select_algorithm_stable(monkeypatch):
+    random.seed(1)
+    text = ''.join(f"{random.randint(0, 10**4)};{random.choice(['GET', 'PUT'])}\n" for _ in range(20000)).encode()
+    samples = [text[i:i+2**15] for i in range(0, len(text), 2**15)]
+
+    # Identical files always get the same algorithm, whatever the load of the machine
+    for policy in ['ratio', 'balanced', 'speed']:
+        assert len({select_algorithm(list(samples), policy) for _ in range(5)}) == 1
+
+    # Too little data to tell the candidates apart: nothing is compressed
+    def no_trial(self, data, level):
+        raise AssertionError("Trial compression of a small file")
+
+    monkeypatch.setattr(Algorithm, 'data_compress', no_trial)
+    small = [text[:AUTO_MIN_SAMPLE // 2]]
+    assert select_algorithm(small, 'ratio') == AUTO_DEFAULT
+    assert select_algorithm(small, 'ratio', legacy=True)[0] == Algorithm.ZLIB
@@ -1,11 +1,12 @@
 from argparse import ArgumentError
 import pytest
 import hashlib
+import os
 import random
 
 from pathlib import Path
 import shutil
-from mkzftree2.compressor import compress_file, uncompress_file
+from mkzftree2.compressor import compress_file, compress_stream, uncompress_file
 from mkzftree2.arguments import default_block_sizes
 from mkzftree2.models.algorithm import Algorithm
 from mkzftree2.models.FileObject import ZISOFS, ZISOFSv2, FileObject
@@ -183,3 +184,297 @@ def test_compress(input_file_tuple, output_file, alg, blocksize, force, legacy,
 
 
     print(f"ratio: {ratio*100:0.2f}%", end=' ')
+
+
+@pytest.mark.parametrize('alg', Algorithm.list_all())
+@pytest.mark.parametrize('workers', [2, 4])
+def test_parallel_blocks(input_file_holes, output_file, alg, workers):
+    compress_file(input_file_holes, output_file, algorithm=alg, force=True)
+    serial = output_file.read_bytes()
+
+    compress_file(input_file_holes, output_file, algorithm=alg, force=True, workers=workers)
+
+    # Output must be byte identical to the serial path
+    assert(output_file.read_bytes() == serial)
+
+
+def test_codec_context_cache():
+    from concurrent.futures import ThreadPoolExecutor
+
+    context = Algorithm.ZSTD.get_context(3)
+
+    # Reused in the same thread, per (algorithm, level)
+    assert(Algorithm.ZSTD.get_context(3) is context)
+    assert(Algorithm.ZSTD.get_context(4) is not context)
+
+    # Never shared between threads
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert(pool.submit(Algorithm.ZSTD.get_context, 3).result() is not context)
+
+
+@pytest.fixture
+def input_file_json(tmpdir):
+    random.seed(0)
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(3, 12)))
+             for _ in range(3000)]
+
+    out_file = Path(tmpdir / "logs.json")
+    with out_file.open('w') as fout:
+        for i in range(0, 20000):
+            fout.write(f'{{"timestamp": {1600000000 + i*7}, "severity": "{random.choice(["INFO", "WARN"])}", '
+                       f'"message": "{" ".join(random.choice(words) for _ in range(6))}"}}\n')
+    yield out_file
+
+
+def test_zstd_dict(input_file_json, output_file):
+    ratio_plain = compress_file(input_file_json, output_file, algorithm='zstd', zlevel=3)
+    ratio_dict = compress_file(input_file_json, output_file, algorithm='zstd_dict', zlevel=3)
+
+    assert(ratio_dict < ratio_plain)
+
+    fobj = FileObject(output_file)
+    assert(fobj.get_algorithm() == Algorithm.ZSTD_DICT)
+    assert(len(fobj.get_dictionary()) > 0)
+
+    # Random access must keep working
+    original = input_file_json.read_bytes()
+    blocksize = fobj.header.get_blocksize()
+    for num in [5, 0, fobj._get_numblocks() - 2, 3]:
+        assert(fobj.read_block(num) == original[num*blocksize:(num+1)*blocksize])
+
+
+class NonSeekable:
+    """
+    Minimal pipe-like stream: only read() or write(), no seek() nor tell()
+    """
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def read(self, size):
+        chunk = bytes(self.data[self.pos:self.pos+size])
+        self.pos += len(chunk)
+        return chunk
+
+    def write(self, data):
+        self.data += data
+        return len(data)
+
+
+class ShortReads(NonSeekable):
+    """
+    Raw pipe: read() returns at most a few KiB, whatever the size asked
+    """
+    def read(self, size):
+        return super().read(min(size, random.randint(1, 5000)))
+
+
+@pytest.mark.parametrize('alg', Algorithm.list_all())
+@pytest.mark.parametrize('legacy', [False, True])
+def test_stream(input_file_holes, output_file, alg, legacy):
+    if legacy and alg != 'zlib':
+        return
+
+    compress_file(input_file_holes, output_file, algorithm=alg, legacy=legacy,
+                  force=True, copy_attributes=False)
+
+    dst = NonSeekable()
+    compress_stream(NonSeekable(input_file_holes.read_bytes()), dst, algorithm=alg, legacy=legacy, workers=2)
+
+    if alg == 'zstd_dict':
+        # The dictionary is trained with the first blocks instead of samples of the whole file
+        output_file.write_bytes(bytes(dst.data))
+        extracted_file = (output_file.parent / 'result_extracted')
+        uncompress_file(output_file, extracted_file)
+        assert(get_md5(input_file_holes) == get_md5(extracted_file))
+    else:
+        # Same output as the seekable path
+        assert(bytes(dst.data) == output_file.read_bytes())
+
+
+def test_stream_short_reads(input_file_holes, output_file):
+    random.seed(0)
+    compress_file(input_file_holes, output_file, algorithm='zstd', force=True, copy_attributes=False)
+
+    dst = NonSeekable()
+    compress_stream(ShortReads(input_file_holes.read_bytes()), dst, algorithm='zstd', workers=2)
+    # Blocks are complete, as if the whole stream was read at once
+    assert(bytes(dst.data) == output_file.read_bytes())
+
+
+@pytest.mark.parametrize('alg, legacy', [('zlib', True), ('zstd', False), ('lz4', False)])
+def test_stream_in_place(input_file_holes, output_file, monkeypatch, alg, legacy):
+    compress_file(input_file_holes, output_file, algorithm=alg, legacy=legacy,
+                  force=True, copy_attributes=False)
+
+    # Appended writes can't go back to the pointers table: spooled
+    stream_file = output_file.parent / 'stream.zf'
+    stream_file.write_bytes(b'prefix')
+    with open(input_file_holes, 'rb') as src, open(stream_file, 'ab') as dst:
+        compress_stream(src, dst, algorithm=alg, legacy=legacy, workers=2)
+    assert(stream_file.read_bytes() == b'prefix' + output_file.read_bytes())
+
+    # A regular file into a seekable output: nothing is spooled
+    import mkzftree2.compressor
+    def no_spool(*args, **kwargs):
+        raise AssertionError("Spooled")
+    monkeypatch.setattr(mkzftree2.compressor.tempfile, 'SpooledTemporaryFile', no_spool)
+
+    with open(input_file_holes, 'rb') as src, open(stream_file, 'wb') as dst:
+        dst.write(b'prefix')
+        compress_stream(src, dst, algorithm=alg, legacy=legacy, workers=2)
+    assert(stream_file.read_bytes() == b'prefix' + output_file.read_bytes())
+
+
+def test_stream_legacy_limit(monkeypatch):
+    import mkzftree2.compressor
+    monkeypatch.setattr(mkzftree2.compressor, 'LEGACY_LIMIT', 2**20)
+
+    # Too big, found out before reading the whole stream
+    src = NonSeekable(b'a,b,c,d,e,f,g,h\n' * 2**18)
+    with pytest.raises(IllegalArgumentError, match="smaller than 4 GiB"):
+        compress_stream(src, NonSeekable(), legacy=True)
+    assert(src.pos < len(src.data))
+
+    # Small enough, but its pointers would not fit in 32 bits once compressed
+    random.seed(0)
+    with pytest.raises(IllegalArgumentError, match="compressed files smaller than 4 GiB"):
+        compress_stream(NonSeekable(random.getrandbits(8 * (2**20 - 2**8)).to_bytes(2**20 - 2**8, 'little')),
+                        NonSeekable(), legacy=True)
+
+
+def test_early_abort(tmpdir, output_file, monkeypatch):
+    random.seed(0)
+    size = 4*10**6
+
+    # The first block is compressible, the rest is not
+    in_file = Path(tmpdir / "mixed.bin")
+    with open(in_file, 'wb') as fout:
+        fout.write(b'a,b,c,d,e,f,g,h\n' * 2**11)
+        fout.write(random.getrandbits(8*size).to_bytes(size, 'little', signed=False))
+
+    import mkzftree2.compressor
+    compressed_blocks = []
+    compress_block = mkzftree2.compressor._compress_block
+    monkeypatch.setattr(mkzftree2.compressor, '_compress_block',
+                        lambda chunk, *args: compressed_blocks.append(chunk) or compress_block(chunk, *args))
+
+    ratio = compress_file(in_file, output_file)
+
+    assert(ratio == 1)
+    assert(output_file.read_bytes() == in_file.read_bytes())
+
+    # Compression stopped long before the end of the file
+    assert(len(compressed_blocks) < 10)
+
+
+@pytest.mark.parametrize('input_name', ['input_file_holes', 'input_file_full', 'input_file_empty'])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_hasher(request, output_file, input_name, workers):
+    in_file = request.getfixturevalue(input_name)
+
+    hasher = hashlib.blake2b()
+    compress_file(in_file, output_file, workers=workers, hasher=hasher)
+
+    # Hashed while compressing or storing, holes included
+    assert(hasher.digest() == hashlib.blake2b(in_file.read_bytes()).digest())
+
+
+@pytest.mark.parametrize('policy', ['ratio', 'balanced', 'speed'])
+@pytest.mark.parametrize('legacy', [False, True])
+def test_auto(input_file_holes, output_file, policy, legacy):
+    compress_file(input_file_holes, output_file, algorithm='auto', auto_policy=policy, legacy=legacy)
+
+    fobj = FileObject(output_file)
+    assert(isinstance(fobj.header, ZISOFS if legacy else ZISOFSv2))
+    assert(fobj.get_algorithm() in Algorithm)
+
+    extracted_file = (output_file.parent / 'result_extracted')
+    uncompress_file(output_file, extracted_file)
+    assert(get_md5(input_file_holes) == get_md5(extracted_file))
+
+    stream_file = output_file.parent / 'stream.zf'
+    with open(input_file_holes, 'rb') as src, open(stream_file, 'wb') as dst:
+        compress_stream(src, dst, algorithm='auto', auto_policy=policy, legacy=legacy)
+    uncompress_file(stream_file, extracted_file)
+    assert(get_md5(input_file_holes) == get_md5(extracted_file))
+
+
+@pytest.mark.parametrize('legacy', [False, True])
+def test_sparse(tmpdir, output_file, legacy):
+    size = 64 * 2**20
+    in_file = Path(tmpdir / "sparse.img")
+    with open(in_file, 'wb') as fout:
+        fout.truncate(size)
+        fout.seek(size // 2 + 1000)
+        fout.write(b'a,b,c,d,e,f,g,h\n' * 10000)
+
+    compress_file(in_file, output_file, legacy=legacy)
+
+    extracted_file = (output_file.parent / 'result_extracted')
+    uncompress_file(output_file, extracted_file)
+
+    assert(get_md5(in_file) == get_md5(extracted_file))
+    # Zero blocks are left as holes
+    assert(extracted_file.stat().st_size == size)
+    if hasattr(os, 'SEEK_DATA'):
+        assert(extracted_file.stat().st_blocks * 512 < size // 4)
+
+
+@pytest.mark.parametrize('legacy', [False, True])
+def test_pointers_table(input_file_holes, output_file, legacy):
+    compress_file(input_file_holes, output_file, legacy=legacy)
+
+    fobj = FileObject(output_file)
+    pointers = fobj.get_pointers()
+
+    # Loaded once, then cached
+    assert(fobj.get_pointers() is pointers)
+    assert(len(pointers) == fobj._get_numblocks())
+    assert(pointers[0] == len(fobj.header) + len(fobj.getTablePointers()))
+    assert(pointers[-1] == output_file.stat().st_size)
+    assert(all(a <= b for a, b in zip(pointers, pointers[1:])))
+
+    # Encoding gives back the same table
+    with open(output_file, 'rb') as src:
+        src.seek(len(fobj.header))
+        assert(fobj.getTablePointers(list_pointers=pointers) == src.read(len(pointers) * fobj.header.pointers_size))
+
+
+@pytest.mark.parametrize('alg', Algorithm.list_all())
+def test_mmap_reader(input_file_holes, output_file, alg):
+    compress_file(input_file_holes, output_file, algorithm=alg, force=True)
+
+    fobj = FileObject(output_file)
+    with FileObject(output_file, use_mmap=True) as mapped, FileObject(output_file, use_mmap=True) as other:
+        # A single mapping is shared by all the readers of the file
+        assert(mapped.mapping.obj is other.mapping.obj)
+
+        for num in [3, 0, 100, fobj._get_numblocks() - 2]:
+            assert(mapped.read_block(num, count=2) == fobj.read_block(num, count=2))
+
+        assert(b''.join(mapped.get_chunks()) == input_file_holes.read_bytes())
+
+    assert(mapped.mapping is None)
+
+    with pytest.raises(NotCompressedFile):
+        FileObject(input_file_holes, use_mmap=True)
+
+
+@pytest.mark.parametrize('seed', range(0, 2))
+@pytest.mark.parametrize('alg', Algorithm.list_all())
+@pytest.mark.parametrize('use_mmap', [False, True])
+def test_read_range(input_file_holes, output_file, seed, alg, use_mmap):
+    compress_file(input_file_holes, output_file, algorithm=alg, force=True)
+    original = input_file_holes.read_bytes()
+    size = len(original)
+
+    # Any range must give back the same bytes as the original file
+    rnd = random.Random(seed)
+    with FileObject(output_file, use_mmap=use_mmap) as fobj:
+        blocksize = fobj.header.get_blocksize()
+        for _ in range(0, 100):
+            offset = rnd.choice([rnd.randrange(0, size), rnd.randrange(0, size // blocksize) * blocksize,
+                                 size - rnd.randrange(1, 10), rnd.randrange(size, size + 10)])
+            length = rnd.choice([rnd.randrange(1, 10), rnd.randrange(1, 4 * blocksize), blocksize])
+            assert(bytes(fobj.read_range(offset, length)) == original[offset:offset+length])
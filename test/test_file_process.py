@@ -0,0 +1,517 @@
+import io
+import json
+import os
+import pytest
+import random
+import shutil
+import time
+from collections import Counter
+
+from pathlib import Path
+from mkzftree2 import file_process
+from mkzftree2.__main__ import main
+from mkzftree2.file_process import find_files, process_files, uncompress_files, verify_files
+from mkzftree2.progress import Progress
+from mkzftree2.fsck import load_digests
+from mkzftree2.index import content_hasher, read_index, lookup
+from mkzftree2.manifest import read_manifest
+from mkzftree2.models.FileObject import FileObject
+from mkzftree2.models.algorithm import TREE_DICT_PREFIX
+from mkzftree2.stats import RunStats
+from mkzftree2.utils import sizeof_fmt
+
+
+@pytest.fixture
+def input_tree(tmpdir):
+    random.seed(0)
+    source = Path(tmpdir / "source")
+
+    for idx in range(0, 12):
+        in_file = source / f"dir{idx % 3}" / f"file{idx}.txt"
+        in_file.parent.mkdir(parents=True, exist_ok=True)
+        with in_file.open('w') as src:
+            for _ in range(0, 500 * (idx + 1)):
+                src.write(f"{random.randint(0, 100)},b,c,d\n")
+
+    # Incompressible file
+    size = 10**5
+    (source / "random.bin").write_bytes(random.getrandbits(8*size).to_bytes(size, 'little'))
+    (source / "empty_dir").mkdir()
+    (source / "link.txt").symlink_to("dir0/file0.txt")
+
+    yield source
+
+
+def run_tree(source, target, zlevel=3, alg='zstd', **kwargs):
+    list_files = find_files(source, [], False)
+    return process_files(list_files, source, target, False, alg, zlevel, 2**15,
+                         False, False, False, **kwargs)
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_file_pool(input_tree, tmpdir, pool):
+    serial = run_tree(input_tree, Path(tmpdir / "serial"))
+    parallel = run_tree(input_tree, Path(tmpdir / "parallel"), file_jobs=4, pool=pool)
+
+    # Results keep the input order, whatever the scheduling was
+    assert [r.source for r in serial] == [r.source for r in parallel]
+    assert [r.status for r in serial] == [r.status for r in parallel]
+    assert sum(r.csize for r in serial) == sum(r.csize for r in parallel)
+    assert 'stored' in [r.status for r in parallel]
+
+    for r in parallel:
+        serial_file = Path(tmpdir / "serial") / r.source.relative_to(input_tree)
+        assert r.target.read_bytes() == serial_file.read_bytes()
+
+    assert (Path(tmpdir / "parallel") / "empty_dir").is_dir()
+
+    # A second run skips every file
+    skipped = run_tree(input_tree, Path(tmpdir / "parallel"), file_jobs=4, pool=pool)
+    assert all(r.status == 'skipped' for r in skipped)
+
+
+def test_index(input_tree, tmpdir):
+    target = Path(tmpdir / "target")
+    index_file = Path(tmpdir / "tree.idx")
+    results = run_tree(input_tree, target, file_jobs=4, index_file=index_file)
+
+    index = read_index(index_file)
+    assert len(index) == len(results)
+
+    for r in results:
+        entry = index[str(r.target.relative_to(target))]
+        assert entry.size == r.osize
+        assert entry.csize == r.csize
+        assert (entry.algorithm == 0) == (r.status == 'stored')
+
+        hasher = content_hasher()
+        hasher.update(r.source.read_bytes())
+        assert entry.digest == hasher.digest()
+
+        assert lookup(index, entry.path, r.target.stat()) == entry
+
+    # The index is only trusted while the compressed size and date match
+    stale = index["random.bin"]._replace(csize=1)
+    assert lookup({"random.bin": stale}, "random.bin", (target / "random.bin").stat()) is None
+    stale = index["random.bin"]._replace(mtime=index["random.bin"].mtime - 10**9)
+    assert lookup({"random.bin": stale}, "random.bin", (target / "random.bin").stat()) is None
+
+    extracted = Path(tmpdir / "extracted")
+    extracted.mkdir()
+    uncompress_files(target, extracted, index)
+    for r in results:
+        assert (extracted / r.source.relative_to(input_tree)).read_bytes() == r.source.read_bytes()
+
+    # A run on some of the files keeps the entries of the others, except removed ones
+    removed = next(p for p in index if p != "random.bin")
+    (target / removed).unlink()
+    process_files([input_tree / "random.bin"], input_tree, target, True, 'zlib', 3, 2**15,
+                  False, False, False, index_file=index_file, quiet=True)
+    partial = read_index(index_file)
+    assert sorted(partial) == sorted(p for p in index if p != removed)
+    assert partial["random.bin"].mtime == (target / "random.bin").stat().st_mtime_ns
+
+
+def test_incremental(input_tree, tmpdir):
+    target = Path(tmpdir / "target")
+    manifest = Path(tmpdir / "manifest.json")
+
+    first = run_tree(input_tree, target, manifest_file=manifest)
+    assert all(r.status in ('compressed', 'stored') for r in first)
+    assert (target / "link.txt").is_symlink()
+
+    # Nothing changed
+    second = run_tree(input_tree, target, manifest_file=manifest, file_jobs=4)
+    assert all(r.status == 'unchanged' for r in second)
+
+    # Modified, only touched, removed and new files
+    with (input_tree / "dir0" / "file3.txt").open('a') as src:
+        src.write("new line\n")
+    os.utime(input_tree / "dir1" / "file1.txt", ns=(0, 0))
+    shutil.rmtree(input_tree / "dir2")
+    (input_tree / "new.txt").write_text("a,b,c,d\n" * 1000)
+
+    third = {str(r.source.relative_to(input_tree)): r.status
+             for r in run_tree(input_tree, target, manifest_file=manifest)}
+    assert third.pop("dir0/file3.txt") == 'compressed'
+    assert third.pop("new.txt") == 'compressed'
+    assert all(status == 'unchanged' for status in third.values())
+    assert not (target / "dir2").exists()
+
+    extracted = Path(tmpdir / "extracted")
+    extracted.mkdir()
+    uncompress_files(target, extracted)
+    for f in input_tree.rglob('*'):
+        if f.is_file():
+            assert (extracted / f.relative_to(input_tree)).read_bytes() == f.read_bytes()
+
+    # Other compression parameters rebuild everything
+    fourth = run_tree(input_tree, target, zlevel=5, manifest_file=manifest)
+    assert all(r.status != 'unchanged' for r in fourth)
+
+
+def test_dedup(input_tree, tmpdir):
+    os.link(input_tree / "dir0" / "file0.txt", input_tree / "dir1" / "hardlink.txt")
+    shutil.copy2(input_tree / "dir0" / "file3.txt", input_tree / "copy.txt")
+    # Same size and beginning, different content
+    data = (input_tree / "random.bin").read_bytes()
+    (input_tree / "almost.bin").write_bytes(data[:-1] + bytes([data[-1] ^ 1]))
+
+    target = Path(tmpdir / "target")
+    results = {str(r.source.relative_to(input_tree)): r
+               for r in run_tree(input_tree, target, dedup=True, file_jobs=2)}
+
+    # Whatever the order of the files, one of each pair is compressed and the other linked
+    for pair in [("dir0/file0.txt", "dir1/hardlink.txt"), ("dir0/file3.txt", "copy.txt")]:
+        assert sorted(results[p].status for p in pair) == ['compressed', 'linked']
+    assert results["almost.bin"].status == 'stored'
+    assert sum(r.status == 'linked' for r in results.values()) == 2
+
+    # Hardlinks are kept in the compressed tree
+    assert (target / "dir1" / "hardlink.txt").samefile(target / "dir0" / "file0.txt")
+    assert (target / "copy.txt").read_bytes() == (target / "dir0" / "file3.txt").read_bytes()
+
+    extracted = Path(tmpdir / "extracted")
+    extracted.mkdir()
+    uncompress_files(target, extracted)
+    for f in input_tree.rglob('*'):
+        if f.is_file():
+            assert (extracted / f.relative_to(input_tree)).read_bytes() == f.read_bytes()
+
+    # Compressing a file again doesn't change the outputs it was linked with
+    new_file = input_tree / "new.tmp"
+    new_file.write_text("other,content\n" * 1000)
+    os.replace(new_file, input_tree / "dir0" / "file0.txt")
+    run_tree(input_tree, target, manifest_file=Path(tmpdir / "manifest.json"))
+    assert not (target / "dir1" / "hardlink.txt").samefile(target / "dir0" / "file0.txt")
+
+    shutil.rmtree(extracted)
+    extracted.mkdir()
+    uncompress_files(target, extracted)
+    for f in input_tree.rglob('*'):
+        if f.is_file():
+            assert (extracted / f.relative_to(input_tree)).read_bytes() == f.read_bytes()
+
+
+@pytest.mark.parametrize('ignore_attributes', [False, True])
+def test_dedup_attributes(input_tree, tmpdir, monkeypatch, capsys, ignore_attributes):
+    # Filesystem without reflinks
+    monkeypatch.setattr(file_process, 'reflink_file', lambda src, dst: False)
+    shutil.copy(input_tree / "dir0" / "file3.txt", input_tree / "script.sh")
+    os.chmod(input_tree / "script.sh", 0o755)
+    os.chmod(input_tree / "dir0" / "file3.txt", 0o644)
+    # Only the dates differ
+    shutil.copy(input_tree / "dir0" / "file6.txt", input_tree / "same.txt")
+    os.utime(input_tree / "same.txt", ns=(0, 0))
+
+    target = Path(tmpdir / "target")
+    list_files = find_files(input_tree, [], False)
+    results = process_files(list_files, input_tree, target, False, 'zstd', 3, 2**15, False, False,
+                            ignore_attributes, dedup=True)
+    statuses = {r.source.name: r.status for r in results}
+    assert statuses["same.txt"] == 'linked'
+    assert statuses["script.sh"] == ('linked' if ignore_attributes else 'copied')
+    assert (target / "same.txt").samefile(target / "dir0" / "file6.txt")
+    assert (target / "script.sh").samefile(target / "dir0" / "file3.txt") == ignore_attributes
+
+    # The reported totals are the real usage of the outputs
+    inodes = {f.stat().st_ino: f.stat().st_size for f in target.rglob('*') if f.is_file() and not f.is_symlink()}
+    assert sum(r.csize for r in results if r.status != 'linked') == sum(inodes.values())
+    saved = sum(r.csize for r in results if r.status == 'linked')
+    assert f"Deduplicated     : {2 if ignore_attributes else 1} files, {sizeof_fmt(saved)}" in capsys.readouterr().out
+
+    if not ignore_attributes:
+        extracted = Path(tmpdir / "extracted")
+        extracted.mkdir()
+        uncompress_files(target, extracted, quiet=True)
+        assert (extracted / "script.sh").stat().st_mode & 0o777 == 0o755
+        assert (extracted / "dir0" / "file3.txt").stat().st_mode & 0o777 == 0o644
+        assert (extracted / "script.sh").read_bytes() == (input_tree / "script.sh").read_bytes()
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_auto_tree(input_tree, tmpdir, pool):
+    target = Path(tmpdir / "target")
+    results = run_tree(input_tree, target, alg='auto', auto_policy='ratio', file_jobs=2, pool=pool)
+
+    assert all(r.algorithm is not None for r in results if r.status == 'compressed')
+    assert {r.status for r in results} == {'compressed', 'stored'}
+
+    extracted = Path(tmpdir / "extracted")
+    extracted.mkdir()
+    uncompress_files(target, extracted)
+    for r in results:
+        assert (extracted / r.source.relative_to(input_tree)).read_bytes() == r.source.read_bytes()
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_stats(input_tree, tmpdir, pool):
+    # Some zero blocks
+    (input_tree / "zeros.bin").write_bytes(bytes(2**17) + b'a,b,c,d\n' * 1000)
+
+    class Hooks(RunStats):
+        files = []
+
+        def file_done(self, result, stats):
+            self.files.append(result.source)
+            super().file_done(result, stats)
+
+    hooks = Hooks(slowest=3)
+    results = run_tree(input_tree, Path(tmpdir / "target"), file_jobs=2, pool=pool, workers=2, hooks=hooks)
+    report = json.loads(json.dumps(hooks.report()))
+
+    assert sorted(hooks.files) == sorted(r.source for r in results)
+    assert report['files'] == dict(Counter(r.status for r in results), failed=0)
+    assert report['bytes']['in'] == sum(r.osize for r in results)
+    assert report['bytes']['out'] == sum(r.csize for r in results)
+    assert report['bytes']['per_algorithm']['stored']['files'] == 1
+    assert report['blocks']['zero'] == 4
+    assert report['counters']['bytes_read'] == report['bytes']['in']
+    for stage in ['read', 'zero_check', 'compress', 'write', 'attributes']:
+        assert report['stages'][stage]['calls'] > 0
+    assert len(report['slowest']) == 3
+    assert report['slowest'][0]['seconds'] >= report['slowest'][-1]['seconds']
+    assert report['wall'] > 0
+
+
+def test_progress(input_tree, tmpdir, capsys, monkeypatch):
+    stream = io.StringIO()
+    progress = Progress(4, 4000, stream=stream, log_interval=10)
+    now = [0.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    progress.start = progress._last_draw = 0.0
+
+    # Not a terminal: one line every log_interval seconds
+    progress.update(1000)
+    assert stream.getvalue() == ""
+    now[0] = 10.0
+    progress.update(1000)
+    assert stream.getvalue() == "2/4 files, 2.0 KiB/3.9 KiB, 0.0 MB/s, ETA 0:00:10\n"
+    progress.close()
+    assert stream.getvalue().endswith("2/4 files, 2.0 KiB in 0:00:10 (0.0 MB/s)\n")
+    monkeypatch.undo()
+
+    run_tree(input_tree, Path(tmpdir / "verbose"), verbose=True)
+    out, err = capsys.readouterr()
+    assert "file9.txt: " in out and "Total input size" in out
+    assert "files," in err
+
+    run_tree(input_tree, Path(tmpdir / "quiet"), quiet=True)
+    assert capsys.readouterr() == ("", "")
+
+    uncompress_files(Path(tmpdir / "verbose"), Path(tmpdir / "uncompressed"), quiet=True)
+    assert capsys.readouterr() == ("", "")
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_uncompress_pool(input_tree, tmpdir, pool):
+    target = Path(tmpdir / "target")
+    run_tree(input_tree, target)
+    os.chmod(target / "dir0", 0o750)
+    os.utime(target / "dir0", (1000000000, 1000000000))
+
+    serial = Path(tmpdir / "serial")
+    uncompress_files(target, serial, quiet=True)
+    parallel = Path(tmpdir / "parallel")
+    uncompress_files(target, parallel, quiet=True, file_jobs=4, pool=pool)
+
+    for source in input_tree.rglob('*'):
+        rel_path = source.relative_to(input_tree)
+        if source.is_symlink():
+            assert os.readlink(parallel / rel_path) == os.readlink(source)
+        elif source.is_file():
+            assert (parallel / rel_path).read_bytes() == source.read_bytes()
+            assert (parallel / rel_path).read_bytes() == (serial / rel_path).read_bytes()
+            assert (parallel / rel_path).stat().st_mtime == (target / rel_path).stat().st_mtime
+
+    # Directory attributes are set after their content
+    assert (parallel / "empty_dir").is_dir()
+    assert (parallel / "dir0").stat().st_mtime == 1000000000
+    assert (parallel / "dir0").stat().st_mode & 0o777 == 0o750
+
+    # Failures are reported after the rest of the tree is done
+    broken = Path(tmpdir / "broken")
+    shutil.copytree(target, broken, symlinks=True)
+    data = (broken / "dir0" / "file0.txt").read_bytes()
+    (broken / "dir0" / "file0.txt").write_bytes(data[:len(data) // 2])
+    with pytest.raises(Exception):
+        uncompress_files(broken, Path(tmpdir / "out"), quiet=True, file_jobs=4, pool=pool)
+    assert (Path(tmpdir / "out") / "random.bin").read_bytes() == (input_tree / "random.bin").read_bytes()
+
+
+@pytest.mark.parametrize('pool', ['thread', 'process'])
+def test_verify(input_tree, tmpdir, pool):
+    target = Path(tmpdir / "target")
+    index_file = Path(tmpdir / "tree.idx")
+    run_tree(input_tree, target, index_file=index_file)
+
+    assert verify_files(target, input_tree, quiet=True, workers=2, file_jobs=2, pool=pool) == []
+    assert verify_files(target, digests=load_digests(index_file), quiet=True, workers=2) == []
+
+    broken = Path(tmpdir / "broken")
+    shutil.copytree(target, broken, symlinks=True)
+
+    # Bad block data
+    with FileObject(broken / "dir2" / "file11.txt") as fobj:
+        offset = fobj.get_pointers()[1]
+    with open(broken / "dir2" / "file11.txt", 'r+b') as fout:
+        fout.seek(offset)
+        fout.write(b'\xff' * 8)
+
+    # Pointers table going backwards
+    with FileObject(broken / "dir1" / "file10.txt") as fobj:
+        header_size = len(fobj.header)
+        first = fobj.get_pointers()[0]
+    with open(broken / "dir1" / "file10.txt", 'r+b') as fout:
+        fout.seek(header_size + 8)
+        fout.write((first - 1).to_bytes(8, 'little'))
+
+    # Truncated file
+    data = (broken / "dir0" / "file9.txt").read_bytes()
+    (broken / "dir0" / "file9.txt").write_bytes(data[:len(data) // 2])
+
+    (broken / "random.bin").write_bytes(b'other content')
+    (broken / "dir1" / "file1.txt").unlink()
+
+    problems = verify_files(broken, input_tree, quiet=True, workers=2, file_jobs=2, pool=pool)
+    statuses = {str(r.path.relative_to(broken)): r.status for r in problems}
+    assert statuses == {
+        "dir2/file11.txt": 'corrupt',
+        "dir1/file10.txt": 'corrupt',
+        "dir0/file9.txt": 'corrupt',
+        "random.bin": 'mismatch',
+        "dir1/file1.txt": 'missing',
+    }
+    errors = {str(r.path.relative_to(broken)): r.error for r in problems}
+    assert errors["dir2/file11.txt"].startswith("Block 1 ")
+    assert errors["dir1/file10.txt"].startswith("Pointer 1 ")
+    assert errors["dir0/file9.txt"].startswith("Blocks end at ")
+
+    # Without reference, only the structure and the blocks are checked
+    problems = verify_files(broken, quiet=True)
+    assert sorted(str(r.path.relative_to(broken)) for r in problems) == \
+        ["dir0/file9.txt", "dir1/file10.txt", "dir2/file11.txt"]
+
+    # The tree alone on the command line
+    for tree, code in [(target, 0), (broken, 1)]:
+        with pytest.raises(SystemExit) as ex:
+            main([str(tree), "--verify", "-q"])
+        assert ex.value.code == code
+
+
+def test_stats_stdout(input_tree, tmpdir, capsys):
+    main([str(input_tree), str(tmpdir / "target"), "--verbose", "--stats", "-"])
+    out, err = capsys.readouterr()
+
+    # Only the report is on stdout
+    assert json.loads(out)['files']['failed'] == 0
+    assert "Total input size" in err and "Done" in err
+
+
+@pytest.mark.parametrize('file_jobs', [1, 2])
+def test_failed_file(input_tree, tmpdir, capsys, monkeypatch, file_jobs):
+    target = Path(tmpdir / "target")
+    manifest = Path(tmpdir / "manifest.json")
+    compress_file = file_process.compress_file
+
+    def failing_compress(input_file, *args, **kwargs):
+        if input_file.name == "file5.txt":
+            raise OSError("unreadable")
+        return compress_file(input_file, *args, **kwargs)
+
+    monkeypatch.setattr(file_process, 'compress_file', failing_compress)
+    hooks = RunStats()
+    with pytest.raises(OSError):
+        run_tree(input_tree, target, file_jobs=file_jobs, manifest_file=manifest, hooks=hooks)
+
+    # The rest of the run is done and reported
+    assert hooks.wall is not None
+    assert hooks.report()['files']['failed'] == 1
+    out, _ = capsys.readouterr()
+    assert "file5.txt: FAILED (unreadable)" in out
+    assert "Total input size" in out
+
+    _, files = read_manifest(manifest)
+    assert "dir2/file5.txt" not in files
+    assert "dir2/file11.txt" in files
+
+    # Only the failed file is compressed again
+    monkeypatch.undo()
+    statuses = {r.source.name: r.status for r in run_tree(input_tree, target, manifest_file=manifest)}
+    assert statuses.pop("file5.txt") == 'compressed'
+    assert all(status == 'unchanged' for status in statuses.values())
+
+
+def test_tree_dictionary(tmpdir):
+    random.seed(0)
+    source = Path(tmpdir / "source")
+    source.mkdir()
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(random.randint(3, 12)))
+             for _ in range(400)]
+    for idx in range(150):
+        with (source / f"record{idx}.json").open('w') as fout:
+            while fout.tell() < 5000:
+                fout.write(f'{{"id": {random.randrange(10**6)}, "user": "{random.choice(words)}", '
+                           f'"status": "{random.choice(["active", "disabled"])}", "score": {random.random():.4f}}},\n')
+
+    def tree_size(target):
+        return sum(f.stat().st_size for f in target.iterdir())
+
+    plain = Path(tmpdir / "plain")
+    run_tree(source, plain, alg='zstd')
+    per_file = Path(tmpdir / "per_file")
+    run_tree(source, per_file, alg='zstd_dict')
+    tree = Path(tmpdir / "tree")
+    run_tree(source, tree, alg='zstd_dict', dict_scope='tree')
+
+    # Small files don't get a dictionary of their own, and the tree one is stored once
+    assert tree_size(per_file) <= tree_size(plain)
+    assert tree_size(tree) < 0.95 * tree_size(plain)
+    assert len([f for f in tree.iterdir() if f.name.startswith(TREE_DICT_PREFIX)]) == 1
+
+    extracted = Path(tmpdir / "extracted")
+    extracted.mkdir()
+    uncompress_files(tree, extracted, quiet=True)
+    assert sorted(f.name for f in extracted.iterdir()) == sorted(f.name for f in source.iterdir())
+    for f in source.iterdir():
+        assert (extracted / f.name).read_bytes() == f.read_bytes()
+    assert verify_files(tree, source, quiet=True) == []
+
+
+def test_tree_dictionary_rerun(tmpdir):
+    random.seed(1)
+    source = Path(tmpdir / "source")
+    source.mkdir()
+    for idx in range(40):
+        with (source / f"log{idx}.txt").open('w') as fout:
+            while fout.tell() < 4000:
+                fout.write(f"{random.choice(['GET', 'POST'])} /api/v1/items/{random.randrange(1000)} "
+                           f"{random.choice([200, 404, 500])}\n")
+    # A user file that only looks like a tree dictionary
+    (source / f"{TREE_DICT_PREFIX}00000001").write_bytes(b"not a dictionary")
+
+    target = Path(tmpdir / "target")
+    manifest = Path(tmpdir / "manifest.json")
+
+    def dictionaries():
+        return sorted(f.name for f in target.iterdir() if f.name.startswith(TREE_DICT_PREFIX)
+                      and f.name != f"{TREE_DICT_PREFIX}00000001")
+
+    run_tree(source, target, alg='zstd_dict', dict_scope='tree', manifest_file=manifest)
+    first = dictionaries()
+    assert len(first) == 1
+
+    # Every file changes, so the first dictionary isn't used any more
+    for f in source.glob("log*.txt"):
+        with f.open('a') as fout:
+            fout.write("DELETE /api/v2/users 204\n" * 50)
+    run_tree(source, target, alg='zstd_dict', dict_scope='tree', manifest_file=manifest)
+    second = dictionaries()
+    assert len(second) == 1 and second != first
+
+    extracted = Path(tmpdir / "extracted")
+    extracted.mkdir()
+    uncompress_files(target, extracted, quiet=True)
+    assert sorted(f.name for f in extracted.iterdir()) == sorted(f.name for f in source.iterdir())
+    for f in source.iterdir():
+        assert (extracted / f.name).read_bytes() == f.read_bytes()
@@ -0,0 +1,20 @@
+import os
+import pytest
+
+from pathlib import Path
+from mkzftree2 import utils
+from mkzftree2.utils import copy_file_data
+
+
+@pytest.mark.parametrize('system', ['Linux', 'Other'])
+def test_copy_file_data(tmpdir, monkeypatch, system):
+    monkeypatch.setattr(utils.platform, 'system', lambda: system)
+
+    src_file = Path(tmpdir / "src.bin")
+    dst_file = Path(tmpdir / "dst.bin")
+    src_file.write_bytes(os.urandom(3 * utils.COPY_BUFSIZE + 123))
+
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+        copy_file_data(src, dst)
+
+    assert dst_file.read_bytes() == src_file.read_bytes()
@@ -0,0 +1,265 @@
+import errno
+import importlib
+import os
+import random
+import sys
+import time
+import types
+from pathlib import Path
+
+import pytest
+
+from mkzftree2.compressor import compress_file, save_tree_dictionary
+from mkzftree2.index import index_entry
+
+trio = pytest.importorskip('trio')
+
+
+def _fake_pyfuse3():
+    """
+    The parts of pyfuse3 used by the operations, enough to call them without mounting
+    """
+    module = types.ModuleType('pyfuse3')
+
+    class FUSEError(Exception):
+        def __init__(self, errno_):
+            super().__init__(errno_)
+            self.errno = errno_
+
+    class Attributes:
+        pass
+
+    class FileInfo:
+        def __init__(self, fh=None):
+            self.fh = fh
+
+    module.ROOT_INODE = 1
+    module.default_options = frozenset()
+    module.FUSEError = FUSEError
+    module.Operations = object
+    module.EntryAttributes = Attributes
+    module.StatvfsData = Attributes
+    module.FileInfo = FileInfo
+    module.readdir_reply = None
+    return module
+
+
+@pytest.fixture
+def zisofuse(monkeypatch):
+    try:
+        import pyfuse3  # noqa: F401
+    except ImportError:
+        monkeypatch.setitem(sys.modules, 'pyfuse3', _fake_pyfuse3())
+    monkeypatch.delitem(sys.modules, 'mkzftree2.zisofuse', raising=False)
+    return importlib.import_module('mkzftree2.zisofuse')
+
+
+@pytest.fixture
+def tree(tmpdir):
+    """
+    A compressed tree with a multi-block file, and its uncompressed content
+    """
+    random.seed(0)
+    source = Path(tmpdir / "data.csv")
+    with source.open('w') as fout:
+        for idx in range(60000):
+            fout.write(f"{idx},{random.randint(0, 1000)}\n")
+
+    root = Path(tmpdir / "tree")
+    root.mkdir()
+    compress_file(source, root / "data.csv", algorithm='zstd')
+    (root / "plain.txt").write_bytes(b"not compressed\n")
+    return root, source.read_bytes()
+
+
+async def _open(ops, name):
+    attr = await ops.lookup(1, os.fsencode(name))
+    return attr, (await ops.open(attr.st_ino, os.O_RDONLY, None)).fh
+
+
+@pytest.mark.parametrize('options', [dict(), dict(use_mmap=True), dict(cache_size=0), dict(readahead=0)])
+def test_read(zisofuse, tree, options):
+    root, content = tree
+
+    async def main():
+        ops = zisofuse.Operations(str(root), threads=2, **options)
+        attr, fh = await _open(ops, "data.csv")
+        assert attr.st_size == len(content)
+
+        data = bytearray()
+        while len(data) < len(content):
+            data += await ops.read(fh, len(data), 100000)
+        assert bytes(data) == content
+
+        rnd = random.Random(1)
+        for _ in range(50):
+            offset, length = rnd.randrange(len(content)), rnd.randrange(1, 3 * 2**15)
+            assert bytes(await ops.read(fh, offset, length)) == content[offset:offset + length]
+        assert await ops.read(fh, len(content), 10) == b''
+
+        if ops._block_cache is not None:
+            assert ops._block_cache.hits > 0
+        await ops.release(fh)
+
+        # Files which are not compressed are read as they are
+        attr, fh = await _open(ops, "plain.txt")
+        assert attr.st_size == 15
+        assert await ops.read(fh, 4, 100) == b"compressed\n"
+        await ops.release(fh)
+
+    trio.run(main)
+
+
+@pytest.mark.parametrize('threads, readahead, reads, prefetches', [
+    (8, 32, 4, 4), (3, 32, 2, 1), (1, 32, 1, 0), (8, 0, 8, 0),
+])
+def test_threads(zisofuse, tmpdir, threads, readahead, reads, prefetches):
+    # Reads and prefetches share the threads
+    ops = zisofuse.Operations(str(tmpdir), threads=threads, readahead=readahead)
+    assert ops._read_limiter.total_tokens == reads
+    assert (ops._prefetch_pool._max_workers if ops._prefetch_pool else 0) == prefetches
+    assert bool(ops._readahead) == bool(prefetches)
+
+
+def test_open_validates_cache(zisofuse, tree, tmpdir):
+    root, content = tree
+    other = Path(tmpdir / "other.csv")
+    other.write_bytes(content[::-1] + b"more")
+
+    async def main():
+        ops = zisofuse.Operations(str(root), readahead=0)
+        attr, fh = await _open(ops, "data.csv")
+        assert bytes(await ops.read(fh, 0, 1000)) == content[:1000]
+        await ops.release(fh)
+
+        # Rewritten in place: same inode, but the cached blocks are stale
+        compress_file(other, root / "data.csv", algorithm='zstd')
+        assert (await ops.lookup(1, b"data.csv")).st_ino == attr.st_ino
+        attr, fh = await _open(ops, "data.csv")
+        assert bytes(await ops.read(fh, 0, 1000)) == other.read_bytes()[:1000]
+        await ops.release(fh)
+
+    trio.run(main)
+
+
+def test_release_waits_prefetches(zisofuse, tree):
+    root, content = tree
+    finished = []
+
+    async def main():
+        ops = zisofuse.Operations(str(root), threads=2, readahead=8)
+        prefetch_block = ops._prefetch_block
+
+        def slow_prefetch(inode, fobj, fd, num):
+            time.sleep(0.05)
+            # The fd must still be open
+            os.fstat(fd)
+            finished.append(num)
+            return prefetch_block(inode, fobj, fd, num)
+
+        ops._prefetch_block = slow_prefetch
+
+        _, fh = await _open(ops, "data.csv")
+        for offset in range(0, 3 * 2**15, 2**15):
+            await ops.read(fh, offset, 2**15)
+        futures = list(ops._prefetch_futures[fh].values())
+        assert futures
+
+        await ops.release(fh)
+        assert fh not in ops._prefetch_futures and fh not in ops._readahead_map
+        assert all(f.done() for f in futures)
+        # Queued prefetches are dropped, and the running ones ended before the close
+        assert any(f.cancelled() for f in futures)
+        assert all(f.exception() is None for f in futures if not f.cancelled())
+        with pytest.raises(OSError):
+            os.fstat(fh)
+
+    trio.run(main)
+    assert finished
+
+
+def test_readdir(zisofuse, tmpdir, monkeypatch):
+    root = Path(tmpdir / "tree")
+    root.mkdir()
+    names = [f"file{idx:03}" for idx in range(2 * zisofuse.READDIR_BATCH + 10)]
+    for name in names:
+        (root / name).write_bytes(name.encode())
+    save_tree_dictionary(root, b"dictionary")
+
+    replies = []
+    limit = [0]
+
+    def readdir_reply(token, name, attr, off):
+        # The reply buffer fills after limit entries
+        if len(replies) >= limit[0]:
+            return False
+        replies.append((os.fsdecode(name), attr, off))
+        return True
+
+    monkeypatch.setattr(zisofuse.pyfuse3, 'readdir_reply', readdir_reply)
+
+    async def main():
+        ops = zisofuse.Operations(str(root))
+        fh = await ops.opendir(1, None)
+        (root / "file005").unlink()
+
+        # Each call resumes at the offset of the last entry returned
+        offset = 0
+        while True:
+            limit[0] += 50
+            count = len(replies)
+            await ops.readdir(fh, offset, None)
+            if len(replies) == count:
+                break
+            offset = replies[-1][2]
+        await ops.releasedir(fh)
+        assert fh not in ops._dir_snapshots
+
+    trio.run(main)
+
+    # Every entry once, without the tree dictionary nor the entry removed after opendir
+    assert sorted(name for name, _, _ in replies) == [name for name in names if name != "file005"]
+    offsets = [off for _, _, off in replies]
+    assert offsets == sorted(set(offsets))
+    assert all(attr.st_size == 7 for _, attr, _ in replies)
+
+
+def test_getattr(zisofuse, tree, monkeypatch):
+    root, content = tree
+    index = {"data.csv": index_entry(root / "data.csv", "data.csv")}
+
+    async def main():
+        ops = zisofuse.Operations(str(root), attr_timeout=5, entry_timeout=7, index=index)
+        attr = await ops.lookup(1, b"data.csv")
+        assert (attr.st_size, attr.attr_timeout, attr.entry_timeout) == (len(content), 5, 7)
+        assert await ops.getattr(attr.st_ino) is not None
+
+        attrs = ops._batch_getattr(str(root), ["plain.txt", "missing", "data.csv"])
+        assert attrs[1] is None
+        assert [attrs[0].st_size, attrs[2].st_size] == [15, len(content)]
+
+        with pytest.raises(zisofuse.FUSEError) as ex:
+            await ops.lookup(1, b"missing")
+        assert ex.value.errno == errno.ENOENT
+
+    # Indexed files get their size from the index, without reading their header
+    headers = []
+    uncompressed_size = zisofuse.Operations._uncompressed_size
+
+    def read_header(path, stat):
+        headers.append(path)
+        return uncompressed_size(path, stat)
+
+    monkeypatch.setattr(zisofuse.Operations, '_uncompressed_size', staticmethod(read_header))
+    trio.run(main)
+    assert str(root / "data.csv") not in headers
+
+    # An index entry of another version of the file is ignored
+    index["data.csv"] = index["data.csv"]._replace(size=1, csize=2)
+
+    async def stale():
+        ops = zisofuse.Operations(str(root), index=index)
+        assert (await ops.lookup(1, b"data.csv")).st_size == len(content)
+
+    trio.run(stale)
+    assert str(root / "data.csv") in headers